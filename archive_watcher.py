@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+archive_watcher.py: Queue the downstream pipelines of a session when a pipeline's output lands in the archive.
+
+The archive is polled incrementally: the mtime of each session's RESOURCES
+directory is kept in a SQLite cursor, and only the sessions whose directory
+changed are listed. On CephFS, a project whose `arc001` has the same recursive
+ctime (`ceph.dir.rctime`) as at the last poll isn't listed at all. A new output resource (the OUTPUT_RESOURCE_NAME of a
+pipeline, e.g. Structural_preproc or rfMRI_REST1_AP_preproc) is watched until
+the success file of its XNAT_CHECK step appears. Then every downstream pipeline
+whose inputs are now all complete is added to the queue feeder's ledger (see
+queue_feeder.py), which submits it.
+
+A downstream pipeline waits for every upstream pipeline producing its required
+inputs that applies to the session, e.g. MultiRunIcaFixProcessing waits for all
+the fMRI scans, but not for DiffusionPreprocessing: Diffusion_preproc is one of
+its OPTIONAL_INPUTS (see scheduler.py).
+
+    python archive_watcher.py --project CCF_HCA_STG --interval 60
+    python archive_watcher.py --project CCF_HCA_STG --once --pipelines FunctionalPreprocessing DiffusionPreprocessing
+
+The first poll of a project only records what is already in the archive.
+"""
+import argparse
+import os
+import re
+import signal
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+from queue_feeder import DEFAULT_LEDGER, Ledger
+from scheduler import CONFIG_DIR, PER_SCAN_PIPELINES, PipelineGraph, is_complete, produces, scan_values
+
+DEFAULT_CURSOR = os.path.expanduser("~/pipeline_runner_logs/archive_watcher.sqlite")
+DEFAULT_ARCHIVE_ROOT = "/ceph/intradb/archive"
+# resources whose XNAT_CHECK never succeeds are not watched forever
+PENDING_SECONDS = 7 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    project TEXT, session TEXT, mtime REAL,
+    PRIMARY KEY (project, session)
+);
+CREATE TABLE IF NOT EXISTS resources (
+    project TEXT, session TEXT, resource TEXT, state TEXT, seen REAL,
+    PRIMARY KEY (project, session, resource)
+);
+CREATE INDEX IF NOT EXISTS resources_state ON resources (state);
+CREATE TABLE IF NOT EXISTS projects (project TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS project_stamps (project TEXT PRIMARY KEY, rctime TEXT);
+"""
+
+
+def tree_stamp(path):
+    """
+    When anything below `path` last changed: the recursive ctime CephFS keeps for directories, or None elsewhere.
+    """
+    try:
+        return os.getxattr(path, "ceph.dir.rctime").decode()
+    except (OSError, AttributeError):
+        return None
+
+
+def producer(graph, resource):
+    """
+    Returns:
+        (pipeline, scan) of the pipeline whose output is `resource`, or None
+    """
+    for pipeline, settings in graph.pipelines.items():
+        if settings["output"] == resource:
+            return pipeline, ""
+    for pipeline, settings in graph.pipelines.items():
+        if "${SCAN}" in settings["output"]:
+            pattern = re.escape(settings["output"]).replace(re.escape("${SCAN}"), "(.+)")
+            match = re.fullmatch(pattern, resource)
+            if match:
+                return pipeline, match.group(1)
+    return None
+
+
+class Session:
+    """
+    The state of the pipelines of a session, from its RESOURCES directory.
+    """
+
+    def __init__(self, graph, resources_root, session):
+        self.graph = graph
+        self.resources_root = resources_root
+        self.session = session
+        self._applicable = {}
+
+    def producers(self, pattern, pipeline):
+        return [
+            other for other, settings in self.graph.pipelines.items()
+            if other != pipeline and produces(settings["output"], pattern)
+        ]
+
+    def applicable(self, pipeline):
+        """
+        Whether the session has the data the pipeline needs, or will have once its upstream pipelines ran.
+        """
+        if pipeline not in self._applicable:
+            self._applicable[pipeline] = False
+            if pipeline in PER_SCAN_PIPELINES and not scan_values(pipeline, self.resources_root):
+                return False
+            result = True
+            for pattern in self.graph.pipelines[pipeline]["inputs"]:
+                producers = self.producers(pattern, pipeline)
+                if producers:
+                    result = result and any(self.applicable(other) for other in producers)
+                else:
+                    result = result and any(Path(self.resources_root).glob(pattern.split("/")[0]))
+            self._applicable[pipeline] = result
+        return self._applicable[pipeline]
+
+    def complete(self, pipeline, scan=None):
+        if scan is None and pipeline in PER_SCAN_PIPELINES:
+            return all(self.complete(pipeline, value) for value in scan_values(pipeline, self.resources_root))
+        return is_complete(self.resources_root, self.graph, pipeline, self.session, scan or "")
+
+    def ready(self, pipeline):
+        """
+        Whether every upstream pipeline that applies to the session is complete.
+        """
+        if not self.applicable(pipeline):
+            return False
+        return all(
+            self.complete(upstream)
+            for upstream in self.graph.upstream(pipeline)
+            if self.applicable(upstream)
+        )
+
+
+class ArchiveWatcher:
+    def __init__(self, db_path, graph, archive_root, ledger, pipelines=None, extra="all"):
+        """
+        Args:
+            pipelines: the downstream pipelines that may be queued, default is all
+            extra: the extra component of the subject strings of pipelines that don't run per scan
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.graph = graph
+        self.archive_root = archive_root
+        self.ledger = ledger
+        self.pipelines = pipelines or list(graph.pipelines)
+        self.extra = extra
+
+    def close(self):
+        self.db.close()
+
+    def poll(self, projects, now=None):
+        """
+        Returns:
+            list of (pipeline, subject string) added to the ledger
+        """
+        now = time.time() if now is None else now
+        queued = []
+        for project in projects:
+            primed = self.db.execute("SELECT 1 FROM projects WHERE project = ?", (project,)).fetchone()
+            project_dir = os.path.join(self.archive_root, project, "arc001")
+            # before listing, so that a change made during the listing is seen by the next poll
+            rctime = tree_stamp(project_dir)
+            row = self.db.execute("SELECT rctime FROM project_stamps WHERE project = ?", (project,)).fetchone()
+            if not (primed and rctime is not None and row is not None and row["rctime"] == rctime):
+                self._scan_project(project, project_dir, "pending" if primed else "seen", now)
+                self.db.execute("INSERT OR REPLACE INTO project_stamps VALUES (?, ?)", (project, rctime))
+            self.db.execute("INSERT OR IGNORE INTO projects VALUES (?)", (project,))
+            self.db.commit()
+            queued += self._check_pending(project, now)
+        return queued
+
+    def _scan_project(self, project, project_dir, state, now):
+        known = {
+            row["session"]: row["mtime"]
+            for row in self.db.execute("SELECT session, mtime FROM sessions WHERE project = ?", (project,))
+        }
+        with os.scandir(project_dir) as sessions:
+            for entry in sessions:
+                resources_dir = os.path.join(entry.path, "RESOURCES")
+                try:
+                    mtime = os.stat(resources_dir).st_mtime
+                except OSError:
+                    continue
+                if known.get(entry.name) != mtime:
+                    self._scan_session(project, entry.name, resources_dir, mtime, state, now)
+
+    def _scan_session(self, project, session, resources_dir, mtime, state, now):
+        names = [name for name in os.listdir(resources_dir) if producer(self.graph, name)]
+        for name in names:
+            self.db.execute(
+                "INSERT OR IGNORE INTO resources VALUES (?, ?, ?, ?, ?)", (project, session, name, state, now)
+            )
+        # a resource that is removed, e.g. to be processed again, is new when it reappears
+        placeholders = ", ".join("?" * len(names))
+        self.db.execute(
+            f"DELETE FROM resources WHERE project = ? AND session = ? AND resource NOT IN ({placeholders})",
+            (project, session, *names),
+        )
+        self.db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (project, session, mtime))
+
+    def _check_pending(self, project, now):
+        queued = []
+        rows = self.db.execute(
+            "SELECT * FROM resources WHERE project = ? AND state = 'pending'", (project,)
+        ).fetchall()
+        for row in rows:
+            pipeline, scan = producer(self.graph, row["resource"])
+            resources_root = os.path.join(self.archive_root, project, "arc001", row["session"], "RESOURCES")
+            if not is_complete(resources_root, self.graph, pipeline, row["session"], scan):
+                if now - row["seen"] > PENDING_SECONDS:
+                    self._set_state(row, "expired")
+                continue
+            self._set_state(row, "complete")
+            print(f"{project} {row['session']}: {row['resource']} is complete")
+            queued += self.queue_downstream(project, row["session"], pipeline)
+        self.db.commit()
+        return queued
+
+    def _set_state(self, row, state):
+        self.db.execute(
+            "UPDATE resources SET state = ? WHERE project = ? AND session = ? AND resource = ?",
+            (state, row["project"], row["session"], row["resource"]),
+        )
+
+    def queue_downstream(self, project, session, pipeline):
+        resources_root = os.path.join(self.archive_root, project, "arc001", session, "RESOURCES")
+        state = Session(self.graph, resources_root, session)
+        subject, classifier = session.split("_", 1)
+        queued = []
+        for downstream in self.pipelines:
+            if pipeline not in self.graph.upstream(downstream) or not state.ready(downstream):
+                continue
+            if downstream in PER_SCAN_PIPELINES:
+                extras = [x for x in scan_values(downstream, resources_root) if not state.complete(downstream, x)]
+            else:
+                extras = [] if state.complete(downstream) else [self.extra]
+            subject_strings = [f"{project}:{subject}:{classifier}:{extra}" for extra in extras]
+            # sessions already in the ledger are not added again
+            if self.ledger.add(downstream, subject_strings):
+                print(f"{project} {session}: queued {downstream} {' '.join(extras)}")
+                queued += [(downstream, x) for x in subject_strings]
+        return queued
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Queue downstream pipelines when outputs land in the archive.")
+    parser.add_argument("--project", action="append", required=True, help="Project(s) to watch.")
+    parser.add_argument("--archive-root", default=DEFAULT_ARCHIVE_ROOT)
+    parser.add_argument("--cursor", default=DEFAULT_CURSOR, help="SQLite database of what was already seen.")
+    parser.add_argument("--ledger", default=DEFAULT_LEDGER, help="Ledger of queue_feeder.py.")
+    parser.add_argument("--pipelines", nargs="+", help="Downstream pipelines to queue. Default is all.")
+    parser.add_argument("--extra", default="all", help="Extra of the pipelines that don't run per scan.")
+    parser.add_argument("--interval", type=int, default=60, help="Seconds between polls.")
+    parser.add_argument("--once", action="store_true", help="Poll once, e.g. from cron.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    graph = PipelineGraph.from_config(CONFIG_DIR)
+    watcher = ArchiveWatcher(args.cursor, graph, args.archive_root, Ledger(args.ledger), args.pipelines, args.extra)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    while True:
+        start = time.time()
+        queued = watcher.poll(args.project)
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} polled in {time.time() - start:.1f}s, queued {len(queued)}")
+        if args.once:
+            return 0
+        time.sleep(max(0, args.interval - (time.time() - start)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+batch.py: Run a pipeline for many subject strings in one invocation.
+
+    python batch.py [--dryrun] [--workers 8] PIPELINE --subjects-file subjects.txt [--VAR=value ...]
+
+The subjects file has one `project:subject:classifier:extra` string per line;
+blank lines and `#` comments are ignored. Subject strings can also be passed
+as positional arguments.
+
+Compared to invoking `prunner` once per session, the pipeline definition,
+variables.yaml, functions.py and the compiled templates are loaded once, and
+checks that only depend on shared variables (e.g. that the containers are
+readable) run once. Sessions are then rendered by a pool of forked workers,
+which inherit everything already loaded. A failing session is reported at the
+end and does not stop the rest of the batch.
+
+With --array-manifest, the jobs of the sessions are not submitted one by one,
+but collected in a manifest and submitted as slurm job arrays, one array per
+step, by lib/slurm_array.py. With --pack-sessions N as well, the run_all jobs
+of N sessions share one allocation instead, see lib/slurm_pack.py.
+"""
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+import traceback
+from pprint import PrettyPrinter
+
+from prunner.ImmutableDict import ImmutableDict
+from prunner.executioner import Executioner, typecast
+from prunner.tasks import STANDARD_TASKS
+from prunner.tasks.call_function import FunctionTask, generate_args_from_function_signature
+from prunner.util import convert_args_to_dict, split_file_component
+
+# functions whose result only depends on variables shared by every session of a batch
+SHARED_FUNCTIONS = ("check_required_files_are_available",)
+
+
+class BatchFunctionTask(FunctionTask):
+    """
+    Calls each of SHARED_FUNCTIONS once per distinct set of arguments.
+    """
+
+    def __init__(self, default_filename):
+        super().__init__(default_filename)
+        self.results = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(f"{settings['PRUNNER_CONFIG_DIR']}/functions.py")
+
+    def execute(self, params, variables=None):
+        function_name, filename = split_file_component(params)
+        if function_name not in SHARED_FUNCTIONS:
+            return super().execute(params, variables)
+
+        fn = self.loader.get_function(function_name, filename)
+        args = generate_args_from_function_signature(fn, variables)
+        key = (function_name, filename, repr(args))
+        if key not in self.results:
+            self.results[key] = fn(*args)
+        return self.results[key]
+
+
+class SessionExecutioner(Executioner):
+    """
+    An Executioner that shares its loaders and tasks with the rest of the batch.
+    """
+
+    def __init__(self, variables, shared):
+        for k, v in variables.items():
+            variables[k] = typecast(v)
+        self.variables = variables
+        self.pipeline_loader = shared.pipeline_loader
+        self.tasks = shared.tasks
+        self.printer = PrettyPrinter()
+
+
+class Batch:
+    def __init__(self, pipeline, variables, tasks=None):
+        """
+        Args:
+            pipeline: name of the pipeline in pipelines.yaml
+            variables: variables shared by all sessions, as prunner would set them from the CLI
+            tasks: task classes, defaults to prunner's standard tasks with BatchFunctionTask
+        """
+        self.pipeline = pipeline
+        self.variables = variables
+        if tasks is None:
+            tasks = [BatchFunctionTask if task is FunctionTask else task for task in STANDARD_TASKS]
+        self.shared = Executioner(ImmutableDict(variables), tasks)
+
+    def warm_up(self):
+        """
+        Parse the YAML files, import functions.py and compile every template of the pipeline.
+        """
+        steps = self.shared.pipeline_loader.get_section(self.pipeline)
+        for step in steps:
+            (task_name, params), = step.items()
+            task = self.shared.get_task(task_name)
+            if task_name in ("load_variables", "function"):
+                task.loader.load(split_file_component(params)[1])
+            elif task_name == "generate_file":
+                task.loader.get_template(params["template"])
+        # the templates won't change during the batch, don't stat them on every render
+        self.shared.get_task("generate_file").loader.env.auto_reload = False
+
+    def execute(self, subject_string, variables=None):
+        """
+        Run the pipeline for one session.
+
+        Returns:
+            the variables at the end of the pipeline, e.g., SUBMIT_TO_PBS_SCRIPT
+        """
+        variables = ImmutableDict(dict(self.variables if variables is None else variables))
+        variables.update({"_0": subject_string, "_1": subject_string})
+        executioner = SessionExecutioner(variables, self.shared)
+        executioner.execute_pipeline(self.pipeline)
+        return executioner.variables
+
+    def run_session(self, subject_string, variables=None):
+        """
+        Args:
+            variables: variables of this session, instead of the ones of the batch
+
+        Returns:
+            (subject string, error or None, captured output)
+        """
+        output = io.StringIO()
+        error = None
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                self.execute(subject_string, variables)
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+        return subject_string, error, output.getvalue()
+
+    def run(self, subject_strings, workers=1, log_dir=None):
+        """
+        Returns:
+            dict of {subject string: error} for the sessions that failed
+        """
+        self.warm_up()
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+
+        if workers > 1:
+            # forked workers inherit the loaded YAML, functions and compiled templates
+            global _batch
+            _batch = self
+            pool = multiprocessing.get_context("fork").Pool(workers)
+            results = pool.imap_unordered(_run_session, subject_strings)
+        else:
+            pool = None
+            results = map(self.run_session, subject_strings)
+
+        failures = {}
+        try:
+            for i, (subject_string, error, output) in enumerate(results, 1):
+                status = "FAILED" if error else "OK"
+                print(f"[{i}/{len(subject_strings)}] {status}: {subject_string}", flush=True)
+                if log_dir:
+                    log_name = subject_string.replace(":", "_").replace("/", "_") + ".log"
+                    with open(os.path.join(log_dir, log_name), "w") as fd:
+                        fd.write(output)
+                if error:
+                    failures[subject_string] = error
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return failures
+
+
+# the batch being run, inherited by the forked workers
+_batch = None
+
+
+def _run_session(subject_string):
+    return _batch.run_session(subject_string)
+
+
+def read_subject_strings(filepath):
+    with open(filepath) as fd:
+        lines = [line.split("#", 1)[0].strip() for line in fd]
+    return [line for line in lines if line]
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Run a pipeline for many subject strings.")
+    parser.add_argument("--config", "-c", help="The configuration directory to use. Default is $PWD.")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose (for debugging pipeline).")
+    parser.add_argument("--dryrun", "-n", action="store_true", help="Dry-run. Don't execute local scripts.")
+    parser.add_argument("--subjects-file", help="File with one subject string per line.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Sessions rendered in parallel.")
+    parser.add_argument("--log-dir", help="Write the output of each session to <log-dir>/<subject string>.log")
+    parser.add_argument(
+        "--array-manifest",
+        help="Collect the jobs of all sessions in this manifest, then submit them as slurm job arrays.",
+    )
+    parser.add_argument("--array-max-running", type=int, help="Maximum number of tasks of an array running at once.")
+    parser.add_argument(
+        "--pack-sessions",
+        type=int,
+        help="With --array-manifest and BREAKPOINT=run_all, run this many sessions per allocation.",
+    )
+    parser.add_argument("PIPELINE", help="The name of the pipeline to run")
+    parser.add_argument("SUBJECTS", nargs="*", help="Subject strings, project:subject:classifier:extra")
+    # anything else is a --VARIABLE=value override applied to every session, as with prunner
+    parsed, rest = parser.parse_known_args(args)
+
+    overrides = convert_args_to_dict(rest)
+    overrides = {k: v for k, v in overrides.items() if not (k.startswith("_") and k[1:].isdigit())}
+    subject_strings = list(parsed.SUBJECTS)
+    if parsed.subjects_file:
+        subject_strings += read_subject_strings(parsed.subjects_file)
+
+    config_dir = os.path.abspath(parsed.config) if parsed.config else os.getcwd()
+    variables = {f"ENV_{k}": v for k, v in os.environ.items()}
+    variables.update(
+        {
+            "PRUNNER_CONFIG_DIR": config_dir,
+            "DRYRUN": parsed.dryrun,
+            "VERBOSE": parsed.verbose,
+            "DEFAULT_PIPELINE": parsed.PIPELINE,
+            **overrides,
+        }
+    )
+    if parsed.array_manifest:
+        variables["SUBMIT_MANIFEST"] = os.path.abspath(parsed.array_manifest)
+    return parsed, variables, subject_strings
+
+
+def main(args=None):
+    parsed, variables, subject_strings = parse_arguments(args)
+    if not subject_strings:
+        print("No subject strings given.")
+        return 2
+
+    if parsed.pack_sessions and not parsed.array_manifest:
+        print("--pack-sessions needs --array-manifest.")
+        return 2
+
+    if parsed.array_manifest and os.path.exists(parsed.array_manifest):
+        print(f"The manifest {parsed.array_manifest} already exists. Submit or remove it first.")
+        return 2
+
+    start = time.time()
+    failures = Batch(parsed.PIPELINE, variables).run(subject_strings, parsed.workers, parsed.log_dir)
+
+    print(
+        f"{parsed.PIPELINE}: {len(subject_strings) - len(failures)} of {len(subject_strings)} sessions "
+        f"succeeded in {time.time() - start:.1f}s."
+    )
+    for subject_string, error in failures.items():
+        print("-" * 80)
+        print(f"FAILED: {subject_string}")
+        print(error)
+
+    if parsed.array_manifest and os.path.exists(parsed.array_manifest):
+        if parsed.pack_sessions:
+            cmd = [sys.executable, os.path.join(variables["PRUNNER_CONFIG_DIR"], "lib", "slurm_pack.py")]
+            cmd.append(f"--sessions-per-pack={parsed.pack_sessions}")
+        else:
+            cmd = [sys.executable, os.path.join(variables["PRUNNER_CONFIG_DIR"], "lib", "slurm_array.py")]
+        if parsed.array_max_running and not parsed.pack_sessions:
+            cmd.append(f"--max-running={parsed.array_max_running}")
+        cmd.append(parsed.array_manifest)
+        subprocess.check_call(cmd)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
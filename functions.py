@@ -1,5 +1,6 @@
 import glob
 import logging
+import math
 import sys
 import os
 import random
@@ -7,7 +8,10 @@ import time
 from datetime import datetime
 from pathlib import Path
 
+from .lib.capacity import estimate, free_bytes, tree_size
+from .lib.container_cache import digest_file_problem
 from .lib.get_data import PipelineResources
+from .lib.resource_prediction import output_ratio, predict, read_history, run_totals
 from .util import escape_path, keep_resting_state_scans, shell_run, is_unreadable
 
 
@@ -27,6 +31,10 @@ def check_required_files_are_available(
         return
     if is_unreadable(QUNEX_CONTAINER):
         raise Exception("QUNEX_CONTAINER is not accessible. Value = ", QUNEX_CONTAINER)
+    # the nodes ignore a stale .sha256 and compute the sha256 of the container while copying it
+    problem = digest_file_problem(QUNEX_CONTAINER)
+    if problem:
+        logging.warning("%s Update it with sha256sum so that the nodes don't have to compute it.", problem)
     if is_unreadable(XNAT_CREDENTIALS_FILE):
         raise Exception("XNAT_CREDENTIALS_FILE is not accessible. Value = ", XNAT_CREDENTIALS_FILE)
     if is_unreadable(EXPECTED_FILES_LIST):
@@ -102,14 +110,67 @@ def choose_put_server(PUT_SERVER_LIST):
     }
 
 
+def check_capacity(
+    PIPELINE_NAME,
+    RESOURCES_ROOT,
+    BUILD_SPACE,
+    USE_SCRATCH_FOR_PROCESSING,
+    SCRATCH_CAPACITY_GBS,
+    TELEMETRY_HISTORY_FILE,
+    DRYRUN,
+    OUTPUT_INPUT_RATIO=1.5,
+    RESOURCE_QUANTILE=0.95,
+    RESOURCE_MARGIN=0.2,
+    SCRATCH_TMP_DIR="",
+    SCRATCH_TMP_GBS=0,
+    REQUEST_NODE_TMP=False,
+):
+    # The space needed by the inputs in RESOURCES_ROOT and by the outputs, from the ratio of
+    # bytes written to input size of the past runs of the pipeline in TELEMETRY_HISTORY_FILE.
+    # Scratch is local to the node the job will run on: its free space can't be seen from here,
+    # so the process job asks slurm for SCRATCH_NEEDED_GBS of it, up to SCRATCH_CAPACITY_GBS.
+    # A SCRATCH_TMP_DIR on node-local scratch, bound to the container's /tmp, needs SCRATCH_TMP_GBS of it
+    # whether or not the job processes on scratch. Slurm is only asked for it with REQUEST_NODE_TMP:
+    # the nodes must then define TmpDisk, or jobs asking for --tmp never start.
+    input_gbs = tree_size(RESOURCES_ROOT) / 2 ** 30
+    ratio = output_ratio(
+        read_history(TELEMETRY_HISTORY_FILE), PIPELINE_NAME, float(RESOURCE_QUANTILE), float(OUTPUT_INPUT_RATIO)
+    )
+    scratch_gbs, output_gbs = estimate(input_gbs, ratio, float(RESOURCE_MARGIN))
+    scratch_gbs, output_gbs = math.ceil(scratch_gbs), math.ceil(output_gbs)
+    print(f"Estimated {output_gbs} GB of outputs from {input_gbs:.1f} GB of inputs.")
+
+    free_gbs = free_bytes(BUILD_SPACE) / 2 ** 30
+    if free_gbs < output_gbs:
+        message = f"BUILD_SPACE has {free_gbs:.0f} GB free, {output_gbs} GB are needed. Value = {BUILD_SPACE}"
+        if not DRYRUN:
+            raise Exception(message)
+        logging.warning(message)
+
+    tmp_gbs = math.ceil(float(SCRATCH_TMP_GBS)) if str(SCRATCH_TMP_DIR).startswith("/scratch/") else 0
+    process_on_scratch = bool(USE_SCRATCH_FOR_PROCESSING) and scratch_gbs + tmp_gbs <= float(SCRATCH_CAPACITY_GBS)
+    if USE_SCRATCH_FOR_PROCESSING and not process_on_scratch:
+        logging.warning(
+            "%s GB are needed on scratch, more than SCRATCH_CAPACITY_GBS (%s): processing in BUILD_SPACE.",
+            scratch_gbs,
+            SCRATCH_CAPACITY_GBS,
+        )
+    return {
+        "PROCESS_ON_SCRATCH": process_on_scratch,
+        "SCRATCH_NEEDED_GBS": ((scratch_gbs if process_on_scratch else 0) + tmp_gbs) if REQUEST_NODE_TMP else 0,
+        "OUTPUT_ESTIMATE_GBS": output_gbs,
+        "INPUT_GBS": round(input_gbs, 1),
+    }
+
+
 def set_study_folder(
     WORKING_DIR,
     SESSION,
     SCRATCH_SPACE,
     WORKING_DIR_BASENAME,
-    USE_SCRATCH_FOR_PROCESSING,
+    PROCESS_ON_SCRATCH,
 ):
-    if USE_SCRATCH_FOR_PROCESSING:
+    if PROCESS_ON_SCRATCH:
         WORKING_DIR_SCRATCH = f"{SCRATCH_SPACE}/{WORKING_DIR_BASENAME}"
     else:
         WORKING_DIR_SCRATCH = WORKING_DIR
@@ -141,7 +202,7 @@ def make_directories(
         #os.makedirs(MARK_COMPLETION_DIR, exist_ok=True)
 
 
-def launch_main_script(SUBMIT_TO_PBS_SCRIPT, DRYRUN, AUTOLAUNCH_AT_END):
+def launch_main_script(SUBMIT_TO_PBS_SCRIPT, DRYRUN, AUTOLAUNCH_AT_END, SUBMIT_MANIFEST=""):
     if DRYRUN:
         logging.warning(
             "Dry-Mode is active: Skipping the launch of the main script to prevent side-effects."
@@ -153,7 +214,11 @@ def launch_main_script(SUBMIT_TO_PBS_SCRIPT, DRYRUN, AUTOLAUNCH_AT_END):
     else:
         launch_time = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
         logging.info("Launching main Bash script... at %s", launch_time)
-        shell_run(f"{SUBMIT_TO_PBS_SCRIPT} --normal-start")
+        if SUBMIT_MANIFEST:
+            # the jobs are submitted later, together with the other sessions of the batch
+            shell_run(f"{SUBMIT_TO_PBS_SCRIPT} --normal-start --manifest {SUBMIT_MANIFEST}")
+        else:
+            shell_run(f"{SUBMIT_TO_PBS_SCRIPT} --normal-start")
 
 
 def available_bold_dirs(RESOURCES_ROOT, PROJECT):
@@ -348,8 +413,73 @@ def set_qunex_scanlist_bold(BOLD_LIST_ORDER, BOLD_LIST):
 def multirunicafix_process_overrides(PROJECT):
     if "BANDA" in PROJECT:
         # BANDA often exceeds the 48GB memory limit.  It needs to be set higher.
-        overrides = dict(MEM_LIMIT_GBS = 60)
+        # A floor, so that predict_resources still sizes the jobs that need more;
+        # MEM_FLOOR_GBS is left unset by the yaml for this.
+        overrides = dict(MEM_FLOOR_GBS = 60)
     else:
         overrides = {}
 
     return overrides
+
+
+def predict_resources(
+    PIPELINE_NAME,
+    PROJECT,
+    MEM_LIMIT_GBS,
+    WALLTIME_LIMIT_HOURS,
+    TELEMETRY_HISTORY_FILE,
+    INPUT_GBS,
+    BOLD_LIST=(),
+    RESOURCE_QUANTILE=0.95,
+    RESOURCE_MARGIN=0.2,
+    JOB_MEM_LIMIT_GBS=None,
+    JOB_WALLTIME_LIMIT_HOURS=None,
+    RUNALL_WALLTIME_LIMIT_HOURS=None,
+    ALLOW_MEM_BELOW_LIMIT=False,
+    MEM_FLOOR_GBS=0,
+):
+    # The limits of the process job, from the past runs of the pipeline in TELEMETRY_HISTORY_FILE,
+    # or MEM_LIMIT_GBS and WALLTIME_LIMIT_HOURS without enough of them.
+    # The memory predicted is never below MEM_LIMIT_GBS, unless ALLOW_MEM_BELOW_LIMIT, nor ever below MEM_FLOOR_GBS.
+    # The run_all job runs every step: its walltime is predicted from whole runs, or is at least WALLTIME_LIMIT_HOURS.
+    # JOB_MEM_LIMIT_GBS, JOB_WALLTIME_LIMIT_HOURS or RUNALL_WALLTIME_LIMIT_HOURS given on the command line,
+    # or by an override, are kept.
+    # INPUT_GBS is the size of the session's RESOURCES_ROOT, measured by check_capacity.
+    bolds = len(BOLD_LIST) if BOLD_LIST else None
+    results = {"BOLD_COUNT": "" if bolds is None else bolds}
+    history = read_history(TELEMETRY_HISTORY_FILE)
+    predictors = {"bolds": bolds, "input_gbs": float(INPUT_GBS)}
+
+    prediction = predict(
+        history, PIPELINE_NAME, PROJECT, predictors, float(RESOURCE_QUANTILE), float(RESOURCE_MARGIN)
+    )
+    if prediction is None:
+        mem_gbs, hours = MEM_LIMIT_GBS, WALLTIME_LIMIT_HOURS
+    else:
+        mem_gbs, hours, runs = prediction
+        print(f"Predicted {mem_gbs} GB and {hours} hours from {runs} runs of {PIPELINE_NAME}.")
+        if not ALLOW_MEM_BELOW_LIMIT:
+            mem_gbs = max(mem_gbs, MEM_LIMIT_GBS)
+    mem_gbs = max(mem_gbs, MEM_FLOOR_GBS)
+
+    whole_runs = predict(
+        run_totals(history, PIPELINE_NAME),
+        PIPELINE_NAME,
+        PROJECT,
+        predictors,
+        float(RESOURCE_QUANTILE),
+        float(RESOURCE_MARGIN),
+    )
+    if whole_runs is None:
+        runall_hours = max(hours, WALLTIME_LIMIT_HOURS)
+    else:
+        runall_hours = whole_runs[1]
+        print(f"Predicted {runall_hours} hours for run_all from {whole_runs[2]} runs of {PIPELINE_NAME}.")
+
+    if JOB_MEM_LIMIT_GBS is None:
+        results["JOB_MEM_LIMIT_GBS"] = mem_gbs
+    if JOB_WALLTIME_LIMIT_HOURS is None:
+        results["JOB_WALLTIME_LIMIT_HOURS"] = hours
+    if RUNALL_WALLTIME_LIMIT_HOURS is None:
+        results["RUNALL_WALLTIME_LIMIT_HOURS"] = runall_hours
+    return results
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+generator_service.py: Keep the pipeline configuration loaded between runs.
+
+Start the service on the login node, from the root of the repo:
+
+    python generator_service.py serve [--socket ~/.hcp_generator.sock]
+
+Then submit generation requests to it, with the same arguments as `prunner`:
+
+    python generator_service.py run [--dryrun] MsmAllProcessing CCF_HCA_STG:HCA0123456789:V1_MR:all [--VAR=value ...]
+
+The service keeps pipelines.yaml, variables.yaml, bold_lists.yaml, functions.py
+and the compiled templates in memory, and reloads all of them when any of these
+files changes. Requests are handled one at a time, in the directory the service
+was started from; dry-run output goes to its `generated/` directory. The
+environment of the client (ENV_* variables) is used for its request.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import time
+from pathlib import Path
+
+from batch import Batch, parse_arguments
+
+DEFAULT_SOCKET = os.path.expanduser("~/.hcp_generator.sock")
+# files below the config dir that, if changed, invalidate everything loaded
+WATCHED_PATTERNS = ("*.yaml", "*.py", "lib/*.py", "templates/**/*")
+
+
+def watched_files(config_dir):
+    files = set()
+    for pattern in WATCHED_PATTERNS:
+        files.update(p for p in Path(config_dir).glob(pattern) if p.is_file())
+    return sorted(files)
+
+
+def snapshot(config_dir):
+    """
+    (path, mtime, size) of every watched file. Any difference means something changed.
+    """
+    result = []
+    for path in watched_files(config_dir):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        result.append((str(path), st.st_mtime_ns, st.st_size))
+    return tuple(result)
+
+
+def unload_functions():
+    """
+    Forget functions.py and the modules it imported relative to itself, so they are re-imported.
+    """
+    for name in list(sys.modules):
+        if name == "functions" or name.startswith("functions."):
+            del sys.modules[name]
+
+
+class Generator:
+    def __init__(self, config_dir):
+        self.config_dir = config_dir
+        self.batches = {}
+        self.state = snapshot(config_dir)
+
+    def reload_if_changed(self):
+        state = snapshot(self.config_dir)
+        if state == self.state:
+            return False
+        self.state = state
+        self.batches = {}
+        unload_functions()
+        return True
+
+    def batch(self, pipeline, variables):
+        if pipeline not in self.batches:
+            batch = Batch(pipeline, variables)
+            batch.warm_up()
+            self.batches[pipeline] = batch
+        return self.batches[pipeline]
+
+    def generate(self, pipeline, subject_strings, variables):
+        reloaded = self.reload_if_changed()
+        batch = self.batch(pipeline, variables)
+        # shared checks, e.g. that the containers are readable, are repeated for every request
+        batch.shared.get_task("function").results.clear()
+        results = [batch.run_session(subject_string, variables) for subject_string in subject_strings]
+        return reloaded, results
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    generator = None
+
+    def handle(self):
+        start = time.time()
+        try:
+            request = json.loads(self.rfile.readline())
+            variables = dict(request["variables"])
+            variables["PRUNNER_CONFIG_DIR"] = self.generator.config_dir
+            reloaded, results = self.generator.generate(request["pipeline"], request["subjects"], variables)
+            response = dict(
+                reloaded=reloaded,
+                results=[dict(subject=s, error=error, output=output) for s, error, output in results],
+            )
+        except Exception as e:
+            response = dict(error=f"{type(e).__name__}: {e}", results=[])
+        response["seconds"] = time.time() - start
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+def serve(socket_path, config_dir):
+    if os.path.exists(socket_path):
+        # refuse to take over the socket of a running service
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            os.remove(socket_path)
+        else:
+            raise Exception("A generator service is already listening on", socket_path)
+        finally:
+            probe.close()
+
+    generator = Generator(config_dir)
+    handler = type("Handler", (_Handler,), {"generator": generator})
+    server = socketserver.UnixStreamServer(socket_path, handler)
+    os.chmod(socket_path, 0o600)
+    print(f"Generator service for {config_dir} listening on {socket_path}", flush=True)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def request(socket_path, pipeline, subject_strings, variables, timeout=600):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_path)
+        message = dict(pipeline=pipeline, subjects=subject_strings, variables=variables)
+        client.sendall(json.dumps(message).encode() + b"\n")
+        with client.makefile("rb") as fd:
+            return json.loads(fd.readline())
+
+
+def run(socket_path, args):
+    parsed, variables, subject_strings = parse_arguments(args)
+    if not subject_strings:
+        print("No subject strings given.")
+        return 2
+    # the service uses its own configuration directory
+    del variables["PRUNNER_CONFIG_DIR"]
+
+    response = request(socket_path, parsed.PIPELINE, subject_strings, variables)
+    if response.get("error"):
+        print("Generator service error:", response["error"])
+        return 1
+
+    failed = 0
+    for result in response["results"]:
+        if parsed.verbose or result["error"]:
+            print(result["output"])
+        print(f"{'FAILED' if result['error'] else 'OK'}: {result['subject']}")
+        failed += bool(result["error"])
+    reloaded = " (configuration reloaded)" if response["reloaded"] else ""
+    print(f"Generated {len(response['results'])} session(s) in {response['seconds'] * 1000:.0f} ms{reloaded}.")
+    return 1 if failed else 0
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Keep the pipeline configuration loaded between runs.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"Unix socket. Default is {DEFAULT_SOCKET}")
+    parser.add_argument("command", choices=["serve", "run"])
+    parser.add_argument("--config", "-c", help="(serve) The configuration directory to use. Default is $PWD.")
+    parsed, rest = parser.parse_known_args(args)
+
+    if parsed.command == "serve":
+        config_dir = os.path.abspath(parsed.config) if parsed.config else os.getcwd()
+        # paths in pipelines.yaml, e.g. bold_lists.yaml, are relative to the config dir
+        os.chdir(config_dir)
+        serve(parsed.socket, config_dir)
+        return 0
+    return run(parsed.socket, rest)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
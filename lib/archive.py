@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+archive.py: Build zip archives in-process with zipfile, without the `zip` shell command.
+
+* Files that are already compressed (by extension, or because a sample of their
+  content does not compress) are stored rather than deflated.
+* The samples are read by a thread pool, ahead of the writer: on Ceph, opening
+  a file costs more than reading 64 KiB of it.
+* zipfile computes the CRC of every member while writing it, so the archive
+  does not have to be read back afterwards (`zip --test`).
+
+Archives larger than 4 GiB, or with more than 65535 members, use Zip64 records.
+"""
+import os
+import zlib
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+STORED = zipfile.ZIP_STORED
+DEFLATED = zipfile.ZIP_DEFLATED
+
+SAMPLE_SIZE = 64 * 1024
+# a sample that deflates to more than this fraction of its size is not worth deflating
+INCOMPRESSIBLE_RATIO = 0.9
+
+COMPRESSED_EXTENSIONS = (
+    ".gz",
+    ".tgz",
+    ".bz2",
+    ".xz",
+    ".zst",
+    ".zip",
+    ".7z",
+    ".mgz",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".sif",
+)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def is_compressed_extension(filename):
+    return os.fspath(filename).lower().endswith(COMPRESSED_EXTENSIONS)
+
+
+def looks_incompressible(sample):
+    if len(sample) < 512:
+        return False
+    return len(zlib.compress(sample, 1)) > INCOMPRESSIBLE_RATIO * len(sample)
+
+
+def compress_type(source):
+    """
+    STORED for a file that is already compressed, DEFLATED otherwise.
+
+    Only files whose extension doesn't tell are sampled. Runs in a worker thread.
+    """
+    if is_compressed_extension(source):
+        return STORED
+    with open(source, "rb") as fd:
+        sample = fd.read(SAMPLE_SIZE)
+    return STORED if looks_incompressible(sample) else DEFLATED
+
+
+def available_cpus():
+    """
+    CPUs this process may run on, e.g. those of the Slurm allocation rather than of the whole node.
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def write_archive(zip_path, entries, workers=None, level=6):
+    """
+    Write a zip archive.
+
+    Args:
+        zip_path: archive to create
+        entries: iterable of (source filepath, name within the archive)
+        workers: number of threads sampling the files, defaults to the number of CPUs available
+        level: zlib compression level of deflated members
+
+    Returns:
+        zip_path
+    """
+    if workers is None:
+        workers = available_cpus()
+    entries = [(os.fspath(source), arcname) for source, arcname in entries]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, zipfile.ZipFile(
+        zip_path, "w", compresslevel=level, allowZip64=True, strict_timestamps=False
+    ) as zf:
+        methods = pool.map(compress_type, [source for source, _ in entries])
+        for (source, arcname), method in zip(entries, methods):
+            size = os.path.getsize(source)
+            zf.write(source, arcname, compress_type=method)
+            if zf.infolist()[-1].file_size != size:
+                raise ArchiveError("File changed while it was being archived.", source)
+    return zip_path
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+capacity.py: Estimate the disk space a run needs, before it is launched.
+
+* input: the size of the session's RESOURCES, from the recursive size cephfs
+  keeps for directories, or from a parallel scan of the tree elsewhere
+* output: the input times the ratio of bytes written to input size of the past
+  process steps of the pipeline, see `output_ratio` in resource_prediction.py
+
+On scratch, the process step needs room for both, as the inputs are copied
+next to the outputs (see scratch_stage.py). BUILD_SPACE needs room for the
+outputs either way. `check_capacity` (functions.py) uses these to choose
+between scratch and BUILD_SPACE, or to refuse to generate the jobs.
+
+    capacity.py [--ratio 1.5] RESOURCES_ROOT [BUILD_SPACE]
+"""
+import argparse
+import os
+import shutil
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+WORKERS = 16
+
+
+def scan_directory(directory):
+    """
+    Returns:
+        (bytes of the files of `directory`, its subdirectories), links are not followed
+    """
+    size, subdirs = 0, []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size += entry.stat(follow_symlinks=False).st_size
+    except OSError:
+        pass
+    return size, subdirs
+
+
+def tree_size(path, workers=WORKERS):
+    """
+    Bytes of the files under `path`.
+    """
+    try:
+        return int(os.getxattr(path, "ceph.dir.rbytes"))
+    except (OSError, ValueError, AttributeError):
+        pass
+    total = 0
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(scan_directory, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                size, subdirs = future.result()
+                total += size
+                pending |= {pool.submit(scan_directory, subdir) for subdir in subdirs}
+    return total
+
+
+def free_bytes(path):
+    """
+    Free bytes of the file system of `path`, or of its closest existing parent.
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def estimate(input_gbs, ratio, margin):
+    """
+    Returns:
+        (GB needed on scratch to process there, GB of outputs needed in BUILD_SPACE)
+    """
+    output_gbs = input_gbs * ratio * (1 + margin)
+    return input_gbs * (1 + margin) + output_gbs, output_gbs
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Estimate the disk space a run needs.")
+    parser.add_argument("resources_root")
+    parser.add_argument("build_space", nargs="?")
+    parser.add_argument("--ratio", type=float, default=1.5, help="Bytes of output per byte of input.")
+    parser.add_argument("--margin", type=float, default=0.2)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    input_gbs = tree_size(args.resources_root) / 2 ** 30
+    scratch_gbs, build_gbs = estimate(input_gbs, args.ratio, args.margin)
+    print(f"input: {input_gbs:.1f} GB")
+    print(f"needed on scratch: {scratch_gbs:.1f} GB, in BUILD_SPACE: {build_gbs:.1f} GB")
+    if args.build_space:
+        print(f"free in BUILD_SPACE: {free_bytes(args.build_space) / 2 ** 30:.1f} GB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
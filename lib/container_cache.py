@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+container_cache.py: Keep a copy of the QuNex container on the node, see CONTAINER_CACHE_DIR.
+
+Images are cached under their name (which has QUNEX_VERSION) and the start of
+their sha256, so a container rebuilt under the same name is copied again. The
+sha256 is read from `<image>.sha256` next to the image when there is one and
+it is newer than the image, or computed during the first copy and remembered in
+the index of the cache.
+
+The jobs of a node take a lock on the cache, so that the first one copies the
+image and the others wait for it and use the same copy. Copies go to a partial
+file, are checked against the sha256, and only then renamed. To make room, the
+least recently used images are removed. When anything goes wrong, the image
+on Ceph is used.
+
+    QUNEX_CONTAINER=$(container_cache.py fetch IMAGE --cache-dir DIR [--capacity-gbs 60])
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+
+CAPACITY_GBS = 60
+CHUNK_BYTES = 16 * 2 ** 20
+LOCK_FILE = ".lock"
+INDEX_FILE = ".index.json"
+PARTIAL_SUFFIX = ".partial"
+DIGEST_SUFFIX = ".sha256"
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}\b")
+
+
+def read_digest_file(image):
+    """
+    Returns:
+        the sha256 of `<image>.sha256` (as written by sha256sum), or None
+    """
+    try:
+        with open(image + DIGEST_SUFFIX) as fd:
+            match = DIGEST_PATTERN.match(fd.read().strip())
+    except OSError:
+        return None
+    return match.group(0) if match else None
+
+
+def digest_file_problem(image):
+    """
+    Checks `<image>.sha256` without reading the image.
+
+    Returns:
+        what is wrong with it, or None if it is usable or absent
+    """
+    digest_file = image + DIGEST_SUFFIX
+    if not os.path.exists(digest_file):
+        return None
+    if read_digest_file(image) is None:
+        return f"{digest_file} has no sha256."
+    if os.path.getmtime(digest_file) < os.path.getmtime(image):
+        return f"{digest_file} is older than the image."
+    return None
+
+
+def cached_name(image, digest):
+    stem, extension = os.path.splitext(os.path.basename(image))
+    return f"{stem}.{digest[:16]}{extension}"
+
+
+def read_index(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE)) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_index(cache_dir, index):
+    path = os.path.join(cache_dir, INDEX_FILE)
+    with open(path + PARTIAL_SUFFIX, "w") as fd:
+        json.dump(index, fd)
+    os.replace(path + PARTIAL_SUFFIX, path)
+
+
+def known_digest(image, index):
+    """
+    The sha256 of `image`, from its .sha256 file or from the index if the image didn't change since.
+    """
+    # a .sha256 older than the image could name the copy of the image it replaced
+    digest = read_digest_file(image) if digest_file_problem(image) is None else None
+    if digest:
+        return digest
+    stat = os.stat(image)
+    entry = index.get(os.path.abspath(image))
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+    return None
+
+
+def copy_with_digest(source, destination):
+    """
+    Returns:
+        the sha256 of what was copied
+    """
+    digest = hashlib.sha256()
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        while True:
+            chunk = src.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+
+def cached_images(cache_dir):
+    """
+    Returns:
+        [(last use, size, path)] of the images of the cache, least recently used first
+    """
+    images = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.startswith(".") and not entry.name.endswith(PARTIAL_SUFFIX):
+            stat = entry.stat()
+            images.append((stat.st_mtime, stat.st_size, entry.path))
+    return sorted(images)
+
+
+def make_room(cache_dir, size, capacity):
+    """
+    Remove the least recently used images until `size` more bytes fit in the cache and on the disk.
+
+    Returns:
+        whether they fit
+    """
+    images = cached_images(cache_dir)
+    used = sum(image_size for _, image_size, _ in images)
+    free = shutil.disk_usage(cache_dir).free
+    while images and (used + size > capacity or size > free):
+        _, image_size, path = images.pop(0)
+        os.remove(path)
+        print(f"container_cache: evicted {path}", file=sys.stderr)
+        used -= image_size
+        free += image_size
+    return used + size <= capacity and size <= free
+
+
+def fetch(image, cache_dir, capacity=CAPACITY_GBS * 2 ** 30):
+    """
+    Returns:
+        the path of the copy of `image` in `cache_dir`, copying it there first if needed
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = read_index(cache_dir)
+        size = os.path.getsize(image)
+        expected = known_digest(image, index)
+        if expected:
+            cached = os.path.join(cache_dir, cached_name(image, expected))
+            if os.path.isfile(cached) and os.path.getsize(cached) == size:
+                # the last use, for the eviction
+                os.utime(cached)
+                return cached
+
+        if not make_room(cache_dir, size, capacity):
+            raise Exception(f"{image} doesn't fit in {cache_dir}.")
+        partial = os.path.join(cache_dir, os.path.basename(image) + PARTIAL_SUFFIX)
+        start = time.time()
+        try:
+            digest = copy_with_digest(image, partial)
+            if expected and digest != expected:
+                raise Exception(f"The sha256 of {image} is {digest}, not {expected}.")
+            cached = os.path.join(cache_dir, cached_name(image, digest))
+            os.replace(partial, cached)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        stat = os.stat(image)
+        index[os.path.abspath(image)] = [stat.st_size, stat.st_mtime_ns, digest]
+        write_index(cache_dir, index)
+        print(f"container_cache: copied {image} to {cached} in {time.time() - start:.0f}s", file=sys.stderr)
+        return cached
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Print the path of a node-local copy of a container image.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fetch_parser = subparsers.add_parser("fetch", help="Copy the image to the cache if needed.")
+    fetch_parser.add_argument("image")
+    fetch_parser.add_argument("--cache-dir", required=True)
+    fetch_parser.add_argument("--capacity-gbs", type=float, default=CAPACITY_GBS)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    try:
+        path = fetch(args.image, args.cache_dir, int(args.capacity_gbs * 2 ** 30))
+    except Exception as e:
+        print(f"container_cache: using {args.image}: {e}", file=sys.stderr)
+        path = args.image
+    print(path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
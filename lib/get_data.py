@@ -7,7 +7,13 @@ import typing
 from pathlib import Path
 
 
-def link_directory(source, destination, show_log=True):
+def link_directory(source, destination, show_log=True, limiter=None):
+    """
+    Link the files of `source` from the same tree of directories in `destination`.
+
+    The stats, links and directories made count against `limiter`, see metadata_limiter.py.
+    """
+    consume = limiter.consume if limiter else lambda operations=1: None
     if not source.is_dir():
         raise OSError(f"ERROR: {source} is not a valid directory.")
     if destination.exists():
@@ -21,14 +27,18 @@ def link_directory(source, destination, show_log=True):
     def recursively_link_files(source_dir, destination_dir):
         source_dir = source_dir.resolve().absolute()
         visited.add(str(source_dir))
+        consume()
         for source in source_dir.iterdir():
             destination = destination_dir / source.name
+            consume()
             if source.is_file():
+                consume()
                 if not destination.exists():
                     if show_log:
                         print(
                             f"linking: {destination.absolute()} --> {source.absolute()}"
                         )
+                    consume()
                     destination.symlink_to(source.absolute())
                 else:
                     if show_log:
@@ -42,7 +52,9 @@ def link_directory(source, destination, show_log=True):
                         continue
                 if show_log:
                     print("dirname: " + str(destination.absolute()))
+                consume()
                 if not destination.exists():
+                    consume()
                     destination.mkdir()
                 recursively_link_files(source, destination)
 
@@ -60,11 +72,16 @@ class PipelineResources:
         session,
         log,
         output_dir,
+        limiter=None,
+        staging=None,
     ):
         self.SESSION = session
         self.RESOURCES_ROOT = RESOURCES_ROOT
         self.output_dir = Path(output_dir)
         self.show_log = log
+        self.limiter = limiter
+        # the inputs shared by the per-scan jobs of the session, see shared_staging.py
+        self.staging = staging
 
     def list_resources(self, glob_pattern:str, str_contains_pattern:typing.Optional[str]=None)->typing.List[Path]:
         """
@@ -105,7 +122,7 @@ class PipelineResources:
             basename_with_no_suffix = source.name[:-7]
 
             destination = unprocessed_dir / basename_with_no_suffix
-            link_directory(source, destination, self.show_log)
+            link_directory(source, destination, self.show_log, self.limiter)
 
     def mirror_folders_in_output(self, glob_pattern:str, contains_pattern:typing.Optional[str]=None)->None:
         """
@@ -117,7 +134,30 @@ class PipelineResources:
         """
         destination = self.output_dir
         for source in self.list_resources(glob_pattern, contains_pattern):
-            link_directory(source, destination, self.show_log)
+            link_directory(source, destination, self.show_log, self.limiter)
+
+    def mirror_shared_folders_in_output(self, glob_pattern:str)->None:
+        """
+        Same as mirror_folders_in_output, for the resources that are the same for every scan of the session.
+
+        With a staging, they are linked once for the session and the links are copied to the output directory.
+
+        Args:
+            glob_pattern: glob pattern to match
+        """
+        if self.staging is None:
+            self.mirror_folders_in_output(glob_pattern)
+            return
+
+        sources = self.list_resources(glob_pattern)
+
+        def populate(directory):
+            for source in sources:
+                link_directory(source, Path(directory), self.show_log, self.limiter)
+
+        name = glob_pattern.replace("/", "_").replace("*", "_")
+        consume = self.limiter.consume if self.limiter else None
+        self.staging.overlay(name, populate, str(self.output_dir), consume, sources)
 
     # get unprocessed data
     def get_structural_unproc_data(self):
@@ -135,13 +175,13 @@ class PipelineResources:
     # get preprocessed data
 
     def get_structural_preproc_data(self):
-        self.mirror_folders_in_output("Structural_preproc")
+        self.mirror_shared_folders_in_output("Structural_preproc")
 
     def get_icafix_data(self):
         self.mirror_folders_in_output("MultiRunIcaFix_proc")
 
     def get_supplemental_structural_preproc_data(self):
-        self.mirror_folders_in_output("Structural_preproc/supplemental")
+        self.mirror_shared_folders_in_output("Structural_preproc/supplemental")
 
     def get_hand_edit_data(self):
         self.mirror_folders_in_output("Structural_Hand_Edit")
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+metadata_limiter.py: Share a budget of metadata operations per second between the jobs, see METADATA_OPS_PER_SECOND.
+
+The get and clean steps stat, link and create millions of files on CephFS.
+Started together by a batch, they all queue on the same MDS. Each job
+registers in METADATA_BUDGET_FILE, under BUILD_MOUNT_ROOT, and gets an equal
+share of METADATA_OPS_PER_SECOND, renewed every few seconds as jobs come and
+go. `link_directory` (get_data.py) and `VirtualFileSystem` (virtual_fs.py)
+count their operations against it.
+
+Jobs also wait a random time, up to START_JITTER_SECONDS, before they start,
+so that the jobs of a batch don't all start scanning the archive at once.
+
+    metadata_limiter.py status METADATA_BUDGET_FILE
+"""
+import argparse
+import atexit
+import fcntl
+import json
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+from scratch_stage import Throttle
+
+# seconds between updates of the share of a job
+REFRESH_SECONDS = 10
+# jobs that didn't update their share for this long are gone
+STALE_SECONDS = 60
+
+
+def stagger(max_seconds):
+    """
+    Sleep for a random time up to `max_seconds`.
+    """
+    if max_seconds:
+        seconds = random.uniform(0, float(max_seconds))
+        print(f"Waiting {seconds:.0f}s before starting.")
+        time.sleep(seconds)
+
+
+def update_jobs(budget_file, job, now, leaving=False):
+    """
+    Register `job` in `budget_file` (or remove it) and forget the stale jobs.
+
+    Returns:
+        the jobs registered: job -> time of its last update
+    """
+    fd = os.open(budget_file, os.O_RDWR | os.O_CREAT, 0o666)
+    with open(fd, "r+") as budget:
+        fcntl.flock(budget, fcntl.LOCK_EX)
+        try:
+            jobs = json.loads(budget.read() or "{}")
+        except ValueError:
+            jobs = {}
+        jobs = {name: seen for name, seen in jobs.items() if now - seen < STALE_SECONDS}
+        if leaving:
+            jobs.pop(job, None)
+        else:
+            jobs[job] = now
+        budget.seek(0)
+        budget.truncate()
+        budget.write(json.dumps(jobs))
+    return jobs
+
+
+class MetadataLimiter:
+    """
+    At most `rate` metadata operations per second, across the jobs sharing `budget_file`.
+    """
+
+    def __init__(self, rate, budget_file=None, job=None):
+        self.rate = float(rate)
+        self.budget_file = budget_file
+        self.job = job or f"{socket.gethostname()}:{os.getpid()}"
+        self.throttle = Throttle(self.rate)
+        self.refreshed = 0
+        self.lock = threading.Lock()
+        if self.rate and self.budget_file:
+            self.refresh(time.time())
+            atexit.register(self.close)
+
+    def refresh(self, now):
+        try:
+            jobs = len(update_jobs(self.budget_file, self.job, now))
+        except OSError as e:
+            print(f"Can't share the metadata budget through {self.budget_file}: {e}")
+            jobs = 1
+            self.budget_file = None
+        with self.throttle.lock:
+            self.throttle.rate = self.throttle.burst = self.rate / jobs
+        self.refreshed = now
+
+    def consume(self, operations=1):
+        if not self.rate:
+            return
+        if self.budget_file:
+            now = time.time()
+            with self.lock:
+                if now - self.refreshed > REFRESH_SECONDS:
+                    self.refresh(now)
+        self.throttle.consume(operations)
+
+    def close(self):
+        if self.rate and self.budget_file:
+            try:
+                update_jobs(self.budget_file, self.job, time.time(), leaving=True)
+            except OSError:
+                pass
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Show the jobs sharing the metadata budget.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    status_parser = subparsers.add_parser("status")
+    status_parser.add_argument("budget_file")
+    status_parser.add_argument("--rate", type=float, help="METADATA_OPS_PER_SECOND")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    with open(args.budget_file) as fd:
+        jobs = json.loads(fd.read() or "{}")
+    now = time.time()
+    active = sorted(name for name, seen in jobs.items() if now - seen < STALE_SECONDS)
+    print(f"{len(active)} jobs sharing the budget")
+    if args.rate and active:
+        print(f"{args.rate / len(active):.0f} operations per second each")
+    for name in active:
+        print(name)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+profiling.py: Profile the python steps of a job, when PROFILE_JOBS is set.
+
+shared_values.py starts the profiler in the get, clean, put and check steps.
+When the step exits, two files are written next to its log in CHECK_DATA_DIR,
+which ends up in ProcessingInfo:
+
+* `<script>.prof`: the cProfile stats, e.g. for `python -m pstats` or snakeviz
+* `<script>.profile.txt`: the top functions by cumulative time, the top
+  allocation sites of tracemalloc, and the wall clock spans of the filesystem,
+  subprocess and HTTP calls
+
+The profiles of get and clean are copied by the put step, the one of put is
+uploaded by the check step. The one of the check step stays in CHECK_DATA_DIR
+when the check fails, which is when it is wanted.
+
+    python lib/profiling.py CHECK_DATA_DIR/<script>.prof [--top 30]
+"""
+import argparse
+import atexit
+import cProfile
+import functools
+import http.client
+import io
+import os
+import pstats
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+TOP = 30
+# frames kept for each allocation, more makes tracemalloc slower
+TRACEMALLOC_FRAMES = 5
+# (category, object, attribute) of the calls timed as spans
+SPANS = (
+    ("filesystem", shutil, "copyfile"),
+    ("filesystem", shutil, "copytree"),
+    ("filesystem", shutil, "rmtree"),
+    ("filesystem", shutil, "move"),
+    ("filesystem", os, "listdir"),
+    ("subprocess", os, "system"),
+    ("subprocess", subprocess.Popen, "communicate"),
+    ("subprocess", subprocess.Popen, "wait"),
+    # requests sends through urllib3, which sends through http.client
+    ("http", http.client.HTTPConnection, "send"),
+    ("http", http.client.HTTPConnection, "getresponse"),
+)
+
+
+class Spans:
+    """
+    Wall clock time of the calls in SPANS. Calls made inside another span, e.g. shutil.copytree calling
+    shutil.copyfile, are part of the outer one only.
+    """
+
+    def __init__(self):
+        self.totals = {}
+        self.originals = []
+        self.local = threading.local()
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            if getattr(self.local, "inside", False):
+                return fn(*args, **kwargs)
+            self.local.inside = True
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.local.inside = False
+                calls, total, longest = self.totals.get(name, (0, 0, 0))
+                self.totals[name] = (calls + 1, total + elapsed, max(longest, elapsed))
+
+        return timed
+
+    def install(self, spans=SPANS):
+        for category, owner, attribute in spans:
+            original = getattr(owner, attribute)
+            self.originals.append((owner, attribute, original))
+            name = f"{category}: {getattr(owner, '__name__', owner)}.{attribute}"
+            setattr(owner, attribute, self.wrap(name, original))
+
+    def uninstall(self):
+        for owner, attribute, original in reversed(self.originals):
+            setattr(owner, attribute, original)
+        self.originals = []
+
+    def report(self):
+        lines = [f"{'calls':>8} {'total s':>10} {'max s':>10}  span"]
+        for name, (calls, total, longest) in sorted(self.totals.items(), key=lambda x: -x[1][1]):
+            lines.append(f"{calls:>8} {total:>10.3f} {longest:>10.3f}  {name}")
+        return "\n".join(lines)
+
+
+class Profiler:
+    def __init__(self, output_dir, name, top=TOP):
+        """
+        Args:
+            output_dir: where `<name>.prof` and `<name>.profile.txt` are written
+        """
+        self.prof_path = os.path.join(output_dir, f"{name}.prof")
+        self.summary_path = os.path.join(output_dir, f"{name}.profile.txt")
+        self.top = top
+        self.profile = cProfile.Profile()
+        self.spans = Spans()
+        self.start_time = None
+
+    def start(self):
+        self.spans.install()
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self.start_time = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        elapsed = time.perf_counter() - self.start_time
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.spans.uninstall()
+
+        # like the telemetry, nothing is written once the step removed its directory
+        if not os.path.isdir(os.path.dirname(self.prof_path)):
+            return
+        self.profile.dump_stats(self.prof_path)
+        stats = io.StringIO()
+        pstats.Stats(self.profile, stream=stats).sort_stats("cumulative").print_stats(self.top)
+        allocations = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ]).statistics("lineno")[:self.top]
+        with open(self.summary_path, "w") as fd:
+            fd.write(f"{' '.join(sys.argv)}\n")
+            fd.write(f"wall time: {elapsed:.3f} s, python heap: peak {peak / 2 ** 20:.1f} MB, "
+                     f"at exit {current / 2 ** 20:.1f} MB\n\n")
+            fd.write(f"# spans\n{self.spans.report()}\n\n")
+            fd.write(f"# top {self.top} allocation sites\n")
+            fd.write("".join(f"{stat}\n" for stat in allocations))
+            fd.write(f"\n# top {self.top} functions by cumulative time\n{stats.getvalue()}")
+
+
+def profile_at_exit(output_dir, name, top=TOP):
+    """
+    Profile the current python step until it exits.
+    """
+    profiler = Profiler(output_dir, name, top)
+    profiler.start()
+    atexit.register(profiler.stop)
+    return profiler
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Print the top functions of a profile written by a job.")
+    parser.add_argument("prof", help="<script>.prof file")
+    parser.add_argument("--top", type=int, default=TOP)
+    parser.add_argument("--sort", default="cumulative", help="e.g. cumulative, tottime or ncalls")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    pstats.Stats(args.prof).sort_stats(args.sort).print_stats(args.top)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
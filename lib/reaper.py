@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+reaper.py: Remove the directories of finished jobs in the background, see TRASH_DIR.
+
+Removing a study folder from Ceph unlinks up to millions of files, one
+metadata operation each. Rather than doing it while holding their allocation,
+jobs `discard` their directories: an atomic rename into TRASH_DIR, on the same
+file system. The reaper, one per user, removes what is in TRASH_DIR with
+parallel workers, at most --rate unlinks per second so that it doesn't starve
+the jobs running on Ceph. Each removed tree is logged, with its file count and
+bytes, to `reaped.jsonl` in TRASH_DIR.
+
+slurm_array.py and slurm_pack.py queue one `run --once` job per TRASH_DIR after
+all the jobs of a manifest (`afterany`). submit_jobs queues one after the jobs
+of a session submitted on its own, unless a reaper is already pending. A reaper
+that finds another one at work exits right away, so they don't pile up on the
+same TRASH_DIR.
+
+    reaper.py run TRASH_DIR [--workers 16] [--rate 2000] [--interval 60] [--once] &
+    reaper.py submit TRASH_DIR [--dependency afterany:123] [--log-dir LOG_DIR] [--dry-run]
+    reaper.py status TRASH_DIR
+"""
+import argparse
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+from scratch_stage import Throttle
+
+WORKERS = 16
+# unlinks per second
+RATE = 2000
+INTERVAL_SECONDS = 60
+LOCK_FILE = ".reaper.lock"
+LOG_FILE = "reaped.jsonl"
+# the reaper's own job, when queued by `submit`
+JOB_OPTIONS = ("--account=hcp", "--partition=tier2_cpu", "--nodes=1", "--ntasks-per-node=4", "--mem=4000",
+               "--time=24:00:00")
+
+
+def discard(path, trash_dir):
+    """
+    Move `path` to `trash_dir`, for the reaper to remove. Removes it now if it can't be moved there.
+
+    Returns:
+        where it was moved, or None
+    """
+    if not os.path.lexists(path):
+        return None
+    os.makedirs(trash_dir, exist_ok=True)
+    name = f"{os.path.basename(os.path.normpath(path))}.{datetime.now():%Y%m%d%H%M%S}.{os.getpid()}"
+    destination = os.path.join(trash_dir, name)
+    try:
+        os.rename(path, destination)
+    except OSError as e:
+        # e.g. on another file system than TRASH_DIR
+        print(f"Can't move {path} to {trash_dir}, removing it: {e}")
+        remove_tree(path)
+        return None
+    return destination
+
+
+class Tally:
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def add(self, files, size):
+        with self.lock:
+            self.files += files
+            self.bytes += size
+
+
+def clear_directory(directory, throttle, tally):
+    """
+    Unlink the files and links of `directory`.
+
+    Returns:
+        its subdirectories
+    """
+    subdirs, files, size = [], 0, 0
+    try:
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+    except FileNotFoundError:
+        return []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            subdirs.append(entry.path)
+            continue
+        try:
+            size += entry.stat(follow_symlinks=False).st_size
+            throttle.consume(1)
+            os.unlink(entry.path)
+            files += 1
+        except FileNotFoundError:
+            pass
+    tally.add(files, size)
+    return subdirs
+
+
+def remove_tree(path, workers=WORKERS, throttle=None):
+    """
+    Remove `path` and everything under it, the directories being scanned and emptied in parallel.
+
+    Returns:
+        (number of files, bytes) removed
+    """
+    throttle = throttle or Throttle(0)
+    tally = Tally()
+    if os.path.islink(path) or os.path.isfile(path):
+        tally.add(1, os.lstat(path).st_size)
+        os.unlink(path)
+        return tally.files, tally.bytes
+    directories = [path]
+    with ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(clear_directory, path, throttle, tally)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for subdir in future.result():
+                    directories.append(subdir)
+                    pending.add(pool.submit(clear_directory, subdir, throttle, tally))
+    # the deepest first, they are empty by now
+    for directory in sorted(directories, key=lambda d: d.count(os.sep), reverse=True):
+        throttle.consume(1)
+        try:
+            os.rmdir(directory)
+        except FileNotFoundError:
+            pass
+    return tally.files, tally.bytes
+
+
+def reap(trash_dir, workers=WORKERS, throttle=None):
+    """
+    Remove everything in `trash_dir`, oldest first.
+
+    Returns:
+        (number of trees, files, bytes) removed
+    """
+    trees = total_files = total_bytes = 0
+    entries = [
+        entry for entry in os.scandir(trash_dir)
+        if entry.name not in (LOCK_FILE, LOG_FILE)
+    ]
+    for entry in sorted(entries, key=lambda entry: entry.stat(follow_symlinks=False).st_mtime):
+        start = time.time()
+        files, size = remove_tree(entry.path, workers, throttle)
+        seconds = time.time() - start
+        with open(os.path.join(trash_dir, LOG_FILE), "a") as fd:
+            record = dict(time=datetime.now().isoformat(timespec="seconds"), name=entry.name,
+                          files=files, bytes=size, seconds=round(seconds, 1))
+            fd.write(json.dumps(record) + "\n")
+        print(f"reaper: removed {entry.name}, {files} files, {size / 2 ** 30:.1f} GB in {seconds:.0f}s")
+        trees, total_files, total_bytes = trees + 1, total_files + files, total_bytes + size
+    return trees, total_files, total_bytes
+
+
+def submit(trash_dir, dependency=None, log_dir=None, dry_run=False):
+    """
+    Queue a job that empties `trash_dir` once, e.g. after `dependency` = `afterany:<job id>`.
+
+    Returns:
+        its job id
+    """
+    log_dir = log_dir or os.path.dirname(os.path.normpath(trash_dir))
+    cmd = ["sbatch", "--parsable", "--job-name=reaper", *JOB_OPTIONS, f"--output={log_dir}/reaper.%j.stdout"]
+    if dependency:
+        cmd.append(f"--dependency={dependency}")
+    cmd.append(f"--wrap={sys.executable} {os.path.abspath(__file__)} run --once {trash_dir}")
+    print(">> ", " ".join(cmd))
+    if dry_run:
+        return "<reaper>"
+    # --parsable prints `<job_id>[;<cluster>]`
+    return subprocess.check_output(cmd).decode().strip().split(";")[0]
+
+
+def submit_after(trash_dirs, job_ids, dry_run=False):
+    """
+    Queue one reaper per TRASH_DIR, once all of `job_ids` are done. The jobs are already submitted:
+    a reaper that can't be queued is reported, the next one or the user's reaper empties TRASH_DIR.
+    """
+    dependency = "afterany:" + ":".join(job_ids)
+    for trash_dir in sorted(set(trash_dirs)):
+        try:
+            submit(trash_dir, dependency, dry_run=dry_run)
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"WARNING: Unable to queue a reaper for {trash_dir}: {e}")
+
+
+def read_log(trash_dir):
+    try:
+        with open(os.path.join(trash_dir, LOG_FILE)) as fd:
+            return [json.loads(line) for line in fd if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Remove the directories discarded by the jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Empty TRASH_DIR every --interval seconds.")
+    run_parser.add_argument("trash_dir")
+    run_parser.add_argument("--workers", type=int, default=WORKERS)
+    run_parser.add_argument("--rate", type=float, default=RATE, help="Unlinks per second, 0 for no limit.")
+    run_parser.add_argument("--interval", type=int, default=INTERVAL_SECONDS)
+    run_parser.add_argument("--once", action="store_true", help="Empty TRASH_DIR once and exit.")
+    submit_parser = subparsers.add_parser("submit", help="Queue a job that empties TRASH_DIR once.")
+    submit_parser.add_argument("trash_dir")
+    submit_parser.add_argument("--dependency", help="e.g. afterany:<job id>")
+    submit_parser.add_argument("--log-dir", help="Where the job's stdout goes, next to TRASH_DIR by default.")
+    submit_parser.add_argument("--dry-run", "-n", action="store_true", help="Print the sbatch command only.")
+    status_parser = subparsers.add_parser("status", help="What is waiting and what was reclaimed.")
+    status_parser.add_argument("trash_dir")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    if args.command == "status":
+        waiting = [name for name in os.listdir(args.trash_dir) if name not in (LOCK_FILE, LOG_FILE)]
+        log = read_log(args.trash_dir)
+        print(f"waiting: {len(waiting)} directories")
+        print(f"reclaimed: {len(log)} directories, {sum(r['files'] for r in log)} files, "
+              f"{sum(r['bytes'] for r in log) / 2 ** 30:.1f} GB in {sum(r['seconds'] for r in log) / 3600:.1f} hours")
+        return 0
+    if args.command == "submit":
+        print(f"Reaper job: {submit(args.trash_dir, args.dependency, args.log_dir, args.dry_run)}")
+        return 0
+
+    os.makedirs(args.trash_dir, exist_ok=True)
+    lock = open(os.path.join(args.trash_dir, LOCK_FILE), "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print(f"Another reaper is emptying {args.trash_dir}.")
+        # a queued reaper has nothing left to do
+        return 0 if args.once else 1
+    throttle = Throttle(args.rate)
+    while True:
+        reap(args.trash_dir, args.workers, throttle)
+        if args.once:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+resource_prediction.py: Predict the memory and walltime of a process job from the telemetry of past jobs.
+
+The process step of every job appends its telemetry (see telemetry.py) to
+TELEMETRY_HISTORY_FILE, labelled with its project, pipeline, number of BOLDs and
+input size. A new job is sized from the successful runs of the same pipeline:
+
+* of the same project when it has enough of them, of all projects otherwise
+* the nearest ones in number of BOLDs and input size
+* the RESOURCE_QUANTILE of their peak memory and wall time, plus RESOURCE_MARGIN
+
+The memory of a run is the peak memory of its whole job (`job_mem_kb`), or the
+peak RSS of its largest process for the records that don't have it. The runs
+that failed, e.g. killed for exceeding their memory limit, needed more than they
+got to use: the memory predicted is at least the peak of those as near to the new
+job as the runs it is sized from, plus RESOURCE_MARGIN. Likewise, the runs that
+timed out (`timed_out`, see telemetry.py) needed more time than they had: the
+walltime predicted is at least theirs, plus RESOURCE_MARGIN.
+
+With too few runs, the YAML defaults are used.
+
+The run_all job is sized the same way from whole runs: the process record of
+each run, with the wall time of all the steps of the run (same session and
+TIMESTAMP) added up.
+
+The same runs give the ratio of bytes written to input size, from which
+`check_capacity` estimates the disk space of a run (see capacity.py).
+
+    resource_prediction.py [--project CCF_HCA_STG] [--bolds 4] [--input-gbs 20] TELEMETRY_HISTORY_FILE PIPELINE
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+QUANTILE = 0.95
+MARGIN = 0.2
+MIN_SAMPLES = 10
+NEIGHBOURS = 30
+
+_history_cache = {}
+
+
+def read_history(history_file):
+    """
+    Returns:
+        the records of `history_file` and of the previous one, moved to `<history_file>.1` when it grew too large
+        (see telemetry.append_history), only read again when they change
+    """
+    paths = [f"{history_file}.1", str(history_file)]
+    key = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            key.append((stat.st_ino, stat.st_mtime, stat.st_size))
+        except OSError:
+            key.append(None)
+    key = tuple(key)
+    cached = _history_cache.get(str(history_file))
+    if cached and cached[0] == key:
+        return cached[1]
+    records = []
+    for path, path_key in zip(paths, key):
+        if path_key is None:
+            continue
+        with open(path) as fd:
+            for line in fd:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    _history_cache[str(history_file)] = (key, records)
+    return records
+
+
+def job_memory_gbs(record):
+    """
+    The peak memory of the job of a record, or of its largest process for records without it.
+    """
+    kb = record.get("job_mem_kb")
+    if kb is None:
+        kb = record["max_rss_kb"]
+    return kb / 2 ** 20
+
+
+def predictor(record, name):
+    try:
+        return float(record[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def quantile(values, q):
+    """
+    Linear interpolation between the closest ranks.
+    """
+    values = sorted(values)
+    position = (len(values) - 1) * q
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def distance_to(records, predictors):
+    """
+    Returns:
+        the distance of a record to `predictors`, each predictor scaled by its range in `records`.
+        Predictors that are unknown for the new job or a record are left out of the distance.
+    """
+    scales = {}
+    for name, value in predictors.items():
+        known = [x for x in (predictor(r, name) for r in records) if x is not None]
+        if value is not None and known:
+            scales[name] = (max(known) - min(known)) or 1
+
+    def distance(record):
+        total = 0
+        for name, scale in scales.items():
+            x = predictor(record, name)
+            total += 1 if x is None else abs(x - predictors[name]) / scale
+        return total
+
+    return distance
+
+
+def predict(history, pipeline, project, predictors, q=QUANTILE, margin=MARGIN, min_samples=MIN_SAMPLES,
+            neighbours=NEIGHBOURS):
+    """
+    Returns:
+        (memory in GB, walltime in hours, number of runs it is based on), or None with fewer than `min_samples` runs
+    """
+    processed = [r for r in history if r.get("pipeline") == pipeline and r.get("step") == "process"]
+    runs = [r for r in processed if r.get("returncode") == 0]
+    failed = [r for r in processed if r.get("returncode") not in (0, None)]
+    same_project = [r for r in runs if r.get("project") == project]
+    if len(same_project) >= min_samples:
+        runs = same_project
+        failed = [r for r in failed if r.get("project") == project]
+    if len(runs) < min_samples:
+        return None
+    distance = distance_to(runs, predictors)
+    runs = sorted(runs, key=distance)[:max(neighbours, min_samples)]
+    mem_gbs = quantile([job_memory_gbs(r) for r in runs], q)
+    # the runs that failed, as near as the runs it is sized from, needed at least what they used
+    failed = [r for r in failed if distance(r) <= distance(runs[-1])]
+    mem_gbs = max([mem_gbs] + [job_memory_gbs(r) for r in failed]) * (1 + margin)
+    hours = quantile([r["wall_seconds"] / 3600 for r in runs], q)
+    hours = max([hours] + [r["wall_seconds"] / 3600 for r in failed if r.get("timed_out")]) * (1 + margin)
+    return max(1, math.ceil(mem_gbs)), max(1, math.ceil(hours)), len(runs)
+
+
+def run_totals(history, pipeline):
+    """
+    The runs of `pipeline` that went through the check step, as their process record with the wall time of all
+    their steps. A step that ran more than once, e.g. resubmitted, counts once.
+    """
+    runs = {}
+    for record in history:
+        if record.get("pipeline") == pipeline and record.get("timestamp"):
+            key = (record.get("session"), record.get("scan"), record["timestamp"])
+            runs.setdefault(key, {})[record.get("step")] = record
+    totals = []
+    for steps in runs.values():
+        if "process" in steps and "check" in steps:
+            totals.append(dict(steps["process"], wall_seconds=sum(r["wall_seconds"] for r in steps.values())))
+    return totals
+
+
+def output_ratio(history, pipeline, q=QUANTILE, default=None, min_samples=MIN_SAMPLES):
+    """
+    The `q` quantile of the bytes written per byte of input by the successful runs of `pipeline`,
+    or `default` with fewer than `min_samples` of them.
+    """
+    ratios = []
+    for record in history:
+        if record.get("pipeline") != pipeline or record.get("step") != "process" or record.get("returncode") != 0:
+            continue
+        input_gbs = predictor(record, "input_gbs")
+        if input_gbs:
+            ratios.append(record["write_bytes"] / 2 ** 30 / input_gbs)
+    if len(ratios) < min_samples:
+        return default
+    return quantile(ratios, q)
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Predict the memory and walltime of a process job.")
+    parser.add_argument("history_file", help="TELEMETRY_HISTORY_FILE")
+    parser.add_argument("pipeline")
+    parser.add_argument("--project")
+    parser.add_argument("--bolds", type=float)
+    parser.add_argument("--input-gbs", type=float)
+    parser.add_argument("--quantile", type=float, default=QUANTILE)
+    parser.add_argument("--margin", type=float, default=MARGIN)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    predictors = dict(bolds=args.bolds, input_gbs=args.input_gbs)
+    history = read_history(args.history_file)
+    prediction = predict(history, args.pipeline, args.project, predictors, args.quantile, args.margin)
+    if prediction is None:
+        print(f"Fewer than {MIN_SAMPLES} successful runs of {args.pipeline}.")
+        return 1
+    print("memory: {} GB, walltime: {} hours, from {} runs".format(*prediction))
+    whole_runs = predict(run_totals(history, args.pipeline), args.pipeline, args.project, predictors, args.quantile,
+                         args.margin)
+    if whole_runs is not None:
+        print("run_all walltime: {1} hours, from {2} runs".format(*whole_runs))
+    ratio = output_ratio(history, args.pipeline, args.quantile)
+    if ratio is not None:
+        print(f"bytes written per byte of input: {ratio:.2f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+running_registry.py: Index of running status markers and the slurm jobs behind them.
+
+Running status markers live in the archive, at
+`<ARCHIVE_ROOT>/<PROJECT>/arc001/<SESSION>/RESOURCES/RunningStatus/<PIPELINE>.<SESSION><_SCAN>.RUNNING`.
+Jobs are recorded by submit_jobs in JOB_RECORDS_FILE. Both are indexed into a
+SQLite database, so that "what is in flight for project X / pipeline Y" is a
+single query. Refreshing only rescans sessions whose RunningStatus directory
+changed since the previous refresh.
+
+The jobs of a marker are those recorded for its pipeline and session that were
+submitted after the marker was set (give or take MARKER_SKEW_SECONDS): jobs of an
+earlier submission say nothing about a marker set again since. A marker is stale
+when it has such jobs and none of them is known to slurm anymore, e.g., the job
+was cancelled before the marker could be removed. Markers without any, e.g. set
+by another operator or from another JOB_RECORDS_FILE, are reported as unknown and
+never removed.
+
+    running_registry.py --db registry.sqlite --job-records submitted_jobs.jsonl \\
+        list --project CCF_HCA_STG --pipeline MsmAllProcessing
+    running_registry.py --db registry.sqlite stale --remove \\
+        --serverlist "http://shadow1:8080 ..." --credentials-file ~/.xnat_credentials
+"""
+import argparse
+import getpass
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import time
+
+MARKER_SUFFIX = ".RUNNING"
+# markers younger than this are never stale, the job may still be in the middle of submission
+STALE_GRACE_SECONDS = 3600
+# jobs submitted up to this long before their marker was set are its jobs: the clocks of the archive and of the
+# submit host may differ
+MARKER_SKEW_SECONDS = 300
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS markers (
+    project TEXT, session TEXT, pipeline TEXT, scan TEXT, marker TEXT, mtime REAL,
+    PRIMARY KEY (project, session, marker)
+);
+CREATE INDEX IF NOT EXISTS markers_pipeline ON markers (pipeline, project);
+CREATE TABLE IF NOT EXISTS scanned (
+    project TEXT, session TEXT, mtime REAL,
+    PRIMARY KEY (project, session)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY, project TEXT, session TEXT, pipeline TEXT, scan TEXT,
+    step TEXT, submitted INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (project, session, pipeline, scan);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+
+def parse_marker(marker, session):
+    """
+    Split `<PIPELINE>.<SESSION><_SCAN>.RUNNING` into (pipeline, scan).
+    """
+    pipeline, _, rest = marker[: -len(MARKER_SUFFIX)].partition(".")
+    if not rest.startswith(session):
+        return None
+    return pipeline, rest[len(session) + 1:]
+
+
+def expand_job_id(job_id):
+    """
+    Pending array tasks are listed together, e.g., `123_[0-3,7%2]`. List them individually.
+    """
+    if not job_id.endswith("]") or "_[" not in job_id:
+        return [job_id]
+    array_job_id, _, ranges = job_id[:-1].partition("_[")
+    task_ids = []
+    for item in ranges.split("%")[0].split(","):
+        first, _, last = item.partition("-")
+        task_ids.extend(range(int(first), int(last or first) + 1))
+    return [f"{array_job_id}_{i}" for i in task_ids]
+
+
+def slurm_job_states(user=None):
+    """
+    {job_id: state} of the jobs slurm knows about. Array tasks (`<array job id>_<index>`)
+    are also reported under their array job id.
+    """
+    if user is None:
+        user = getpass.getuser()
+    output = subprocess.check_output(["squeue", "--noheader", "--user", user, "--format", "%F %i %T"]).decode()
+    states = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        array_job_id, job_id, state = line.split()
+        for task_id in expand_job_id(job_id):
+            states[task_id] = state
+        states.setdefault(array_job_id, state)
+    return states
+
+
+class RunningRegistry:
+    def __init__(self, db_path):
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def refresh_markers(self, archive_root, projects):
+        """
+        Rescan the RunningStatus resources that changed since the last refresh.
+
+        Returns:
+            number of sessions rescanned
+        """
+        rescanned = 0
+        for project in projects:
+            known = {
+                row["session"]: row["mtime"]
+                for row in self.db.execute("SELECT session, mtime FROM scanned WHERE project = ?", (project,))
+            }
+            project_dir = os.path.join(archive_root, project, "arc001")
+            seen = set()
+            with os.scandir(project_dir) as sessions:
+                for entry in sessions:
+                    session = entry.name
+                    status_dir = os.path.join(entry.path, "RESOURCES", "RunningStatus")
+                    try:
+                        mtime = os.stat(status_dir).st_mtime
+                    except OSError:
+                        continue
+                    seen.add(session)
+                    if known.get(session) == mtime:
+                        continue
+                    self._index_session(project, session, status_dir, mtime)
+                    rescanned += 1
+
+            # sessions whose RunningStatus resource disappeared have no markers left
+            for session in set(known) - seen:
+                self.db.execute("DELETE FROM markers WHERE project = ? AND session = ?", (project, session))
+                self.db.execute("DELETE FROM scanned WHERE project = ? AND session = ?", (project, session))
+        self.db.commit()
+        return rescanned
+
+    def _index_session(self, project, session, status_dir, mtime):
+        self.db.execute("DELETE FROM markers WHERE project = ? AND session = ?", (project, session))
+        for entry in os.scandir(status_dir):
+            if not entry.name.endswith(MARKER_SUFFIX):
+                continue
+            parsed = parse_marker(entry.name, session)
+            if parsed is None:
+                continue
+            pipeline, scan = parsed
+            self.db.execute(
+                "INSERT OR REPLACE INTO markers VALUES (?, ?, ?, ?, ?, ?)",
+                (project, session, pipeline, scan, entry.name, entry.stat().st_mtime),
+            )
+        self.db.execute("INSERT OR REPLACE INTO scanned VALUES (?, ?, ?)", (project, session, mtime))
+
+    def refresh_jobs(self, job_records_file):
+        """
+        Index the job records appended since the last refresh.
+
+        Returns:
+            number of new records
+        """
+        if not os.path.exists(job_records_file):
+            return 0
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'job_records_offset'").fetchone()
+        offset = int(row["value"]) if row else 0
+        if offset > os.path.getsize(job_records_file):
+            # the file was truncated or replaced
+            offset = 0
+
+        count = 0
+        with open(job_records_file) as fd:
+            fd.seek(offset)
+            for line in iter(fd.readline, ""):
+                if not line.endswith("\n"):
+                    # partially written record, pick it up next time
+                    break
+                offset = fd.tell()
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self.db.execute(
+                    "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        str(record["job_id"]),
+                        record["project"],
+                        record["session"],
+                        record["pipeline"],
+                        record.get("scan", ""),
+                        record.get("step", ""),
+                        record.get("submitted", 0),
+                    ),
+                )
+                count += 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('job_records_offset', ?)", (str(offset),))
+        self.db.commit()
+        return count
+
+    def in_flight(self, project=None, pipeline=None, job_states=None, skew=MARKER_SKEW_SECONDS):
+        """
+        All markers, optionally for one project and/or pipeline, with the state of their jobs.
+
+        Args:
+            job_states: {job_id: state} as returned by `slurm_job_states`. If None, jobs have no state.
+            skew: the jobs of a marker were submitted at most this many seconds before it was set
+
+        Returns:
+            list of dicts with the marker and `jobs`, a list of (job_id, step, state)
+        """
+        query = "SELECT * FROM markers WHERE 1 = 1"
+        params = []
+        if project:
+            query += " AND project = ?"
+            params.append(project)
+        if pipeline:
+            query += " AND pipeline = ?"
+            params.append(pipeline)
+        query += " ORDER BY project, pipeline, session, scan"
+
+        results = []
+        for row in self.db.execute(query, params).fetchall():
+            jobs = self.db.execute(
+                "SELECT job_id, step FROM jobs WHERE project = ? AND session = ? AND pipeline = ? AND scan = ?"
+                " AND submitted >= ? ORDER BY submitted",
+                (row["project"], row["session"], row["pipeline"], row["scan"], row["mtime"] - skew),
+            ).fetchall()
+            result = dict(row)
+            result["jobs"] = [
+                (job["job_id"], job["step"], (job_states or {}).get(job["job_id"])) for job in jobs
+            ]
+            results.append(result)
+        return results
+
+    def stale(self, job_states, project=None, pipeline=None, now=None, grace=STALE_GRACE_SECONDS):
+        """
+        Markers older than `grace` seconds with jobs submitted since they were set, all of them unknown to slurm.
+        """
+        now = time.time() if now is None else now
+        return [
+            marker
+            for marker in self.in_flight(project, pipeline, job_states)
+            if now - marker["mtime"] > grace
+            and marker["jobs"]
+            and not any(state for _, _, state in marker["jobs"])
+        ]
+
+    def unknown(self, project=None, pipeline=None, now=None, grace=STALE_GRACE_SECONDS):
+        """
+        Markers older than `grace` seconds without any job submitted since they were set: whether they are stale
+        can't be told.
+        """
+        now = time.time() if now is None else now
+        return [
+            marker
+            for marker in self.in_flight(project, pipeline)
+            if now - marker["mtime"] > grace and not marker["jobs"]
+        ]
+
+
+def format_marker(marker):
+    jobs = ", ".join(f"{step}:{job_id}:{state or 'GONE'}" for job_id, step, state in marker["jobs"])
+    return f"{marker['project']}\t{marker['pipeline']}\t{marker['session']}\t{marker['scan'] or '-'}\t{jobs or '-'}"
+
+
+def _group_by_pipeline(markers):
+    groups = {}
+    for marker in markers:
+        classifier = marker["session"].split("_", 1)[1] if "_" in marker["session"] else ""
+        subject = marker["session"][: -len(classifier) - 1] if classifier else marker["session"]
+        subject_string = f"{marker['project']}:{subject}:{classifier}:{marker['scan'] or 'all'}"
+        groups.setdefault(marker["pipeline"], []).append(subject_string)
+    return groups
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Query running status markers and their slurm jobs.")
+    parser.add_argument("--db", required=True, help="SQLite database with the index.")
+    parser.add_argument("--archive-root", default="/ceph/intradb/archive")
+    parser.add_argument("--job-records", help="JOB_RECORDS_FILE written by submit_jobs.")
+    parser.add_argument("--project", action="append", help="Project(s) to index and query.")
+    parser.add_argument("--pipeline")
+    parser.add_argument("--no-refresh", action="store_true", help="Query the index as is.")
+    parser.add_argument("--user", help="Slurm user owning the jobs. Default is the current user.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List markers and the state of their jobs.")
+    stale = subparsers.add_parser("stale", help="List markers whose jobs are gone, and those without jobs.")
+    stale.add_argument("--remove", action="store_true", help="Remove the stale markers from the server.")
+    stale.add_argument("--serverlist")
+    stale.add_argument("--credentials-file")
+    stale.add_argument("--grace", type=int, default=STALE_GRACE_SECONDS, help="Minimum age in seconds.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    registry = RunningRegistry(args.db)
+    if not args.no_refresh:
+        if args.project:
+            registry.refresh_markers(args.archive_root, args.project)
+        if args.job_records:
+            registry.refresh_jobs(args.job_records)
+
+    job_states = slurm_job_states(args.user)
+    projects = args.project or [None]
+    if args.command == "list":
+        for project in projects:
+            for marker in registry.in_flight(project, args.pipeline, job_states):
+                print(format_marker(marker))
+        return 0
+
+    stale = [
+        marker
+        for project in projects
+        for marker in registry.stale(job_states, project, args.pipeline, grace=args.grace)
+    ]
+    unknown = [
+        marker
+        for project in projects
+        for marker in registry.unknown(project, args.pipeline, grace=args.grace)
+    ]
+    for marker in stale:
+        print(format_marker(marker))
+    for marker in unknown:
+        print(f"{format_marker(marker)}\tunknown")
+    if unknown:
+        print(f"{len(unknown)} markers have no recorded jobs, they are left alone.")
+    if args.remove and stale:
+        from running_status import BatchMarker
+
+        marker = BatchMarker(args.serverlist, args.credentials_file, args.archive_root)
+        failures = {}
+        for (pipeline, group) in _group_by_pipeline(stale).items():
+            failures.update(marker.update_all(pipeline, group, "done"))
+        print(f"Removed {len(stale) - len(failures)} of {len(stale)} stale markers.")
+        return 1 if failures else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+running_status.py: Mark or unmark sessions as having a pipeline queued/running.
+
+A marker is a single file, `<PIPELINE>.<SESSION><_SCAN>.RUNNING`, in the
+`RunningStatus` resource of the session. It is written with one PUT and
+removed with one DELETE.
+
+As a command, it updates the markers of many sessions through one pooled client:
+
+    running_status.py --pipeline FunctionalPreprocessing --status queued \\
+        --credentials-file ~/.xnat_credentials --serverlist "http://shadow1:8080 ..." \\
+        CCF_HCA_STG:HCA0123456789:V1_MR:rfMRI_REST1_AP ...
+"""
+import argparse
+import functools
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+from xnat_file_client import XnatFileClient, get_server
+
+RESOURCE = "RunningStatus"
+# the directory of functions.py and batch.py, which read the subject strings of the pipelines
+CONFIG_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def marker_filename(pipeline, session, scan=""):
+    _scan = f"_{scan}" if scan else ""
+    return f"{pipeline}.{session}{_scan}.RUNNING"
+
+
+def mark_queued(client, filename, reason="queued"):
+    """
+    Create the marker with a single request. No catalog refresh is needed.
+    """
+    return client.upload_resource_bytes(RESOURCE, filename, f"Reason: {reason}".encode(), reason)
+
+
+def mark_done(client, filename, resources_root=None):
+    """
+    Remove the marker. If `resources_root` is given, only if it exists in the archive.
+    """
+    if resources_root is not None and not (Path(resources_root) / RESOURCE / filename).exists():
+        return None
+    return client.remove_resource_filepath(RESOURCE, filename)
+
+
+@functools.lru_cache(maxsize=None)
+def load_config_module(name):
+    """
+    functions.py or batch.py, loaded the way prunner loads functions.py. Only when needed: the jobs
+    marking their own session import this module without prunner.
+    """
+    from prunner.loaders.function import FunctionLoader
+
+    return FunctionLoader().load(os.path.join(CONFIG_DIR, f"{name}.py"))
+
+
+def parse_subject_string(text):
+    """
+    Split `project:subject:classifier:extra` into (project, subject, session, scan), see split_subject_components.
+    """
+    components = load_config_module("functions").split_subject_components(text.strip())
+    return components["PROJECT"], components["SUBJECT"], components["SESSION"], components["SCAN"]
+
+
+class BatchMarker:
+    """
+    Updates running status markers of many sessions, sharing one server and one connection pool.
+    """
+
+    def __init__(self, serverlist, credentials_file, archive_root=None, workers=8):
+        self.credentials_file = credentials_file
+        self.archive_root = archive_root
+        self.workers = workers
+        self.server = get_server(serverlist)
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    def client(self, project, subject, session):
+        client = XnatFileClient(
+            project,
+            subject,
+            session,
+            None,
+            self.credentials_file,
+            server=self.server,
+            http=self.http,
+        )
+        if client.sessionId is None:
+            raise Exception("Session not found on server.", project, subject, session)
+        return client
+
+    def update(self, pipeline, subject_string, status):
+        project, subject, session, scan = parse_subject_string(subject_string)
+        client = self.client(project, subject, session)
+        filename = marker_filename(pipeline, session, scan)
+        if status == "queued":
+            r = mark_queued(client, filename, status)
+        else:
+            resources_root = None
+            if self.archive_root:
+                resources_root = Path(self.archive_root) / project / "arc001" / session / "RESOURCES"
+            r = mark_done(client, filename, resources_root)
+        if r is not None and not r.ok and not (status == "done" and r.status_code == 404):
+            raise Exception("Server rejected the request.", r.status_code, r.content)
+
+    def update_all(self, pipeline, subject_strings, status):
+        """
+        Returns:
+            dict of {subject string: exception} for the sessions that failed
+        """
+        def update(subject_string):
+            try:
+                self.update(pipeline, subject_string, status)
+            except Exception as e:
+                return subject_string, e
+            return subject_string, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(update, subject_strings)
+        return {subject_string: e for subject_string, e in results if e is not None}
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Mark or unmark many sessions as running a pipeline.")
+    parser.add_argument("--pipeline", required=True, help="e.g., FunctionalPreprocessing")
+    parser.add_argument("--status", choices=["queued", "done"], default="queued")
+    parser.add_argument("--serverlist", required=True, help="Space separated list of servers.")
+    parser.add_argument("--credentials-file", required=True)
+    parser.add_argument(
+        "--archive-root", help="If specified, only remove markers that exist in this archive."
+    )
+    parser.add_argument("--subjects-file", help="File with one subject string per line.")
+    parser.add_argument("--workers", type=int, default=8, help="Number of concurrent requests.")
+    parser.add_argument("subjects", nargs="*", help="project:subject:classifier:extra")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    subject_strings = list(args.subjects)
+    if args.subjects_file:
+        subject_strings += load_config_module("batch").read_subject_strings(args.subjects_file)
+
+    marker = BatchMarker(args.serverlist, args.credentials_file, args.archive_root, args.workers)
+    failures = marker.update_all(args.pipeline, subject_strings, args.status)
+
+    print(f"Updated {len(subject_strings) - len(failures)} of {len(subject_strings)} sessions.")
+    for subject_string, e in failures.items():
+        print(f"FAILED: {subject_string}: {e}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+scratch_stage.py: Stage the study folder of a process step on node-local scratch, see USE_SCRATCH_FOR_PROCESSING.
+
+The get step links the inputs of a session to the archive, on Ceph. With
+USE_SCRATCH_FOR_PROCESSING, the process step moves the study folder to scratch
+and:
+
+* `prefetch` replaces the links to files outside the study folder by copies, in
+  parallel, so that QuNex reads its inputs from the node
+* `sync`, in the background while QuNex runs, copies the files that stopped
+  changing back to BUILD_SPACE, so that the last copy only has what is left
+* `finish` copies what is left, removes what QuNex removed, and verifies that
+  BUILD_SPACE has every file of scratch, with the same size and mtime. Only then
+  is the verified file written, which the clean step requires, and scratch can
+  be removed.
+
+Inputs that were not modified are linked to the archive again rather than
+copied to BUILD_SPACE. The copies of all the commands of a job share
+--bandwidth-mbs.
+
+    scratch_stage.py prefetch STUDY_FOLDER [--workers 8] [--bandwidth-mbs 200]
+    scratch_stage.py sync STUDY_FOLDER DESTINATION [--interval 300] [--settle 120] &
+    scratch_stage.py finish STUDY_FOLDER DESTINATION --verified-file FILE
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+WORKERS = 8
+BANDWIDTH_MBS = 200
+SYNC_INTERVAL_SECONDS = 300
+# files modified more recently than this may still be written to
+SETTLE_SECONDS = 120
+CHUNK_BYTES = 4 * 2 ** 20
+# the files of the staging itself, in the study folder on scratch
+STAGE_PREFIX = ".scratch_stage."
+INPUTS_FILE = STAGE_PREFIX + "inputs.json"
+SYNCED_FILE = STAGE_PREFIX + "synced.json"
+PARTIAL_SUFFIX = STAGE_PREFIX + "partial"
+
+
+class Throttle:
+    """
+    Token bucket shared by the threads that copy: at most `rate` bytes per second on average.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # a thread can go into debt, the next ones wait for it to be paid
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def copy_file(source, destination, throttle):
+    """
+    Copy with the mode and times of `source`. `destination` only appears once complete.
+    """
+    partial = destination + PARTIAL_SUFFIX
+    with open(source, "rb") as src, open(partial, "wb") as dst:
+        while True:
+            chunk = src.read(CHUNK_BYTES)
+            if not chunk:
+                break
+            throttle.consume(len(chunk))
+            dst.write(chunk)
+    shutil.copystat(source, partial)
+    os.replace(partial, destination)
+    return os.path.getsize(destination)
+
+
+def walk(directory):
+    """
+    Yields:
+        (path relative to `directory`, os.stat_result of the entry itself) of every file and symlink
+    """
+    for root, dirs, files in os.walk(directory):
+        for name in dirs + files:
+            if name.startswith(STAGE_PREFIX):
+                continue
+            path = os.path.join(root, name)
+            if name in files or os.path.islink(path):
+                yield os.path.relpath(path, directory), os.lstat(path)
+
+
+def read_json(path, default):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return default
+
+
+def write_json(path, data):
+    with open(path + PARTIAL_SUFFIX, "w") as fd:
+        json.dump(data, fd)
+    os.replace(path + PARTIAL_SUFFIX, path)
+
+
+def links_outside(path, directory):
+    """
+    Whether the link `path` points outside `directory`. Links between the files of `directory` are kept.
+    """
+    target = os.path.abspath(os.path.join(os.path.dirname(path), os.readlink(path)))
+    directory = os.path.abspath(directory)
+    return os.path.commonpath([target, directory]) != directory
+
+
+def prefetch(directory, workers=WORKERS, throttle=None):
+    """
+    Replace the links to files outside `directory` by copies of the files.
+
+    Returns:
+        (number of files, bytes) copied
+    """
+    throttle = throttle or Throttle(0)
+    links = [
+        rel for rel, stat in walk(directory)
+        if os.path.islink(os.path.join(directory, rel))
+        and os.path.isfile(os.path.join(directory, rel))
+        and links_outside(os.path.join(directory, rel), directory)
+    ]
+    inputs = read_json(os.path.join(directory, INPUTS_FILE), {})
+
+    def fetch(rel):
+        path = os.path.join(directory, rel)
+        target = os.readlink(path)
+        size = copy_file(os.path.realpath(path), path, throttle)
+        stat = os.stat(path)
+        return rel, target, size, stat.st_mtime_ns
+
+    with ThreadPoolExecutor(workers) as pool:
+        fetched = list(pool.map(fetch, links))
+    for rel, target, size, mtime_ns in fetched:
+        inputs[rel] = [target, size, mtime_ns]
+    write_json(os.path.join(directory, INPUTS_FILE), inputs)
+    return len(fetched), sum(size for _, _, size, _ in fetched)
+
+
+def link(target, destination):
+    if os.path.islink(destination) and os.readlink(destination) == target:
+        return
+    if os.path.lexists(destination):
+        os.remove(destination)
+    os.symlink(target, destination)
+
+
+class Stage:
+    def __init__(self, source, destination, workers=WORKERS, throttle=None, settle_seconds=SETTLE_SECONDS):
+        """
+        Args:
+            source: the study folder on scratch
+            destination: the study folder in BUILD_SPACE
+        """
+        self.source = source
+        self.destination = destination
+        self.workers = workers
+        self.throttle = throttle or Throttle(0)
+        self.settle_seconds = settle_seconds
+        self.inputs = read_json(os.path.join(source, INPUTS_FILE), {})
+        # what the destination has: relative path -> [kind, size, mtime_ns or link target]
+        self.synced = read_json(os.path.join(source, SYNCED_FILE), {})
+        self.stopping = False
+
+    def expected(self, rel, stat):
+        """
+        What the destination must have for the entry of the source.
+        """
+        path = os.path.join(self.source, rel)
+        if os.path.islink(path):
+            return ["link", 0, os.readlink(path)]
+        if rel in self.inputs and self.inputs[rel][1:] == [stat.st_size, stat.st_mtime_ns]:
+            # an input that was not modified goes back to being a link
+            return ["link", 0, self.inputs[rel][0]]
+        return ["file", stat.st_size, stat.st_mtime_ns]
+
+    def sync(self, final=False, now=None):
+        """
+        Bring the destination up to date with the files of the source that stopped changing, or with all of them.
+
+        Returns:
+            number of files copied or linked
+        """
+        now = time.time() if now is None else now
+        pending = []
+        present = set()
+        for rel, stat in walk(self.source):
+            present.add(rel)
+            expected = self.expected(rel, stat)
+            if self.synced.get(rel) == expected:
+                continue
+            if not final and expected[0] == "file" and now - stat.st_mtime < self.settle_seconds:
+                continue
+            pending.append((rel, expected))
+
+        def apply(item):
+            rel, expected = item
+            if self.stopping:
+                return None
+            destination = os.path.join(self.destination, rel)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            if expected[0] == "link":
+                link(expected[2], destination)
+            else:
+                if os.path.islink(destination):
+                    os.remove(destination)
+                copy_file(os.path.join(self.source, rel), destination, self.throttle)
+            return rel, expected
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            done = [x for x in pool.map(apply, pending) if x]
+        for rel, expected in done:
+            self.synced[rel] = expected
+        if final:
+            # including the directories QuNex left empty
+            for root, dirs, _ in os.walk(self.source):
+                for name in dirs:
+                    if not os.path.islink(os.path.join(root, name)):
+                        rel = os.path.relpath(os.path.join(root, name), self.source)
+                        os.makedirs(os.path.join(self.destination, rel), exist_ok=True)
+            for rel in [rel for rel in self.synced if rel not in present]:
+                destination = os.path.join(self.destination, rel)
+                if os.path.lexists(destination):
+                    os.remove(destination)
+                del self.synced[rel]
+        write_json(os.path.join(self.source, SYNCED_FILE), self.synced)
+        return len(done)
+
+    def verify(self):
+        """
+        Returns:
+            the relative paths that the destination is missing or has a different copy of
+        """
+        mismatches = []
+        for rel, stat in walk(self.source):
+            kind, size, value = self.expected(rel, stat)
+            destination = os.path.join(self.destination, rel)
+            if kind == "link":
+                ok = os.path.islink(destination) and os.readlink(destination) == value
+            else:
+                try:
+                    copy = os.lstat(destination)
+                except OSError:
+                    copy = None
+                # file systems keep mtimes to different precisions
+                ok = copy is not None and copy.st_size == size and int(copy.st_mtime) == value // 10 ** 9
+            if not ok:
+                mismatches.append(rel)
+        return mismatches
+
+    def run(self, interval=SYNC_INTERVAL_SECONDS):
+        """
+        Sync every `interval` seconds until SIGTERM, which lets the files being copied finish.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, "stopping", True))
+        while not self.stopping:
+            start = time.time()
+            copied = self.sync()
+            if copied:
+                print(f"scratch_stage: {copied} files synced to {self.destination} in {time.time() - start:.0f}s")
+            deadline = start + interval
+            while not self.stopping and time.time() < deadline:
+                time.sleep(1)
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Stage a study folder on node-local scratch.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    prefetch_parser = subparsers.add_parser("prefetch", help="Copy the linked inputs to scratch.")
+    prefetch_parser.add_argument("source")
+    sync_parser = subparsers.add_parser("sync", help="Copy finished outputs back until SIGTERM.")
+    sync_parser.add_argument("source")
+    sync_parser.add_argument("destination")
+    sync_parser.add_argument("--interval", type=int, default=SYNC_INTERVAL_SECONDS)
+    sync_parser.add_argument("--settle", type=int, default=SETTLE_SECONDS)
+    finish_parser = subparsers.add_parser("finish", help="Copy the rest back and verify.")
+    finish_parser.add_argument("source")
+    finish_parser.add_argument("destination")
+    finish_parser.add_argument("--verified-file", help="Written once the destination is verified.")
+    for subparser in (prefetch_parser, sync_parser, finish_parser):
+        subparser.add_argument("--workers", type=int, default=WORKERS)
+        subparser.add_argument("--bandwidth-mbs", type=float, default=BANDWIDTH_MBS, help="0 for no limit.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    throttle = Throttle(args.bandwidth_mbs * 2 ** 20)
+    if args.command == "prefetch":
+        start = time.time()
+        files, size = prefetch(args.source, args.workers, throttle)
+        print(f"scratch_stage: prefetched {files} files, {size / 2 ** 30:.1f} GB in {time.time() - start:.0f}s")
+        return 0
+    if args.command == "sync":
+        Stage(args.source, args.destination, args.workers, throttle, args.settle).run(args.interval)
+        return 0
+
+    stage = Stage(args.source, args.destination, args.workers, throttle)
+    copied = stage.sync(final=True)
+    mismatches = stage.verify()
+    if mismatches:
+        print(f"ERROR: {len(mismatches)} files of {args.source} differ in {args.destination}, e.g.:", file=sys.stderr)
+        print("\n".join(mismatches[:20]), file=sys.stderr)
+        return 1
+    print(f"scratch_stage: {copied} files synced to {args.destination}, verified.")
+    if args.verified_file:
+        with open(args.verified_file, "w") as fd:
+            fd.write(f"{args.source}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+shared_staging.py: Link the inputs shared by the per-scan jobs of a session once, see SHARE_SESSION_INPUTS.
+
+FunctionalPreprocessing runs a job per BOLD, and each of them links the same
+Structural_preproc trees from the archive. With SHARE_SESSION_INPUTS, the first
+get step of a session links them into SHARED_INPUTS_DIR, while the others
+wait, and every get step copies the links of SHARED_INPUTS_DIR to its own
+WORKING_DIR. This saves the glob and stat of every file of the archive, not
+the links: each job still makes one symlink per file, as the jobs write their
+outputs into the same directories (e.g. MNINonLinear), so the shared tree
+itself can't be linked or bound in their place. Each job then links its own
+scan's data as before.
+
+The jobs using SHARED_INPUTS_DIR are counted in it. Each job releases it once,
+from its marker step, which runs whether the job succeeded or not (`afterany`,
+or last in the run_all script), and the last one moves it to TRASH_DIR (see
+reaper.py). Jobs submitted without a marker step, or killed before it, are
+dropped from the count after STALE_SECONDS.
+
+The `.complete` marker of staged inputs records the time of the last change of
+each source tree (`ceph.dir.rctime` on CephFS, the mtime and ctime of its root
+elsewhere): when one of them changed since, e.g. Structural_preproc was
+reprocessed, the inputs are staged again.
+
+    shared_staging.py status SHARED_INPUTS_DIR
+    shared_staging.py release SHARED_INPUTS_DIR JOB --trash-dir TRASH_DIR
+"""
+import argparse
+import fcntl
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from reaper import discard
+
+REFS_FILE = ".refs.json"
+COMPLETE_SUFFIX = ".complete"
+# jobs that didn't release the inputs after this long are assumed gone: longer than the walltime of any step
+STALE_SECONDS = 2 * 24 * 3600
+
+
+def copy_links(source, destination, consume=None):
+    """
+    Make the directories of `source` in `destination`, with the same symlinks. Existing entries are kept.
+
+    Returns:
+        number of links made
+    """
+    consume = consume or (lambda operations=1: None)
+    made = 0
+    os.makedirs(destination, exist_ok=True)
+    consume()
+    with os.scandir(source) as entries:
+        entries = list(entries)
+    for entry in entries:
+        target = os.path.join(destination, entry.name)
+        if entry.is_symlink():
+            consume(2)
+            try:
+                os.symlink(os.readlink(entry.path), target)
+                made += 1
+            except FileExistsError:
+                pass
+        elif entry.is_dir():
+            consume()
+            made += copy_links(entry.path, target, consume)
+    return made
+
+
+def tree_stamp(path):
+    """
+    When the tree at `path` last changed: the recursive ctime cephfs keeps for directories,
+    or the mtime and ctime of `path` elsewhere.
+    """
+    try:
+        return os.getxattr(path, "ceph.dir.rctime").decode()
+    except (OSError, AttributeError):
+        pass
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return f"{st.st_mtime_ns}:{st.st_ctime_ns}"
+
+
+class SharedStaging:
+    def __init__(self, directory, job, trash_dir):
+        """
+        Args:
+            directory: SHARED_INPUTS_DIR, of the session
+            job: name of the job using it, e.g. its DIR_PREFIX
+        """
+        self.directory = directory
+        self.job = job
+        self.trash_dir = trash_dir
+
+    @contextmanager
+    def locked(self):
+        # next to the directory, which is removed with the last job
+        os.makedirs(os.path.dirname(os.path.abspath(self.directory)), exist_ok=True)
+        with open(self.directory + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def read_refs(self):
+        try:
+            with open(os.path.join(self.directory, REFS_FILE)) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return {}
+
+    def write_refs(self, refs):
+        path = os.path.join(self.directory, REFS_FILE)
+        with open(path + ".partial", "w") as fd:
+            json.dump(refs, fd)
+        os.replace(path + ".partial", path)
+
+    def acquire(self):
+        with self.locked():
+            os.makedirs(self.directory, exist_ok=True)
+            refs = self.read_refs()
+            refs[self.job] = time.time()
+            self.write_refs(refs)
+        return refs
+
+    def release(self):
+        """
+        Returns:
+            the jobs still using the directory
+        """
+        with self.locked():
+            if not os.path.isdir(self.directory):
+                return {}
+            now = time.time()
+            refs = {job: since for job, since in self.read_refs().items() if now - since < STALE_SECONDS}
+            if self.job not in refs:
+                # released already, or never acquired
+                return refs
+            refs.pop(self.job)
+            if refs:
+                self.write_refs(refs)
+            else:
+                print("Removing the shared inputs: ", self.directory)
+                discard(self.directory, self.trash_dir)
+        return refs
+
+    def _stage(self, name, populate, sources):
+        staged = os.path.join(self.directory, name)
+        stamps = {str(source): tree_stamp(source) for source in sources}
+        try:
+            with open(staged + COMPLETE_SUFFIX) as fd:
+                complete = json.load(fd)
+        except (OSError, ValueError):
+            complete = None
+        if complete is not None and complete.get("sources") == stamps:
+            print("Using the shared inputs: ", staged)
+            return staged
+
+        if complete is not None:
+            print("The sources of the shared inputs changed since they were staged: ", staged)
+        # what is left of an earlier staging, complete or not
+        if os.path.lexists(staged + COMPLETE_SUFFIX):
+            os.remove(staged + COMPLETE_SUFFIX)
+        discard(staged, self.trash_dir)
+        print("Staging the shared inputs: ", staged)
+        populate(staged)
+        with open(staged + COMPLETE_SUFFIX, "w") as fd:
+            json.dump({"job": self.job, "sources": stamps}, fd)
+        return staged
+
+    def stage(self, name, populate, sources=()):
+        """
+        The directory of the shared inputs `name`, made by `populate(directory)` from `sources`,
+        unless another job did since they last changed.
+        """
+        with self.locked():
+            return self._stage(name, populate, sources)
+
+    def overlay(self, name, populate, destination, consume=None, sources=()):
+        """
+        Stage the shared inputs `name`, see `stage`, and link them in `destination`.
+        """
+        # under the lock, so that another job doesn't stage them again in the meantime
+        with self.locked():
+            staged = self._stage(name, populate, sources)
+            if os.path.isdir(staged):
+                copy_links(staged, destination, consume)
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Inputs shared by the per-scan jobs of a session.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    status_parser = subparsers.add_parser("status", help="The jobs using the shared inputs.")
+    status_parser.add_argument("directory")
+    release_parser = subparsers.add_parser("release", help="Release the shared inputs for a job that died.")
+    release_parser.add_argument("directory")
+    release_parser.add_argument("job")
+    release_parser.add_argument("--trash-dir", required=True)
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    if args.command == "status":
+        for job, since in SharedStaging(args.directory, None, None).read_refs().items():
+            print(f"{job} since {time.ctime(since)}")
+        return 0
+    refs = SharedStaging(args.directory, args.job, args.trash_dir).release()
+    print(f"{len(refs)} jobs still using {args.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
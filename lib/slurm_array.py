@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+slurm_array.py: Submit the jobs of many sessions as slurm job arrays.
+
+`submit_jobs --manifest <manifest>` appends the job scripts of a session to the
+manifest instead of submitting them. This submits the whole manifest with one
+`sbatch --array` per step:
+
+* Sessions with the same steps and the same resources (the #SBATCH lines of
+  their scripts) share arrays. Task i of every array is session i. The memory,
+  local disk and walltime of each session's jobs are predicted for it (see
+  resource_prediction.py and capacity.py), so they only need to be within the
+  same power of 2 to share an array, which asks for the largest of them.
+* Each step depends on the previous one with `aftercorr`, so the chain of
+  each session still runs in order, independently of the other sessions.
+* Each task runs the session's own script, with stdout/stderr going where the
+  script's #SBATCH --output/--error lines would have sent them.
+* The job that removes the running status markers waits for the whole last
+  array (`afterany`), since slurm has no per-task equivalent of `afterany`.
+* One reaper job per TRASH_DIR (see reaper.py) empties it once the arrays of
+  the whole manifest are done.
+
+    slurm_array.py [--dry-run] [--max-running 200] submitted.manifest
+"""
+import argparse
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+import reaper
+
+MAX_ARRAY_SIZE = 1000
+# options that are specific to a session's script, all others are shared by the array
+SESSION_OPTIONS = ("--job-name", "--output", "--error", "-J", "-o", "-e")
+# options sized for each session: the array asks for the largest
+RESOURCE_OPTIONS = ("--mem", "--tmp", "--time", "-t")
+# MB per unit of the --mem and --tmp suffixes, MB by default
+SIZE_UNITS = {"K": 1 / 1024, "M": 1, "G": 1024, "T": 1024 ** 2}
+
+
+def read_manifest(path):
+    with open(path) as fd:
+        return [json.loads(line) for line in fd if line.strip()]
+
+
+def sbatch_directives(script):
+    """
+    Returns:
+        (list of shared options, stdout path, stderr path) from the #SBATCH lines of a script
+    """
+    shared, stdout, stderr = [], None, None
+    with open(script) as fd:
+        for line in fd:
+            if not line.startswith("#SBATCH"):
+                continue
+            for option in shlex.split(line[len("#SBATCH"):], comments=True):
+                name, _, value = option.partition("=")
+                if name in ("--output", "-o"):
+                    stdout = value
+                elif name in ("--error", "-e"):
+                    stderr = value
+                elif name not in SESSION_OPTIONS:
+                    shared.append(option)
+    return shared, stdout, stderr
+
+
+def parse_slurm_time(value):
+    """
+    Hours of a slurm --time: minutes, minutes:seconds, hours:minutes:seconds,
+    days-hours, days-hours:minutes or days-hours:minutes:seconds.
+    """
+    days, _, rest = value.rpartition("-")
+    fields = [int(field) for field in rest.split(":")]
+    if days:
+        hours, minutes, seconds = (fields + [0, 0])[:3]
+    elif len(fields) == 3:
+        hours, minutes, seconds = fields
+    else:
+        hours, (minutes, seconds) = 0, (fields + [0])[:2]
+    return int(days or 0) * 24 + hours + minutes / 60 + seconds / 3600
+
+
+def format_slurm_time(hours):
+    minutes = math.ceil(hours * 60)
+    return f"{minutes // 60}:{minutes % 60:02d}:00"
+
+
+def parse_slurm_size(value):
+    """
+    MB of a slurm --mem or --tmp, e.g. 48000, 48000M or 48G.
+    """
+    unit = value[-1].upper()
+    if unit in SIZE_UNITS:
+        return math.ceil(float(value[:-1]) * SIZE_UNITS[unit])
+    return int(value)
+
+
+def resource_amount(name, value):
+    """
+    Hours of a --time, MB of a --mem or --tmp.
+    """
+    return parse_slurm_time(value) if name in ("--time", "-t") else parse_slurm_size(value)
+
+
+def resource_signature(options):
+    """
+    The options of a script, with the resources rounded up to a power of 2.
+    """
+    signature = []
+    for option in options:
+        name, _, value = option.partition("=")
+        if name in RESOURCE_OPTIONS:
+            amount = resource_amount(name, value)
+            option = (name, math.ceil(math.log2(amount)) if amount > 0 else None)
+        signature.append(option)
+    return tuple(signature)
+
+
+def array_options(scripts):
+    """
+    The options shared by the scripts of an array, with the largest resources of any of them.
+    """
+    largest = {}
+    for script in scripts:
+        for option in sbatch_directives(script)[0]:
+            name, _, value = option.partition("=")
+            if name in RESOURCE_OPTIONS:
+                largest[name] = max(largest.get(name, 0), resource_amount(name, value))
+    options = []
+    for option in sbatch_directives(scripts[0])[0]:
+        name = option.partition("=")[0]
+        if name in ("--time", "-t"):
+            option = f"{name}={format_slurm_time(largest[name])}"
+        elif name in RESOURCE_OPTIONS:
+            option = f"{name}={largest[name]}"
+        options.append(option)
+    return options
+
+
+def group_sessions(records, max_array_size=MAX_ARRAY_SIZE):
+    """
+    Group sessions whose chains can share job arrays.
+
+    Returns:
+        list of lists of records, each at most `max_array_size` long
+    """
+    groups = {}
+    for record in records:
+        signature = (
+            record["pipeline"],
+            tuple(step for step, _ in record["steps"]),
+            tuple(resource_signature(sbatch_directives(script)[0]) for _, script in record["steps"]),
+            bool(record.get("marker")),
+        )
+        groups.setdefault(signature, []).append(record)
+
+    chunks = []
+    for group in groups.values():
+        for i in range(0, len(group), max_array_size):
+            chunks.append(group[i:i + max_array_size])
+    return chunks
+
+
+def write_array_script(array_dir, name, scripts, job_name):
+    """
+    Write the list of tasks and the script run by each task of the array.
+    """
+    tasks_file = os.path.join(array_dir, f"{name}.tasks")
+    with open(tasks_file, "w") as fd:
+        for script in scripts:
+            _, stdout, stderr = sbatch_directives(script)
+            stdout = stdout or f"{script}.%j.stdout"
+            stderr = stderr or f"{script}.%j.stderr"
+            fd.write(f"{script}\t{stdout}\t{stderr}\n")
+
+    shared = array_options(scripts)
+    array_script = os.path.join(array_dir, f"{name}.sh")
+    lines = ["#!/bin/bash", f'#SBATCH --job-name="{job_name}"']
+    lines += [f"#SBATCH {option}" for option in shared]
+    lines += [
+        f'#SBATCH --output="{array_dir}/{name}.%A_%a.slurmlog"',
+        "",
+        f'TASK=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" "{tasks_file}")',
+        "IFS=$'\\t' read -r SCRIPT STDOUT STDERR <<< \"$TASK\"",
+        'exec "$SCRIPT" > "${STDOUT//%j/$SLURM_JOB_ID}" 2> "${STDERR//%j/$SLURM_JOB_ID}"',
+        "",
+    ]
+    with open(array_script, "w") as fd:
+        fd.write("\n".join(lines))
+    os.chmod(array_script, 0o770)
+    return array_script
+
+
+def sbatch_array(script, size, dependency=None, max_running=None, dry_run=False):
+    array = f"0-{size - 1}" + (f"%{max_running}" if max_running else "")
+    cmd = ["sbatch", "--parsable", f"--array={array}"]
+    if dependency:
+        cmd.append(f"--dependency={dependency}")
+    cmd.append(script)
+    print(">> ", " ".join(cmd))
+    if dry_run:
+        return f"<{os.path.basename(script)}>"
+    # --parsable prints `<job_id>[;<cluster>]`
+    return subprocess.check_output(cmd).decode().strip().split(";")[0]
+
+
+def record_jobs(records, step, job_ids):
+    """
+    Append the job of each session, e.g. its array task, to its job records file, see running_registry.py.
+    """
+    by_file = {}
+    for record, job_id in zip(records, job_ids):
+        job = dict(
+            job_id=job_id,
+            step=step,
+            submitted=int(time.time()),
+            **{k: record[k] for k in ("project", "subject", "session", "scan", "pipeline", "check_data_dir")},
+        )
+        by_file.setdefault(record["job_records_file"], []).append(json.dumps(job) + "\n")
+    for path, lines in by_file.items():
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a") as fd:
+                fd.write("".join(lines))
+        except OSError as e:
+            print(f"WARNING: Unable to record jobs in {path}: {e}")
+
+
+def submit_chunk(records, array_dir, max_running=None, dry_run=False):
+    """
+    Submit one array per step for the sessions of a chunk.
+
+    Returns:
+        list of (step, array job id)
+    """
+    os.makedirs(array_dir, exist_ok=True)
+    pipeline = records[0]["pipeline"]
+    steps = [step for step, _ in records[0]["steps"]]
+    submitted = []
+    prior_job = None
+    for i, step in enumerate(steps):
+        scripts = [record["steps"][i][1] for record in records]
+        script = write_array_script(array_dir, step, scripts, f"{pipeline}.{step}.array")
+        dependency = f"aftercorr:{prior_job}" if prior_job else None
+        prior_job = sbatch_array(script, len(records), dependency, max_running, dry_run)
+        submitted.append((step, prior_job))
+        if not dry_run:
+            record_jobs(records, step, [f"{prior_job}_{i}" for i in range(len(records))])
+
+    if records[0].get("marker"):
+        scripts = [record["marker"] for record in records]
+        script = write_array_script(array_dir, "marker", scripts, f"{pipeline}.marker.array")
+        prior_job = sbatch_array(script, len(records), f"afterany:{prior_job}", None, dry_run)
+        submitted.append(("marker", prior_job))
+        if not dry_run:
+            record_jobs(records, "marker", [f"{prior_job}_{i}" for i in range(len(records))])
+
+    return submitted
+
+
+def mark_queued(records, dry_run=False):
+    """
+    Mark the sessions with a marker step as queued, with one BatchMarker per pipeline rather than
+    a marker script per session. Failures are reported, but don't stop the submission.
+    """
+    groups = {}
+    for record in records:
+        # sessions added by an older submit_jobs marked themselves
+        if record.get("marker") and record.get("subject_string"):
+            key = (record["serverlist"], record["credentials_file"], record["pipeline"])
+            groups.setdefault(key, []).append(record["subject_string"])
+    for (serverlist, credentials_file, pipeline), subject_strings in groups.items():
+        print(f"Marking {len(subject_strings)} sessions of {pipeline} as queued.")
+        if dry_run:
+            continue
+        from running_status import BatchMarker
+
+        try:
+            failures = BatchMarker(serverlist, credentials_file).update_all(pipeline, subject_strings, "queued")
+        except Exception as e:
+            failures = {subject_string: e for subject_string in subject_strings}
+        for subject_string, e in failures.items():
+            print(f"WARNING: Unable to mark {subject_string} as queued: {e}")
+
+
+def submit_manifest(manifest, max_array_size=MAX_ARRAY_SIZE, max_running=None, dry_run=False):
+    records = read_manifest(manifest)
+    mark_queued(records, dry_run)
+    chunks = group_sessions(records, max_array_size)
+    results = []
+    for i, chunk in enumerate(chunks):
+        array_dir = f"{os.path.abspath(manifest)}.arrays/{i:03d}"
+        submitted = submit_chunk(chunk, array_dir, max_running, dry_run)
+        print(f"Submitted {len(chunk)} sessions of {chunk[0]['pipeline']} as {len(submitted)} job arrays.")
+        results.append((chunk, submitted))
+    trash_dirs = [record["trash_dir"] for record in records if record.get("trash_dir")]
+    if trash_dirs:
+        reaper.submit_after(trash_dirs, [submitted[-1][1] for _, submitted in results], dry_run)
+    return results
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Submit the sessions of a manifest as slurm job arrays.")
+    parser.add_argument("manifest", help="Manifest written by `submit_jobs --manifest`.")
+    parser.add_argument("--max-array-size", type=int, default=MAX_ARRAY_SIZE, help="slurm's MaxArraySize - 1")
+    parser.add_argument("--max-running", type=int, help="Maximum number of tasks of an array running at once.")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="Print the sbatch commands only.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    submit_manifest(args.manifest, args.max_array_size, args.max_running, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+slurm_pack.py: Run the run_all jobs of several light sessions in one slurm allocation.
+
+Light pipelines, e.g. BedpostxPreprocessing or TaskAnalysisProcessing, spend
+more time waiting for an allocation than running. This packs the run_all
+scripts of a manifest (see slurm_array.py) N sessions per allocation:
+
+* The allocation asks for the cores, memory and local disk (--tmp) of the
+  sessions it runs at the same time, at most --node-cpus and --node-mem-gbs,
+  and for enough walltime to run them all in as many waves as needed.
+* Inside the allocation, sessions start as soon as there are cores and memory
+  left for them (the --ntasks-per-node and --mem of their own script).
+* Each session logs where its own job would have, and its run_all script still
+  handles its running status marker. Its telemetry records the memory of its
+  own processes, not of the allocation (see telemetry.py). The exit code of
+  each session is written to `<pack dir>/<session>.exit`.
+* One reaper job per TRASH_DIR (see reaper.py) empties it once all the packs
+  of the manifest are done.
+
+    slurm_pack.py [--dry-run] [--sessions-per-pack 8] [--node-cpus 16] [--node-mem-gbs 64] submitted.manifest
+"""
+import argparse
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+
+import reaper
+from slurm_array import (
+    SIZE_UNITS,
+    format_slurm_time,
+    parse_slurm_size,
+    parse_slurm_time,
+    read_manifest,
+    record_jobs,
+    sbatch_directives,
+)
+from telemetry import PACKED_ENV
+
+SESSIONS_PER_PACK = 8
+NODE_CPUS = 16
+NODE_MEM_GBS = 64
+# the options of a session's job that are replaced by the ones of the pack
+PACK_OPTIONS = ("--ntasks-per-node", "--mem", "--tmp", "--time", "-t")
+
+
+def session_resources(script):
+    """
+    Returns:
+        (cpus, memory in MB, local disk in MB, walltime in hours) of the #SBATCH lines of a script
+    """
+    cpus, mem, tmp, hours = 1, 4000, 0, 4
+    for option in sbatch_directives(script)[0]:
+        name, _, value = option.partition("=")
+        if name == "--ntasks-per-node":
+            cpus = int(value)
+        elif name == "--mem":
+            mem = parse_slurm_size(value)
+        elif name == "--tmp":
+            tmp = parse_slurm_size(value)
+        elif name in ("--time", "-t"):
+            hours = parse_slurm_time(value)
+    return cpus, mem, tmp, hours
+
+
+def pack_sessions(records, sessions_per_pack=SESSIONS_PER_PACK):
+    """
+    Group the sessions of each pipeline, `sessions_per_pack` at a time.
+    """
+    for record in records:
+        if [step for step, _ in record["steps"]] != ["run_all"]:
+            raise Exception("Only sessions generated with BREAKPOINT=run_all can be packed.", record["session"])
+    groups = {}
+    for record in records:
+        groups.setdefault(record["pipeline"], []).append(record)
+    packs = []
+    for group in groups.values():
+        for i in range(0, len(group), sessions_per_pack):
+            packs.append(group[i:i + sessions_per_pack])
+    return packs
+
+
+def pack_resources(sessions, node_cpus=NODE_CPUS, node_mem_gbs=NODE_MEM_GBS):
+    """
+    Returns:
+        (cpus, memory in MB, local disk in MB, walltime in hours) of the allocation running `sessions`
+    """
+    cpus = max(session["cpus"] for session in sessions)
+    mem = max(session["mem"] for session in sessions)
+    tmp = max(session.get("tmp", 0) for session in sessions)
+    hours = max(session["hours"] for session in sessions)
+    node_mem = node_mem_gbs * SIZE_UNITS["G"]
+    if cpus > node_cpus or mem > node_mem:
+        raise Exception("A session needs more than a node.", cpus, mem)
+    concurrency = min(len(sessions), node_cpus // cpus, node_mem // mem)
+    waves = math.ceil(len(sessions) / concurrency)
+    return cpus * concurrency, mem * concurrency, tmp * concurrency, hours * waves
+
+
+def write_pack(pack_dir, records, node_cpus=NODE_CPUS, node_mem_gbs=NODE_MEM_GBS):
+    """
+    Write the sessions of the pack and the script of its job.
+    """
+    os.makedirs(pack_dir, exist_ok=True)
+    sessions = []
+    for record in records:
+        script = record["steps"][0][1]
+        _, stdout, stderr = sbatch_directives(script)
+        cpus, mem, tmp, hours = session_resources(script)
+        sessions.append(
+            dict(
+                session=record["session"] + (f"_{record['scan']}" if record["scan"] else ""),
+                script=script,
+                stdout=stdout or f"{script}.%j.stdout",
+                stderr=stderr or f"{script}.%j.stderr",
+                cpus=cpus,
+                mem=mem,
+                tmp=tmp,
+                hours=hours,
+            )
+        )
+    cpus, mem, tmp, hours = pack_resources(sessions, node_cpus, node_mem_gbs)
+    pack_file = os.path.join(pack_dir, "pack.json")
+    with open(pack_file, "w") as fd:
+        json.dump(dict(cpus=cpus, mem=mem, sessions=sessions), fd, indent=1)
+
+    shared = [
+        option for option in sbatch_directives(sessions[0]["script"])[0]
+        if option.partition("=")[0] not in PACK_OPTIONS
+    ]
+    lines = ["#!/bin/bash", f'#SBATCH --job-name="{records[0]["pipeline"]}.pack"']
+    lines += [f"#SBATCH {option}" for option in shared]
+    lines += [
+        f"#SBATCH --ntasks-per-node={cpus} --mem={mem} --time={format_slurm_time(hours)}"
+        + (f" --tmp={tmp}" if tmp else ""),
+        f'#SBATCH --output="{pack_dir}/pack.%j.slurmlog"',
+        "",
+        # the interpreter that submitted the pack, with the same modules
+        f"exec {shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} --run {shlex.quote(pack_file)}",
+        "",
+    ]
+    pack_script = os.path.join(pack_dir, "pack.sh")
+    with open(pack_script, "w") as fd:
+        fd.write("\n".join(lines))
+    os.chmod(pack_script, 0o770)
+    return pack_script
+
+
+def run_pack(pack_file):
+    """
+    Run the sessions of a pack, inside its allocation, as many at a time as the cores and memory allow.
+
+    Returns:
+        number of sessions that failed
+    """
+    with open(pack_file) as fd:
+        pack = json.load(fd)
+    pack_dir = os.path.dirname(pack_file)
+    job_id = os.environ.get("SLURM_JOB_ID", "0")
+    free_cpus, free_mem = pack["cpus"], pack["mem"]
+    waiting = list(pack["sessions"])
+    running = {}
+    failed = 0
+    while waiting or running:
+        while waiting and waiting[0]["cpus"] <= free_cpus and waiting[0]["mem"] <= free_mem:
+            session = waiting.pop(0)
+            with open(session["stdout"].replace("%j", job_id), "w") as stdout, \
+                    open(session["stderr"].replace("%j", job_id), "w") as stderr:
+                # its telemetry measures its own processes, not the allocation, see telemetry.py
+                env = dict(os.environ, **{PACKED_ENV: "1"})
+                process = subprocess.Popen([session["script"]], stdout=stdout, stderr=stderr, env=env)
+            print(f"Started {session['session']}")
+            running[process.pid] = (process, session)
+            free_cpus -= session["cpus"]
+            free_mem -= session["mem"]
+
+        pid, status = os.wait()
+        if pid not in running:
+            continue
+        process, session = running.pop(pid)
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        free_cpus += session["cpus"]
+        free_mem += session["mem"]
+        with open(os.path.join(pack_dir, f"{session['session']}.exit"), "w") as fd:
+            fd.write(f"{returncode}\n")
+        print(f"Finished {session['session']} with exit code {returncode}")
+        failed += returncode != 0
+    return failed
+
+
+def submit_packs(manifest, sessions_per_pack=SESSIONS_PER_PACK, node_cpus=NODE_CPUS, node_mem_gbs=NODE_MEM_GBS,
+                 dry_run=False):
+    records = read_manifest(manifest)
+    results = []
+    for i, records_of_pack in enumerate(pack_sessions(records, sessions_per_pack)):
+        pack_dir = f"{os.path.abspath(manifest)}.packs/{i:03d}"
+        script = write_pack(pack_dir, records_of_pack, node_cpus, node_mem_gbs)
+        cmd = ["sbatch", "--parsable", script]
+        print(">> ", " ".join(cmd))
+        if dry_run:
+            job_id = "<job_id>"
+        else:
+            job_id = subprocess.check_output(cmd).decode().strip().split(";")[0]
+            record_jobs(records_of_pack, "run_all", [job_id] * len(records_of_pack))
+        print(f"Submitted {len(records_of_pack)} sessions of {records_of_pack[0]['pipeline']} as job {job_id}.")
+        results.append((records_of_pack, job_id))
+    trash_dirs = [record["trash_dir"] for record in records if record.get("trash_dir")]
+    if trash_dirs:
+        reaper.submit_after(trash_dirs, [job_id for _, job_id in results], dry_run)
+    return results
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Run the run_all jobs of a manifest, several per allocation.")
+    parser.add_argument("manifest", nargs="?", help="Manifest written by `submit_jobs --manifest`.")
+    parser.add_argument("--sessions-per-pack", type=int, default=SESSIONS_PER_PACK)
+    parser.add_argument("--node-cpus", type=int, default=NODE_CPUS, help="Most cores an allocation asks for.")
+    parser.add_argument("--node-mem-gbs", type=int, default=NODE_MEM_GBS, help="Most memory an allocation asks for.")
+    parser.add_argument("--dry-run", "-n", action="store_true", help="Print the sbatch commands only.")
+    parser.add_argument("--run", metavar="PACK_FILE", help="Run the sessions of a pack. Used by the pack's job.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    if args.run:
+        return 1 if run_pack(args.run) else 0
+    submit_packs(args.manifest, args.sessions_per_pack, args.node_cpus, args.node_mem_gbs, args.dry_run)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
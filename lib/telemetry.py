@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+telemetry.py: Record the time and resources each step of a job uses.
+
+Every step appends one JSON line to TELEMETRY_FILE, in CHECK_DATA_DIR, which
+the put step copies to ProcessingInfo with the rest of CHECK_DATA_DIR:
+
+* the python steps (get, clean, put, check) record themselves when they exit,
+  see `record_at_exit` in shared_values.py
+* the process step runs the container under `telemetry.py run`
+
+All steps also append their records to TELEMETRY_HISTORY_FILE, from which
+`predict_resources` (functions.py) sizes the next jobs: the process job from the
+process steps, the run_all job from all the steps of each run. Once it is larger
+than HISTORY_MAX_BYTES, it is moved to `<TELEMETRY_HISTORY_FILE>.1`, replacing
+the previous one, so that generation never reads more than twice that.
+
+Each record has the wall time, the user and system CPU time, the peak RSS of
+the step or its largest child, the bytes read and written, and the number of
+files in the step's output directory. Steps run under `telemetry.py run` also
+record the peak memory of the whole job (`job_mem_kb`): the anonymous and shared
+memory of the job's cgroup, which is what slurm's memory limit is enforced on
+(page cache left out, it is reclaimed at the limit), sampled every
+MEMORY_SAMPLE_SECONDS, and at least the peak RSS of its largest process.
+The sessions of a pack (see slurm_pack.py) share the cgroup of its allocation:
+they are run with PACKED_ENV set, and record the RSS of their own process tree
+instead, so that each of them isn't sized from the memory of the whole pack.
+
+At its time limit, slurm sends SIGTERM to the job: `telemetry.py run` passes it
+on to the command, and records it with `timed_out`, after the command exits or
+TERMINATE_GRACE_SECONDS later, before slurm kills what is left.
+
+    telemetry.py run --file TELEMETRY_FILE [--file ...] [--history TELEMETRY_HISTORY_FILE] --step process [--files DIR] [--label KEY=VALUE ...] -- CMD ...
+    telemetry.py summarize [--by pipeline project step] FILE_OR_DIR ...
+"""
+import argparse
+import atexit
+import json
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+SUMMARY_FIELDS = ("wall_seconds", "cpu_seconds", "max_rss_mb", "job_mem_mb", "read_mb", "write_mb", "files")
+HISTORY_MAX_BYTES = 16 * 2 ** 20
+MEMORY_SAMPLE_SECONDS = 5
+# set by slurm_pack.py for the sessions it runs in one allocation
+PACKED_ENV = "PIPELINE_PACKED_SESSION"
+# well within slurm's KillWait, between SIGTERM and SIGKILL
+TERMINATE_GRACE_SECONDS = 10
+
+
+def io_counters():
+    """
+    (bytes read, bytes written) by this process and its reaped children, including network file systems.
+    """
+    try:
+        with open("/proc/self/io") as fd:
+            counters = dict(line.split(": ") for line in fd.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        # blocks of 512 bytes, local disks only
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        return sum(u.ru_inblock for u in usage) * 512, sum(u.ru_oublock for u in usage) * 512
+
+
+def memory_cgroup():
+    """
+    (memory.stat of this process's cgroup, its (anonymous, shared) memory counters), or None outside a cgroup.
+    Under slurm, the cgroup is the job step, with every process the step started.
+    """
+    try:
+        with open("/proc/self/cgroup") as fd:
+            lines = fd.read().splitlines()
+    except OSError:
+        return None
+    for line in lines:
+        _, controllers, path = line.split(":", 2)
+        if controllers == "":
+            stat_file, counters = f"/sys/fs/cgroup{path}/memory.stat", ("anon", "shmem")
+        elif "memory" in controllers.split(","):
+            stat_file, counters = f"/sys/fs/cgroup/memory{path}/memory.stat", ("total_rss", "total_shmem")
+        else:
+            continue
+        if os.path.exists(stat_file):
+            return stat_file, counters
+    return None
+
+
+def process_tree_kb(root_pid):
+    """
+    The RSS of a process and all of its descendants, from /proc.
+    """
+    children, rss = {}, {}
+    page_kb = os.sysconf("SC_PAGE_SIZE") // 1024
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as fd:
+                # the command, in parentheses, may have spaces
+                ppid = int(fd.read().rsplit(")", 1)[1].split()[1])
+            with open(f"/proc/{entry}/statm") as fd:
+                rss[int(entry)] = int(fd.read().split()[1]) * page_kb
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total, pids = 0, [root_pid]
+    while pids:
+        pid = pids.pop()
+        total += rss.get(pid, 0)
+        pids += children.get(pid, [])
+    return total
+
+
+class MemorySampler:
+    """
+    Samples the memory of the job's cgroup in a thread, from `start` until `stop`, or with `pid`, that of the
+    process tree of `pid`. `peak_kb` stays None where there is no memory cgroup.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_SECONDS, pid=None):
+        self.interval = interval
+        self.pid = pid
+        self.cgroup = None if pid else memory_cgroup()
+        self.peak_kb = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample(self):
+        if self.pid:
+            kb = process_tree_kb(self.pid)
+        else:
+            stat_file, counters = self.cgroup
+            try:
+                with open(stat_file) as fd:
+                    stat = dict(line.split() for line in fd.read().splitlines())
+            except (OSError, ValueError):
+                return
+            kb = sum(int(stat.get(name, 0)) for name in counters) // 1024
+        self.peak_kb = max(self.peak_kb or 0, kb)
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self._stopped.wait(self.interval):
+                return
+
+    def start(self):
+        if self.cgroup or self.pid:
+            self._thread.start()
+
+    def stop(self):
+        if self.cgroup or self.pid:
+            self._stopped.set()
+            self._thread.join()
+            # the process tree is gone by now
+            if not self.pid:
+                self.sample()
+
+
+def append_history(history_file, record, max_bytes=HISTORY_MAX_BYTES):
+    """
+    Append a record to TELEMETRY_HISTORY_FILE, first moving it to `<history_file>.1` if it is larger than
+    `max_bytes`. The jobs that append to it at the same time take turns on `<history_file>.lock`.
+    """
+    import fcntl
+
+    history_file = str(history_file)
+    os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+    with open(history_file + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(history_file) > max_bytes:
+                os.replace(history_file, history_file + ".1")
+        except FileNotFoundError:
+            pass
+        with open(history_file, "a") as fd:
+            fd.write(json.dumps(record) + "\n")
+
+
+def count_files(directory):
+    if not directory or not os.path.isdir(directory):
+        return None
+    return sum(len(files) for _, _, files in os.walk(directory))
+
+
+class Step:
+    """
+    Measures a step from its creation until `record`.
+    """
+
+    def __init__(self, telemetry_files, step, files_dir=None, labels=None, history_file=None):
+        self.telemetry_files = telemetry_files
+        self.history_file = history_file
+        self.step = step
+        self.files_dir = files_dir
+        self.labels = labels or {}
+        self.start = time.time()
+        self.cpu_start = self.cpu_seconds()
+        self.io_start = io_counters()
+
+    @staticmethod
+    def cpu_seconds():
+        usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        return sum(u.ru_utime for u in usage), sum(u.ru_stime for u in usage)
+
+    def record(self, returncode=None, job_mem_kb=None, timed_out=False):
+        """
+        `job_mem_kb` is the peak memory of the job's cgroup, or of the process tree of a packed session,
+        sampled by a MemorySampler, if any. `timed_out` is for a step stopped by slurm at its time limit.
+        """
+        user, system = self.cpu_seconds()
+        read, written = io_counters()
+        # kilobytes on linux
+        max_rss = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+        record = dict(
+            self.labels,
+            step=self.step,
+            host=socket.gethostname(),
+            job_id=os.environ.get("SLURM_JOB_ID"),
+            start=round(self.start, 3),
+            wall_seconds=round(time.time() - self.start, 3),
+            user_cpu_seconds=round(user - self.cpu_start[0], 3),
+            system_cpu_seconds=round(system - self.cpu_start[1], 3),
+            max_rss_kb=max_rss,
+            job_mem_kb=None if job_mem_kb is None else max(job_mem_kb, max_rss),
+            packed=bool(os.environ.get(PACKED_ENV)),
+            read_bytes=read - self.io_start[0],
+            write_bytes=written - self.io_start[1],
+            files=count_files(self.files_dir),
+            returncode=returncode,
+            timed_out=timed_out,
+        )
+        for telemetry_file in self.telemetry_files:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(telemetry_file)), exist_ok=True)
+                with open(telemetry_file, "a") as fd:
+                    fd.write(json.dumps(record) + "\n")
+            except OSError as e:
+                print(f"WARNING: Unable to write telemetry to {telemetry_file}: {e}")
+        if self.history_file:
+            try:
+                append_history(self.history_file, record)
+            except OSError as e:
+                print(f"WARNING: Unable to write telemetry to {self.history_file}: {e}")
+        return record
+
+
+def record_at_exit(telemetry_file, step, files_dir=None, labels=None, history_file=None):
+    """
+    Record the current python step when it exits, to `history_file` and to `telemetry_file`, unless the step
+    removed the directory of `telemetry_file`, as the check step does with CHECK_DATA_DIR when it succeeds.
+    """
+    measured = Step([], step, files_dir, labels, history_file)
+
+    def record():
+        if os.path.isdir(os.path.dirname(os.path.abspath(telemetry_file))):
+            measured.telemetry_files = [telemetry_file]
+        if measured.telemetry_files or history_file:
+            measured.record()
+
+    atexit.register(record)
+    return measured
+
+
+def run(cmd, telemetry_files, step, files_dir=None, labels=None, history_file=None):
+    """
+    Run a command as a step, and append its record to each of `telemetry_files` and to `history_file`.
+    SIGTERM, sent by slurm at the time limit, is passed on to the command, which gets TERMINATE_GRACE_SECONDS
+    to exit before the step is recorded as timed out.
+
+    Returns:
+        its return code
+    """
+    measured = Step(telemetry_files, step, files_dir, labels, history_file)
+    process = subprocess.Popen(cmd)
+    terminated = []
+
+    def terminate(signum, frame):
+        terminated.append(time.time())
+        process.send_signal(signum)
+
+    previous = signal.signal(signal.SIGTERM, terminate)
+    # a packed session shares the cgroup of the pack's allocation
+    sampler = MemorySampler(pid=process.pid if os.environ.get(PACKED_ENV) else None)
+    sampler.start()
+    try:
+        returncode = None
+        while returncode is None:
+            try:
+                returncode = process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                if terminated and time.time() - terminated[0] > TERMINATE_GRACE_SECONDS:
+                    returncode = -signal.SIGTERM
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+        sampler.stop()
+    measured.record(returncode, sampler.peak_kb, timed_out=bool(terminated))
+    return returncode
+
+
+def read_records(paths):
+    records = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = [
+                os.path.join(root, name)
+                for root, _, names in os.walk(path)
+                for name in names
+                if name.endswith(".telemetry.jsonl")
+            ]
+        else:
+            files = [path]
+        for filename in sorted(files):
+            with open(filename) as fd:
+                for line in fd:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+    return records
+
+
+def summarize(records, by=("pipeline", "project", "step")):
+    """
+    Returns:
+        {group: {"count": n, field: (median, max), ...}} for each group of `by` values
+    """
+    import statistics
+
+    groups = {}
+    for record in records:
+        values = dict(
+            wall_seconds=record["wall_seconds"],
+            cpu_seconds=record["user_cpu_seconds"] + record["system_cpu_seconds"],
+            max_rss_mb=record["max_rss_kb"] / 1024,
+            job_mem_mb=record["job_mem_kb"] / 1024 if record.get("job_mem_kb") is not None else None,
+            read_mb=record["read_bytes"] / 2 ** 20,
+            write_mb=record["write_bytes"] / 2 ** 20,
+            files=record.get("files"),
+        )
+        group = tuple(str(record.get(key)) for key in by)
+        groups.setdefault(group, []).append(values)
+
+    summary = {}
+    for group, rows in sorted(groups.items()):
+        summary[group] = {"count": len(rows)}
+        for field in SUMMARY_FIELDS:
+            numbers = [row[field] for row in rows if row[field] is not None]
+            summary[group][field] = (statistics.median(numbers), max(numbers)) if numbers else None
+    return summary
+
+
+def print_summary(summary, by):
+    header = [*by, "count", *(f"{field} (median/max)" for field in SUMMARY_FIELDS)]
+    print("\t".join(header))
+    for group, stats in summary.items():
+        cells = [*group, str(stats["count"])]
+        for field in SUMMARY_FIELDS:
+            cells.append(f"{stats[field][0]:.1f}/{stats[field][1]:.1f}" if stats[field] else "-")
+        print("\t".join(cells))
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Record and summarize the telemetry of the steps of jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Run a command and record its telemetry.")
+    run_parser.add_argument("--file", action="append", required=True, help="TELEMETRY_FILE, can be repeated.")
+    run_parser.add_argument("--history", help="TELEMETRY_HISTORY_FILE.")
+    run_parser.add_argument("--step", required=True)
+    run_parser.add_argument("--files", help="Count the files in this directory once the step is done.")
+    run_parser.add_argument("--label", action="append", default=[], help="KEY=VALUE added to the record.")
+    run_parser.add_argument("cmd", nargs=argparse.REMAINDER, help="-- followed by the command.")
+    summary_parser = subparsers.add_parser("summarize", help="Summarize telemetry files.")
+    summary_parser.add_argument("paths", nargs="+", help="Telemetry files, or directories to search for them.")
+    summary_parser.add_argument("--by", nargs="+", default=["pipeline", "project", "step"])
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    if args.command == "run":
+        cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+        labels = dict(label.split("=", 1) for label in args.label)
+        return run(cmd, args.file, args.step, args.files, labels, args.history)
+    print_summary(summarize(read_records(args.paths), args.by), args.by)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,5 +1,5 @@
 import shutil
-from collections import Iterable
+from collections.abc import Iterable
 from os import stat_result
 from pathlib import PosixPath, Path
 
@@ -20,14 +20,20 @@ class CachedPath(PosixPath):
 
 
 class VirtualFileSystem:
-    def __init__(self, method="symlink"):
+    def __init__(self, method="symlink", limiter=None):
+        """
+        Args:
+            limiter: the stats and links of the file system count against it, see metadata_limiter.py
+        """
         self.method = method
         self.mappings = {}
+        self.consume = limiter.consume if limiter else lambda operations=1: None
 
     def _add(self, src, dest_parent_dir, visited=None):
         if visited is None:
             visited = set()
         dest = dest_parent_dir / src.name
+        self.consume()
         if src.is_symlink():
             src = src.resolve().absolute()
 
@@ -35,6 +41,7 @@ class VirtualFileSystem:
             self.mappings[CachedPath(dest)] = CachedPath(src)
         elif src.is_dir() and src not in visited:
             visited.add(src)
+            self.consume()
             for src_item in src.iterdir():
                 self._add(src_item, dest, visited)
         else:
@@ -79,6 +86,7 @@ class VirtualFileSystem:
 
     def sync(self):
         for dest, src in self.mappings.items():
+            self.consume()
             if dest.exists():
                 if (
                     (dest.is_symlink() and dest.resolve() == src)
@@ -89,6 +97,7 @@ class VirtualFileSystem:
                     continue
                 # it exists, but isn't the same. Delete first.
                 dest.unlink()
+            self.consume(2)
             dest.parent.mkdir(parents=True, exist_ok=True)
             if self.method == "symlink":
                 dest.symlink_to(src)
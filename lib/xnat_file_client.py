@@ -1,23 +1,131 @@
+import hashlib
+import json
 import os
 import random
-from requests_toolbelt import MultipartEncoder
-import requests
+import tempfile
 import subprocess
 import time
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
 
-def make_zip_from_dir(dirpath):
-    zipped_file = os.path.basename(dirpath) + ".zip"
-    cmd = ["zip", "--recurse-paths", "--test", zipped_file, "."]
-    status = subprocess.call(cmd, cwd=dirpath)
-    if status == 0:
-        return os.path.join(dirpath, zipped_file)
-    else:
-        raise Exception("Unable to create zip using shell command.", cmd)
+from archive import write_archive
+
+# requests and requests_toolbelt are only imported where requests are sent: importing them takes longer
+# than most steps that never talk to XNAT, e.g. XNAT_CLEAN, spend doing their work.
+
+# Upper bound on the uncompressed size of a single zipped batch in a directory upload.
+UPLOAD_BATCH_BYTES = 2 * 1024 ** 3
+# Files up to this size are packed together by `upload_files_packed`.
+PACK_THRESHOLD_BYTES = 1024 ** 2
+
+
+def list_files(dirpath):
+    """
+    List (relative path, size, mtime) for every file below `dirpath`, in a stable order.
+    """
+    files = []
+    for root, dirs, filenames in os.walk(dirpath, followlinks=True):
+        dirs.sort()
+        for name in sorted(filenames):
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            files.append((os.path.relpath(path, dirpath), st.st_size, int(st.st_mtime)))
+    return files
+
+
+def plan_upload_batches(dirpath, batch_bytes=UPLOAD_BATCH_BYTES):
+    """
+    Split the files of a directory into batches that are zipped and uploaded independently.
+
+    A file larger than `batch_bytes` gets a batch of its own.
+    """
+    batches = []
+    current, current_size = [], 0
+    for entry in list_files(dirpath):
+        size = entry[1]
+        if current and current_size + size > batch_bytes:
+            batches.append(current)
+            current, current_size = [], 0
+        current.append(entry)
+        current_size += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+def batch_key(batch):
+    """
+    Fingerprint of a batch. Changes whenever a file in the batch is added, removed or modified.
+    """
+    digest = hashlib.sha1()
+    for relpath, size, mtime in batch:
+        digest.update(f"{relpath}\0{size}\0{mtime}\n".encode())
+    return digest.hexdigest()
+
+
+def make_zip_from_files(dirpath, relpaths, zip_path):
+    entries = [(os.path.join(dirpath, relpath), relpath) for relpath in relpaths]
+    return write_archive(zip_path, entries)
+
+
+def zip_batch(dirpath, batch):
+    """
+    Zip a batch of `plan_upload_batches` into a temporary file next to the directory.
+    """
+    fd, zip_path = tempfile.mkstemp(
+        suffix=".zip",
+        prefix=os.path.basename(os.path.normpath(dirpath)) + ".",
+        dir=os.path.dirname(os.path.normpath(dirpath)),
+    )
+    os.close(fd)
+    try:
+        return make_zip_from_files(dirpath, [entry[0] for entry in batch], zip_path)
+    except BaseException:
+        os.remove(zip_path)
+        raise
+
+
+class UploadCheckpoint:
+    """
+    On-disk record of the batches of a directory upload that the server has confirmed.
+
+    Re-running an interrupted upload skips the confirmed batches.
+    """
+
+    def __init__(self, path, resource_url):
+        self.path = path
+        self.resource_url = resource_url
+        self.confirmed = {}
+        if os.path.exists(path):
+            with open(path) as fd:
+                data = json.load(fd)
+            # a checkpoint for another destination is stale
+            if data.get("resource_url") == resource_url:
+                self.confirmed = data.get("confirmed", {})
+
+    def is_confirmed(self, key):
+        return key in self.confirmed
+
+    def confirm(self, key):
+        self.confirmed[key] = int(time.time())
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as fd:
+            json.dump({"resource_url": self.resource_url, "confirmed": self.confirmed}, fd)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def checkpoint_path(dirpath):
+    return os.path.normpath(dirpath) + ".upload_checkpoint.json"
 
 
 def ping(server):
+    import requests
+
     try:
         r = requests.get(server)
         return r.status_code == 200
@@ -60,7 +168,14 @@ class XnatFileClient:
         credentials_file=None,
         username=None,
         password=None,
+        server=None,
+        http=None,
     ):
+        """
+        `server` skips the search for a shadow server and `http` reuses the connection
+        pool of an existing `requests.Session`, so that one process can build clients
+        for many sessions cheaply (see running_status.py).
+        """
         if credentials_file:
             with open(credentials_file, "r") as fd:
                 cred = fd.read().strip()
@@ -70,8 +185,14 @@ class XnatFileClient:
                 "Either `credentials_file` needs to be specified or both `username` and `password`."
             )
         self.auth = (username, password)
+        if http is None:
+            import requests
 
-        server = get_server(serverlist)
+            http = requests.Session()
+        self.http = http
+
+        if server is None:
+            server = get_server(serverlist)
         self.server = server
         self.project = project
         self.subject = subject
@@ -82,31 +203,97 @@ class XnatFileClient:
         self.api_base = f"{api_base}/{sessionId}"
 
     def _put(self, url, filepath=None):
+        from requests_toolbelt import MultipartEncoder
+
         print(url, filepath)
         if filepath:
-            m = MultipartEncoder(
-                fields={"file": (os.path.basename(filepath), open(filepath, "rb"))}
-            )
-            return requests.put(
-                url, auth=self.auth, data=m, headers={"Content-Type": m.content_type}
-            )
+            with open(filepath, "rb") as fd:
+                m = MultipartEncoder(fields={"file": (os.path.basename(filepath), fd)})
+                return self.http.put(
+                    url, auth=self.auth, data=m, headers={"Content-Type": m.content_type}
+                )
         else:
-            return requests.put(url, auth=self.auth)
+            return self.http.put(url, auth=self.auth)
+
+    def _put_with_retries(self, url, filepath=None, attempts=3, retry_delay=10):
+        """
+        PUT, retrying on connection errors and server-side (5xx) failures with exponential backoff.
+        """
+        import requests
+
+        for i in range(attempts):
+            try:
+                r = self._put(url, filepath)
+                if r.status_code < 500:
+                    return r
+                print(f"Server error ({r.status_code}) on attempt #{i + 1}:", r.content)
+            except requests.exceptions.ConnectionError as e:
+                print(f"Connection error on attempt #{i + 1}:", e)
+                r = None
+            if i + 1 < attempts:
+                time.sleep(retry_delay * 2 ** i)
+        if r is None:
+            raise Exception(f"Upload failed {attempts} times.", url, filepath)
+        return r
+
+    def _upload_directory(self, url, dirpath, batch_bytes, attempts, retry_delay):
+        """
+        Upload a directory as a series of zipped batches, each extracted by the server.
+
+        Confirmed batches are recorded in a checkpoint file next to the directory,
+        so that re-running an interrupted upload resumes where it left off.
+        The next batch is zipped while one is uploaded.
+        """
+        checkpoint = UploadCheckpoint(checkpoint_path(dirpath), url)
+        batches = plan_upload_batches(dirpath, batch_bytes)
+        todo = []
+        for i, batch in enumerate(batches, start=1):
+            key = batch_key(batch)
+            if checkpoint.is_confirmed(key):
+                print(f"Batch {i}/{len(batches)} already uploaded, skipping.")
+            else:
+                todo.append((i, batch, key))
+
+        r = None
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            next_zip = pool.submit(zip_batch, dirpath, todo[0][1]) if todo else None
+            try:
+                for n, (i, batch, key) in enumerate(todo):
+                    zip_path = next_zip.result()
+                    next_zip = pool.submit(zip_batch, dirpath, todo[n + 1][1]) if n + 1 < len(todo) else None
+                    print(f"Uploading batch {i}/{len(batches)} ({len(batch)} files)")
+                    try:
+                        r = self._put_with_retries(url, zip_path, attempts, retry_delay)
+                    finally:
+                        os.remove(zip_path)
+
+                    if not r.ok:
+                        raise Exception(
+                            f"Upload of batch {i}/{len(batches)} was rejected.", url, r.status_code, r.content
+                        )
+                    checkpoint.confirm(key)
+            finally:
+                # the batch zipped ahead of a failed upload
+                if next_zip is not None and next_zip.exception() is None:
+                    os.remove(next_zip.result())
+
+        checkpoint.remove()
+        return r
 
     def _post(self, url):
         print("POST:", url)
-        return requests.post(url, auth=self.auth)
+        return self.http.post(url, auth=self.auth)
 
     def _delete(self, url):
         print("DELETE:", url)
-        return requests.delete(url, auth=self.auth)
+        return self.http.delete(url, auth=self.auth)
 
     def _get(self, url):
         print("GET:", url)
-        return requests.get(url, auth=self.auth)
+        return self.http.get(url, auth=self.auth)
 
     def __get_session_id(self, request_url, session):
-        response = requests.get(request_url, auth=self.auth)
+        response = self.http.get(request_url, auth=self.auth)
         if response.status_code != 200:
             raise Exception("Server response is not OK.", request_url, response.content)
 
@@ -123,6 +310,9 @@ class XnatFileClient:
         reason="Unspecified",
         use_http=True,
         resource_filepath=None,
+        batch_bytes=UPLOAD_BATCH_BYTES,
+        attempts=3,
+        retry_delay=10,
     ):
         if resource_filepath is None:
             resource_filepath = ""
@@ -132,21 +322,104 @@ class XnatFileClient:
 
         filepath = os.path.abspath(filepath)
         if use_http:
-            # if filepath is a directory, send as single zipped file
+            # if filepath is a directory, send as zipped batches that the server extracts
             if os.path.isdir(filepath):
                 resource_url += "&extract=true"
-                tmp_zip_file = make_zip_from_dir(filepath)
-                r = self._put(resource_url, tmp_zip_file)
-                os.remove(tmp_zip_file)
+                r = self._upload_directory(
+                    resource_url, filepath, batch_bytes, attempts, retry_delay
+                )
             else:
                 # otherwise send file directly
-                r = self._put(resource_url, filepath)
+                r = self._put_with_retries(resource_url, filepath, attempts, retry_delay)
         else:
             # if file is local to XNAT server, send file path as reference
             resource_url += "&reference=" + reference_path(filepath)
             r = self._put(resource_url)
         return r
 
+    def upload_resource_bytes(self, resource, resource_filepath, content, reason="Unspecified"):
+        """
+        Upload `content` as a single file of the resource, in a single request.
+        """
+        resource_url = f"{self.api_base}/resources/{resource}/files/{resource_filepath}"
+        resource_url += f"?overwrite=true&replace=true&event_reason={reason}"
+        print(resource_url)
+        from requests_toolbelt import MultipartEncoder
+
+        m = MultipartEncoder(fields={"file": (os.path.basename(resource_filepath), content)})
+        return self.http.put(
+            resource_url, auth=self.auth, data=m, headers={"Content-Type": m.content_type}
+        )
+
+    def upload_files_packed(
+        self,
+        resource,
+        files,
+        reason="Unspecified",
+        index_filepath=None,
+        threshold=PACK_THRESHOLD_BYTES,
+        attempts=3,
+        retry_delay=10,
+    ):
+        """
+        Upload several files to a resource using as few requests as possible.
+
+        Files no larger than `threshold` are packed into one archive that the server
+        extracts in a single request. Larger files are uploaded one by one.
+
+        Args:
+            resource: name of the resource
+            files: dict of {resource filepath: local filepath}
+            reason: event reason recorded by XNAT
+            index_filepath: if specified, the archive also contains a JSON index of
+                the packed files, extracted to this resource filepath
+            threshold: maximum size in bytes of a packed file
+
+        Returns:
+            list of responses
+        """
+        small = {}
+        responses = []
+        for resource_filepath, filepath in files.items():
+            if os.path.getsize(filepath) > threshold:
+                responses.append(
+                    self.upload_resource_filepath(
+                        resource, filepath, reason, resource_filepath=resource_filepath,
+                        attempts=attempts, retry_delay=retry_delay,
+                    )
+                )
+            else:
+                small[resource_filepath] = str(filepath)
+
+        if len(small) == 1 and index_filepath is None:
+            [(resource_filepath, filepath)] = small.items()
+            responses.append(
+                self.upload_resource_filepath(
+                    resource, filepath, reason, resource_filepath=resource_filepath,
+                    attempts=attempts, retry_delay=retry_delay,
+                )
+            )
+        elif small:
+            resource_url = f"{self.api_base}/resources/{resource}/files/"
+            resource_url += f"?overwrite=true&replace=true&event_reason={reason}&extract=true"
+            with tempfile.TemporaryDirectory(prefix="xnat_pack.") as tmp_dir:
+                entries = [(filepath, resource_filepath) for resource_filepath, filepath in small.items()]
+                if index_filepath is not None:
+                    index = [
+                        {"path": resource_filepath, "size": os.path.getsize(filepath)}
+                        for resource_filepath, filepath in small.items()
+                    ]
+                    index_path = os.path.join(tmp_dir, "index.json")
+                    with open(index_path, "w") as fd:
+                        json.dump({"files": index}, fd, indent=2)
+                    entries.append((index_path, index_filepath))
+                zip_path = write_archive(os.path.join(tmp_dir, "packed.zip"), entries, workers=1)
+                r = self._put_with_retries(resource_url, zip_path, attempts, retry_delay)
+            if not r.ok:
+                raise Exception("Upload of packed files was rejected.", resource_url, r.status_code, r.content)
+            responses.append(r)
+        return responses
+
     def remove_resource_filepath(self, resource, resource_filepath):
         resource_url = f"{self.api_base}/resources/{resource}/files/{resource_filepath}"
         return self._delete(resource_url)
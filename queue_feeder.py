@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+"""
+queue_feeder.py: Keep the slurm queue filled from a backlog of sessions.
+
+Our allocation caps the number of queued jobs, so large batches can't be
+submitted at once. Sessions are added to a SQLite ledger, and the feeder
+submits them while the user has fewer than --depth jobs in the queue:
+
+    python queue_feeder.py add MsmAllProcessing --subjects-file subjects.txt [--VAR=value ...]
+    python queue_feeder.py run --depth 400 --interval 300
+    python queue_feeder.py status
+
+Each session is generated with prunner when it is its turn, then submitted with
+its submit_jobs script. The ledger records the state of each session and the
+job ids of every attempt:
+
+* A session is submitted only from the `queued` state, and is not submitted
+  while the archive has a running status marker for it, so a session is never
+  running twice, even if it was also submitted by hand.
+* A session is `completed` once its XNAT_CHECK step uploaded the success file,
+  i.e. it is in the output resource in the archive, newer than the submission.
+* Failed submissions (e.g. sbatch timing out, or the submission limit being
+  reached) and jobs lost to the cluster (NODE_FAIL, PREEMPTED, BOOT_FAIL) are
+  requeued with an exponential backoff, up to --max-attempts. Sessions whose
+  jobs failed otherwise, e.g. FAILED or TIMEOUT, are `failed` and need a look.
+"""
+import argparse
+import getpass
+import json
+import os
+import re
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+import traceback
+
+from batch import Batch, read_subject_strings
+from prunner.util import convert_args_to_dict
+
+DEFAULT_LEDGER = os.path.expanduser("~/pipeline_runner_logs/queue_feeder.sqlite")
+DEFAULT_ARCHIVE_ROOT = "/ceph/intradb/archive"
+# slurm states of jobs that failed because of the cluster rather than the pipeline
+TRANSIENT_STATES = ("NODE_FAIL", "PREEMPTED", "BOOT_FAIL")
+# reason of jobs whose dependency failed, which slurm keeps pending forever
+DEPENDENCY_FAILED = "DependencyNeverSatisfied"
+SUBMITTED_JOB = re.compile(r"^>>\s+sbatch .*?(\S+)\nOutput: Submitted batch job (\d+)", re.MULTILINE)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    pipeline TEXT, subject_string TEXT, variables TEXT, state TEXT, attempts INTEGER,
+    next_attempt REAL, success_file TEXT, reason TEXT, updated REAL,
+    PRIMARY KEY (pipeline, subject_string)
+);
+CREATE INDEX IF NOT EXISTS sessions_state ON sessions (state, next_attempt);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY, pipeline TEXT, subject_string TEXT, attempt INTEGER, step TEXT, state TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_session ON jobs (pipeline, subject_string, attempt);
+"""
+
+
+def queued_jobs(user):
+    """
+    Number of jobs, counting each array task, that the user has in the queue.
+    """
+    output = subprocess.check_output(["squeue", "--noheader", "--array", "--user", user, "--format", "%i"])
+    return len(output.decode().split())
+
+
+def finished_job_states(job_ids):
+    """
+    {job_id: state} from the accounting database, for jobs that left the queue.
+    """
+    if not job_ids:
+        return {}
+    cmd = ["sacct", "--noheader", "--parsable2", "--allocations", "--format", "JobID,State", "--jobs", ",".join(job_ids)]
+    output = subprocess.check_output(cmd).decode()
+    states = {}
+    for line in output.splitlines():
+        if "|" in line:
+            job_id, state = line.split("|")[:2]
+            # e.g. "CANCELLED by 1234"
+            states[job_id] = state.split()[0]
+    return states
+
+
+def parse_submitted_jobs(output):
+    """
+    The (script, job id) of every job submitted by submit_jobs, from its output.
+    """
+    return SUBMITTED_JOB.findall(output)
+
+
+def marker_path(archive_root, subject_string, pipeline):
+    """
+    The running status marker of a session, see XNAT_MARK_RUNNING_STATUS.
+    """
+    project, subject, classifier, scan = subject_string.split(":")
+    session = f"{subject}_{classifier}"
+    _scan = f"_{scan}" if scan != "all" else ""
+    status_dir = os.path.join(archive_root, project, "arc001", session, "RESOURCES", "RunningStatus")
+    return os.path.join(status_dir, f"{pipeline}.{session}{_scan}.RUNNING")
+
+
+class Ledger:
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def add(self, pipeline, subject_strings, variables=None, requeue=False):
+        """
+        Args:
+            variables: {VAR: value} overrides used when generating the sessions
+
+        Returns:
+            number of sessions queued. Sessions already in the ledger are left alone, unless
+            `requeue`, in which case completed and failed ones are queued again.
+        """
+        variables = json.dumps(variables or {})
+        added = 0
+        for subject_string in subject_strings:
+            row = self.session(pipeline, subject_string)
+            if row is None:
+                self.db.execute(
+                    "INSERT INTO sessions VALUES (?, ?, ?, 'queued', 0, 0, NULL, NULL, ?)",
+                    (pipeline, subject_string, variables, time.time()),
+                )
+            elif requeue and row["state"] in ("completed", "failed"):
+                self.set_state(pipeline, subject_string, "queued", attempts=0, next_attempt=0, variables=variables)
+            else:
+                continue
+            added += 1
+        self.db.commit()
+        return added
+
+    def session(self, pipeline, subject_string):
+        return self.db.execute(
+            "SELECT * FROM sessions WHERE pipeline = ? AND subject_string = ?", (pipeline, subject_string)
+        ).fetchone()
+
+    def set_state(self, pipeline, subject_string, state, **columns):
+        columns.update(state=state, updated=time.time())
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        self.db.execute(
+            f"UPDATE sessions SET {assignments} WHERE pipeline = ? AND subject_string = ?",
+            (*columns.values(), pipeline, subject_string),
+        )
+        self.db.commit()
+
+    def sessions(self, state):
+        return self.db.execute(
+            "SELECT * FROM sessions WHERE state = ? ORDER BY next_attempt, rowid", (state,)
+        ).fetchall()
+
+    def record_jobs(self, pipeline, subject_string, attempt, jobs):
+        for step, job_id in jobs:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, 'SUBMITTED')",
+                (job_id, pipeline, subject_string, attempt, step),
+            )
+        self.db.commit()
+
+    def jobs(self, pipeline, subject_string, attempt):
+        return self.db.execute(
+            "SELECT * FROM jobs WHERE pipeline = ? AND subject_string = ? AND attempt = ? ORDER BY rowid",
+            (pipeline, subject_string, attempt),
+        ).fetchall()
+
+    def set_job_states(self, states):
+        self.db.executemany("UPDATE jobs SET state = ? WHERE job_id = ?", [(v, k) for k, v in states.items()])
+        self.db.commit()
+
+    def counts(self):
+        return {
+            row["state"]: row["n"]
+            for row in self.db.execute("SELECT state, COUNT(*) AS n FROM sessions GROUP BY state")
+        }
+
+
+class Feeder:
+    def __init__(self, ledger, variables, archive_root=DEFAULT_ARCHIVE_ROOT, user=None, depth=400,
+                 max_attempts=3, backoff=600):
+        self.ledger = ledger
+        self.variables = variables
+        self.archive_root = archive_root
+        self.user = user or getpass.getuser()
+        self.depth = depth
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        # pipeline -> Batch, so the configuration is loaded once
+        self.batches = {}
+
+    def retry_or_fail(self, row, reason):
+        if row["attempts"] >= self.max_attempts:
+            print(f"FAILED after {row['attempts']} attempts: {row['pipeline']} {row['subject_string']}: {reason}")
+            self.ledger.set_state(row["pipeline"], row["subject_string"], "failed", reason=reason)
+            return
+        delay = self.backoff * 2 ** (row["attempts"] - 1)
+        print(f"Retrying in {delay}s: {row['pipeline']} {row['subject_string']}: {reason}")
+        self.ledger.set_state(
+            row["pipeline"], row["subject_string"], "queued", next_attempt=time.time() + delay, reason=reason
+        )
+
+    def update(self):
+        """
+        Move the submitted sessions whose jobs all left the queue to completed, failed or back to queued.
+        """
+        output = subprocess.check_output(["squeue", "--noheader", "--user", self.user, "--format", "%i %r"])
+        reasons = dict(line.split(None, 1) for line in output.decode().splitlines() if line.strip())
+        for row in self.ledger.sessions("submitted"):
+            jobs = self.ledger.jobs(row["pipeline"], row["subject_string"], row["attempts"])
+            stuck = [job["job_id"] for job in jobs if reasons.get(job["job_id"], "").strip() == DEPENDENCY_FAILED]
+            if stuck:
+                # a step failed, the steps after it will never run
+                subprocess.run(["scancel"] + stuck)
+            if any(job["job_id"] in reasons and job["job_id"] not in stuck for job in jobs):
+                continue
+            # a success file older than the submission is from a previous run
+            if row["success_file"] and os.path.exists(row["success_file"]) \
+                    and os.path.getmtime(row["success_file"]) >= row["updated"]:
+                self.ledger.set_state(row["pipeline"], row["subject_string"], "completed", reason=None)
+                continue
+
+            states = finished_job_states([job["job_id"] for job in jobs])
+            self.ledger.set_job_states(states)
+            transient = [state for state in states.values() if state in TRANSIENT_STATES]
+            if transient:
+                self.retry_or_fail(row, f"jobs ended with {', '.join(sorted(set(transient)))}")
+            else:
+                failed = sorted({f"{job['step']}: {states.get(job['job_id'], 'UNKNOWN')}" for job in jobs
+                                 if states.get(job["job_id"]) != "COMPLETED"})
+                self.ledger.set_state(row["pipeline"], row["subject_string"], "failed", reason="; ".join(failed))
+
+    def batch(self, pipeline):
+        if pipeline not in self.batches:
+            variables = dict(self.variables, DEFAULT_PIPELINE=pipeline, AUTOLAUNCH_AT_END=False)
+            self.batches[pipeline] = Batch(pipeline, variables)
+            self.batches[pipeline].warm_up()
+        return self.batches[pipeline]
+
+    def submit(self, row):
+        """
+        Generate and submit a session.
+
+        Returns:
+            number of jobs submitted
+        """
+        pipeline, subject_string = row["pipeline"], row["subject_string"]
+        attempt = row["attempts"] + 1
+        self.ledger.set_state(pipeline, subject_string, "submitting", attempts=attempt)
+        row = self.ledger.session(pipeline, subject_string)
+        batch = self.batch(pipeline)
+        variables = dict(batch.variables, **json.loads(row["variables"]))
+        try:
+            result = batch.execute(subject_string, variables)
+        except Exception:
+            self.ledger.set_state(pipeline, subject_string, "failed", reason=traceback.format_exc(limit=1))
+            return 0
+
+        # CHECK_DATA_DIR is discarded after a successful check, the copy uploaded to the archive stays
+        success_file = os.path.join(
+            result["RESOURCES_ROOT"],
+            result["OUTPUT_RESOURCE_NAME"],
+            result["SESSION"],
+            "ProcessingInfo",
+            f"{result['SESSION']}.{result['PIPELINE_NAME']}.XNAT_CHECK.success",
+        )
+        cmd = [result["SUBMIT_TO_PBS_SCRIPT"], "--normal-start"]
+        try:
+            output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True).stdout.decode()
+        except subprocess.CalledProcessError as e:
+            # don't leave part of the chain behind, it would run again with the retry
+            jobs = parse_submitted_jobs(e.stdout.decode())
+            if jobs:
+                subprocess.run(["scancel"] + [job_id for _, job_id in jobs])
+            self.retry_or_fail(row, f"submission failed: {e.stdout.decode().strip().splitlines()[-1:]}")
+            return 0
+
+        jobs = [(os.path.basename(script), job_id) for script, job_id in parse_submitted_jobs(output)]
+        self.ledger.record_jobs(pipeline, subject_string, attempt, jobs)
+        self.ledger.set_state(pipeline, subject_string, "submitted", success_file=success_file, reason=None)
+        print(f"Submitted {pipeline} {subject_string}: {' '.join(job_id for _, job_id in jobs)}")
+        return len(jobs)
+
+    def feed(self, now=None):
+        """
+        Submit queued sessions until the queue is `depth` jobs deep.
+
+        Returns:
+            number of sessions submitted
+        """
+        now = time.time() if now is None else now
+        # sessions interrupted in the middle of a submission, e.g. by a restart, may have
+        # jobs that weren't recorded: resubmitting them could run them twice
+        for row in self.ledger.sessions("submitting"):
+            self.ledger.set_state(
+                row["pipeline"], row["subject_string"], "failed", reason="interrupted while submitting, check squeue"
+            )
+
+        self.update()
+        depth = queued_jobs(self.user)
+        submitted = 0
+        for row in self.ledger.sessions("queued"):
+            if depth >= self.depth:
+                break
+            if row["next_attempt"] > now:
+                continue
+            if os.path.exists(marker_path(self.archive_root, row["subject_string"], row["pipeline"])):
+                # submitted by someone else, or still running from a previous attempt
+                continue
+            depth += self.submit(row)
+            submitted += 1
+        return submitted
+
+    def run(self, interval, once=False):
+        while True:
+            start = time.time()
+            submitted = self.feed()
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} submitted {submitted} sessions, {self.ledger.counts()}")
+            if once:
+                return
+            time.sleep(max(0, interval - (time.time() - start)))
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Keep the slurm queue filled from a ledger of sessions.")
+    parser.add_argument("--ledger", default=DEFAULT_LEDGER, help="SQLite database of sessions and jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add = subparsers.add_parser("add", help="Queue sessions. Other --VAR=value are used when generating them.")
+    add.add_argument("PIPELINE")
+    add.add_argument("SUBJECTS", nargs="*", help="Subject strings, project:subject:classifier:extra")
+    add.add_argument("--subjects-file", help="File with one subject string per line.")
+    add.add_argument("--requeue", action="store_true", help="Queue again sessions that completed or failed.")
+
+    run = subparsers.add_parser("run", help="Submit queued sessions as the queue drains.")
+    run.add_argument("--config", "-c", help="The configuration directory to use. Default is $PWD.")
+    run.add_argument("--depth", type=int, default=400, help="Jobs to keep in the queue.")
+    run.add_argument("--interval", type=int, default=300, help="Seconds between checks of the queue.")
+    run.add_argument("--max-attempts", type=int, default=3)
+    run.add_argument("--backoff", type=int, default=600, help="Seconds before the first retry, doubled each time.")
+    run.add_argument("--archive-root", default=DEFAULT_ARCHIVE_ROOT)
+    run.add_argument("--user", help="Slurm user. Default is the current user.")
+    run.add_argument("--once", action="store_true", help="Check and feed the queue once, e.g. from cron.")
+
+    status = subparsers.add_parser("status", help="Count the sessions in each state, list the failed ones.")
+    status.add_argument("--failed", action="store_true", help="List the failed sessions and why.")
+    return parser.parse_known_args(args)
+
+
+def main(args=None):
+    args, rest = parse_arguments(args)
+    ledger = Ledger(args.ledger)
+
+    if args.command == "add":
+        subject_strings = list(args.SUBJECTS)
+        if args.subjects_file:
+            subject_strings += read_subject_strings(args.subjects_file)
+        variables = {k: v for k, v in convert_args_to_dict(rest).items() if not (k.startswith("_") and k[1:].isdigit())}
+        added = ledger.add(args.PIPELINE, subject_strings, variables, args.requeue)
+        print(f"Queued {added} of {len(subject_strings)} sessions of {args.PIPELINE}.")
+        return 0
+    if rest:
+        print(f"Unrecognized arguments: {' '.join(rest)}")
+        return 2
+
+    if args.command == "status":
+        for state, count in sorted(ledger.counts().items()):
+            print(f"{state:>10}: {count}")
+        if args.failed:
+            for row in ledger.sessions("failed"):
+                print(f"{row['pipeline']} {row['subject_string']} ({row['attempts']} attempts): {row['reason']}")
+        return 0
+
+    config_dir = os.path.abspath(args.config) if args.config else os.getcwd()
+    variables = {f"ENV_{k}": v for k, v in os.environ.items()}
+    variables.update(PRUNNER_CONFIG_DIR=config_dir, DRYRUN=False, VERBOSE=False)
+    feeder = Feeder(ledger, variables, args.archive_root, args.user, args.depth, args.max_attempts, args.backoff)
+    # the ledger is committed after every change, so stopping between two checks loses nothing
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    feeder.run(args.interval, args.once)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+"""
+render_regression.py: Check that changes to the code don't change the generated scripts.
+
+Every pipeline of pipelines.yaml is rendered, in dry-run mode, for each project
+of a fixed matrix, with deterministic variables (TIMESTAMP, PUT_SERVER, USER,
+HOME) and a fixture archive providing the preprocessed BOLD resources. The
+rendered files are hashed and compared with the baseline stored in
+tests/render_baseline.json. Only the files that differ are printed.
+
+    python render_regression.py                   # compare with the baseline
+    python render_regression.py --write-dir /tmp/rendered && meld originals/ /tmp/rendered/
+    python render_regression.py --update          # accept the current output as the baseline
+
+Compiled templates are cached in --cache-dir between runs.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+from jinja2 import FileSystemBytecodeCache
+from prunner.tasks import STANDARD_TASKS
+from prunner.tasks.call_function import FunctionTask
+from prunner.tasks.generate_file import GenerateFileTask
+
+from batch import Batch, BatchFunctionTask
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(CONFIG_DIR, "tests", "render_baseline.json")
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/hcp-pipelines/templates")
+PRODUCTION_ARCHIVE_ROOT = "/ceph/intradb/archive"
+
+VARIABLES = {
+    "ENV_USER": "regression",
+    "ENV_HOME": "/home/regression",
+    "TIMESTAMP": "999",
+    "PUT_SERVER": "https://fake-server.nrg.wustl.edu",
+    "DRYRUN": True,
+    "VERBOSE": False,
+}
+
+# variables that a pipeline expects from the command line
+PIPELINE_VARIABLES = {
+    "StructuralPreprocessingHandEdit": {"PIPELINE_ARGS": "-autorecon2-wm -autorecon3"},
+}
+
+# project -> (subject, classifier, bold list order in bold_lists.yaml, extra used by bold list pipelines)
+PROJECTS = {
+    "CCF_HCA_STG": ("HCA0123456789", "V1_MR", "hca", "all"),
+    "CCF_HCD_STG": ("HCD0123456789", "V1_MR", "hcd_8_and_up", "OLDER"),
+    "CCF_BANDA_STG": ("BANDA001", "MR", "banda", "all"),
+    "CCF_MDD_STG": ("MDD0123456789", "MR", "mdd", "all"),
+    "CCF_ECP_STG": ("ECP0123456789", "MR", "ecp", "all"),
+}
+
+# pipelines whose extra component is the BOLD list, a BOLD scan or a task
+BOLD_LIST_PIPELINES = (
+    "MultiRunIcaFixProcessing",
+    "MsmAllProcessing",
+    "PatchProcessing",
+    "ReapplyFixProcessing",
+    "TicaProcessing",
+    "AutoRecleanProcessing",
+)
+BOLD_SCAN_PIPELINES = ("FunctionalPreprocessing",)
+TASK_PIPELINES = ("TaskAnalysisProcessing",)
+
+
+class CapturingGenerateFileTask(GenerateFileTask):
+    """
+    Renders templates into `outputs` instead of writing them.
+    """
+
+    outputs = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(f"{settings['PRUNNER_CONFIG_DIR']}/templates")
+
+    def execute(self, params, variables=None):
+        template = self.loader.get_template(params["template"])
+        filepath = os.path.abspath(params["filepath"])
+        self.outputs[os.path.basename(filepath)] = template.render(**variables)
+        return {params.get("variable", "OUTPUT_FILE"): filepath}
+
+
+def bold_scans(bold_list_order):
+    with open(os.path.join(CONFIG_DIR, "bold_lists.yaml")) as fd:
+        return yaml.safe_load(fd)[bold_list_order]["BOLD_LIST_ORDER"]
+
+
+def make_fixture_archive(archive_root):
+    """
+    A `<scan>_preproc` resource for every BOLD of each project's session.
+    """
+    for project, (subject, classifier, bold_list_order, _) in PROJECTS.items():
+        resources = os.path.join(archive_root, project, "arc001", f"{subject}_{classifier}", "RESOURCES")
+        for scan in bold_scans(bold_list_order):
+            os.makedirs(os.path.join(resources, f"{scan}_preproc"), exist_ok=True)
+
+
+def subject_string(pipeline, project):
+    subject, classifier, bold_list_order, bold_list_extra = PROJECTS[project]
+    extra = "all"
+    if pipeline in BOLD_LIST_PIPELINES:
+        extra = bold_list_extra
+    elif pipeline in BOLD_SCAN_PIPELINES:
+        extra = bold_scans(bold_list_order)[0]
+    elif pipeline in TASK_PIPELINES:
+        task_scans = [x for x in bold_scans(bold_list_order) if x.startswith("tfMRI_")]
+        extra = task_scans[0].split("_")[1]
+    return f"{project}:{subject}:{classifier}:{extra}"
+
+
+def all_pipelines():
+    with open(os.path.join(CONFIG_DIR, "pipelines.yaml")) as fd:
+        return list(yaml.safe_load(fd))
+
+
+# per worker process: pipeline -> Batch
+_batches = {}
+_settings = {}
+
+
+def render_case(case):
+    """
+    Returns:
+        (case, {filename: rendered text}, error or None)
+    """
+    pipeline, project = case
+    if pipeline not in _batches:
+        tasks = [
+            {FunctionTask: BatchFunctionTask, GenerateFileTask: CapturingGenerateFileTask}.get(task, task)
+            for task in STANDARD_TASKS
+        ]
+        variables = dict(_settings["variables"], **PIPELINE_VARIABLES.get(pipeline, {}))
+        batch = Batch(pipeline, variables, tasks)
+        env = batch.shared.get_task("generate_file").loader.env
+        if _settings["cache_dir"]:
+            env.bytecode_cache = FileSystemBytecodeCache(_settings["cache_dir"])
+        batch.warm_up()
+        _batches[pipeline] = batch
+    batch = _batches[pipeline]
+
+    CapturingGenerateFileTask.outputs = {}
+    archive_root = _settings["variables"]["ARCHIVE_ROOT"]
+    # RESOURCES_ROOT is expanded with the ARCHIVE_ROOT of variables.yaml, it has to point at the fixture itself
+    subject, classifier, _, _ = PROJECTS[project]
+    resources_root = os.path.join(archive_root, project, "arc001", f"{subject}_{classifier}", "RESOURCES")
+    variables = dict(batch.variables, RESOURCES_ROOT=resources_root)
+    _, error, output = batch.run_session(subject_string(pipeline, project), variables)
+    outputs = {
+        filename: text.replace(archive_root, PRODUCTION_ARCHIVE_ROOT)
+        for filename, text in CapturingGenerateFileTask.outputs.items()
+    }
+    return f"{pipeline}/{project}", outputs, error
+
+
+def render_all(pipelines, projects, workers, cache_dir):
+    """
+    Returns:
+        {case: {filename: rendered text}}, {case: error}
+    """
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix="render_regression.") as archive_root:
+        make_fixture_archive(archive_root)
+        # the batches of a previous call were warmed up with another fixture archive
+        _batches.clear()
+        _settings.update(
+            cache_dir=cache_dir,
+            variables=dict(VARIABLES, PRUNNER_CONFIG_DIR=CONFIG_DIR, ARCHIVE_ROOT=archive_root),
+        )
+        cases = [(pipeline, project) for pipeline in pipelines for project in projects]
+        if workers > 1:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                results = pool.map(render_case, cases)
+        else:
+            results = [render_case(case) for case in cases]
+    rendered = {case: outputs for case, outputs, error in results if not error}
+    errors = {case: error for case, outputs, error in results if error}
+    return rendered, errors
+
+
+def hash_outputs(rendered):
+    return {
+        case: {filename: hashlib.sha256(text.encode()).hexdigest() for filename, text in sorted(outputs.items())}
+        for case, outputs in sorted(rendered.items())
+    }
+
+
+def compare(baseline, current):
+    """
+    Returns:
+        list of (status, "case/filename") for every file that is not identical
+    """
+    differences = []
+    for case in sorted(set(baseline) | set(current)):
+        old, new = baseline.get(case, {}), current.get(case, {})
+        for filename in sorted(set(old) | set(new)):
+            if filename not in new:
+                differences.append(("removed", f"{case}/{filename}"))
+            elif filename not in old:
+                differences.append(("added", f"{case}/{filename}"))
+            elif old[filename] != new[filename]:
+                differences.append(("changed", f"{case}/{filename}"))
+    return differences
+
+
+def write_rendered(rendered, write_dir):
+    for case, outputs in rendered.items():
+        case_dir = os.path.join(write_dir, case)
+        os.makedirs(case_dir, exist_ok=True)
+        for filename, text in outputs.items():
+            with open(os.path.join(case_dir, filename), "w") as fd:
+                fd.write(text)
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Render every pipeline and compare with the baseline.")
+    parser.add_argument("--pipelines", nargs="+", help="Default is every pipeline in pipelines.yaml.")
+    parser.add_argument("--projects", nargs="+", choices=sorted(PROJECTS), default=list(PROJECTS))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Compiled template cache. '' to disable.")
+    parser.add_argument("--write-dir", help="Also write the rendered files to this directory.")
+    parser.add_argument("--update", action="store_true", help="Store the current output as the baseline.")
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_arguments(args)
+    start = time.time()
+    pipelines = args.pipelines or all_pipelines()
+    rendered, errors = render_all(pipelines, args.projects, args.workers, args.cache_dir)
+    current = hash_outputs(rendered)
+    if args.write_dir:
+        write_rendered(rendered, args.write_dir)
+
+    for case, error in sorted(errors.items()):
+        print(f"ERROR: {case}\n{error}")
+
+    stored = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fd:
+            stored = json.load(fd)
+
+    if args.update:
+        if errors:
+            print("Not updating the baseline, some cases failed to render.")
+            return 1
+        stored.update(current)
+        with open(args.baseline, "w") as fd:
+            json.dump(stored, fd, indent=1, sort_keys=True)
+            fd.write("\n")
+        print(f"Stored {sum(len(x) for x in current.values())} hashes of {len(current)} cases in {args.baseline}")
+        return 0
+
+    # only compare what was rendered this time
+    cases = {f"{pipeline}/{project}" for pipeline in pipelines for project in args.projects}
+    baseline = {case: hashes for case, hashes in stored.items() if case in cases}
+    differences = compare(baseline, current)
+    for status, path in differences:
+        print(f"{status:>8}: {path}")
+    print(
+        f"{len(cases)} cases, {sum(len(x) for x in current.values())} files rendered in "
+        f"{time.time() - start:.1f}s: {len(differences)} differ from the baseline, {len(errors)} failed."
+    )
+    return 1 if differences or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+"""
+scheduler.py: Run all the pipelines a subject needs, each as soon as its inputs are ready.
+
+Which pipeline depends on which is derived from the configuration: the inputs
+of a pipeline are the `resources.get_*()` calls in its XNAT_GET template (see
+lib/get_data.py), and a pipeline produces the OUTPUT_RESOURCE_NAME of its
+section in variables.yaml. The inputs listed in the OPTIONAL_INPUTS of its
+section are copied when the session has them, e.g. Diffusion_preproc for the
+functional pipelines: they don't make it wait for the pipeline producing them.
+FunctionalPreprocessing runs once per fMRI scan and TaskAnalysisProcessing once
+per task.
+
+    python scheduler.py plan MsmAllProcessing BedpostxPreprocessing --subject CCF_HCA_STG:HCA0123456789:V1_MR
+    python scheduler.py submit MsmAllProcessing BedpostxPreprocessing --subject CCF_HCA_STG:HCA0123456789:V1_MR
+    python scheduler.py status ~/pipeline_runner_logs/scheduler/HCA0123456789_V1_MR.<timestamp>.json
+
+Upstream pipelines whose output is already in the archive are not run again.
+Pipelines whose inputs are available are generated and submitted right away,
+independently of each other, e.g. every FunctionalPreprocessing scan and
+DiffusionPreprocessing. Every other pipeline is generated later, by a small
+slurm job that waits for the jobs of its upstream pipelines: scripts like
+MultiRunIcaFix's depend on which upstream outputs exist in the archive. That
+job checks that the upstream outputs were actually archived, then generates and
+submits the pipeline, and in turn schedules what depends on it. The state of
+the graph is kept in a JSON file.
+"""
+import argparse
+import ast
+import contextlib
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from fnmatch import fnmatch
+from pathlib import Path
+
+import yaml
+
+from batch import Batch
+
+CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_STATE_DIR = os.path.expanduser("~/pipeline_runner_logs/scheduler")
+DEFAULT_ARCHIVE_ROOT = "/ceph/intradb/archive"
+
+GET_CALL = re.compile(r"resources\.(get_\w+)\(")
+# pipelines that run once per scan, and how to list the values of their SCAN
+PER_SCAN_PIPELINES = {
+    "FunctionalPreprocessing": "scans",
+    "TaskAnalysisProcessing": "tasks",
+}
+# a representative value of ${SCAN} when matching resource names
+EXAMPLE_SCAN = "rfMRI_SCAN"
+LAUNCHER_SBATCH_OPTIONS = ["--account=hcp", "--partition=tier2_cpu", "--time=1:00:00", "--mem=4000"]
+
+
+def resource_patterns(get_data_file):
+    """
+    {get_* method of PipelineResources: resource glob it links or mirrors}
+    """
+    tree = ast.parse(Path(get_data_file).read_text())
+    patterns = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name.startswith("get_"):
+            for call in ast.walk(node):
+                if isinstance(call, ast.Call) and call.args and isinstance(call.args[0], ast.Constant):
+                    patterns[node.name] = call.args[0].value
+                    break
+    return patterns
+
+
+def produces(output, pattern):
+    """
+    Does a pipeline that archives `output` provide the resources matched by `pattern`?
+    """
+    return fnmatch(output.replace("${SCAN}", EXAMPLE_SCAN), pattern.split("/")[0])
+
+
+class PipelineGraph:
+    def __init__(self, pipelines):
+        """
+        Args:
+            pipelines: {pipeline name: {"output": resource name, "inputs": [resource globs],
+                                        "optional_inputs": [resource globs]}}
+        """
+        self.pipelines = pipelines
+
+    @classmethod
+    def from_config(cls, config_dir=CONFIG_DIR):
+        with open(os.path.join(config_dir, "pipelines.yaml")) as fd:
+            pipeline_steps = yaml.safe_load(fd)
+        with open(os.path.join(config_dir, "variables.yaml")) as fd:
+            variables = yaml.safe_load(fd)
+        patterns = resource_patterns(os.path.join(config_dir, "lib", "get_data.py"))
+
+        pipelines = {}
+        for name, steps in pipeline_steps.items():
+            sections = [step["load_variables"] for step in steps if "#" not in step.get("load_variables", "#")]
+            templates = [
+                step["generate_file"]["template"]
+                for step in steps
+                if "XNAT_GET" in step.get("generate_file", {}).get("template", "")
+            ]
+            output = variables[sections[0]]["OUTPUT_RESOURCE_NAME"]
+            optional = variables[sections[0]].get("OPTIONAL_INPUTS", [])
+            text = Path(config_dir, "templates", templates[0]).read_text()
+            inputs = [patterns[method] for method in GET_CALL.findall(text) if method in patterns]
+            pipelines[name] = dict(
+                output=output,
+                inputs=[x for x in inputs if x not in optional],
+                optional_inputs=[x for x in inputs if x in optional],
+            )
+        return cls(pipelines)
+
+    def upstream(self, name):
+        """
+        Pipelines producing the required inputs of `name`.
+        """
+        result = []
+        for pattern in self.pipelines[name]["inputs"]:
+            for other, pipeline in self.pipelines.items():
+                if other != name and other not in result and produces(pipeline["output"], pattern):
+                    result.append(other)
+        return result
+
+
+def scan_values(pipeline, resources_root):
+    """
+    The values of SCAN of a per-scan pipeline, from the unprocessed fMRI resources of the session.
+    """
+    scans = sorted(p.name[: -len("_unproc")] for p in Path(resources_root).glob("*fMRI*_unproc"))
+    if PER_SCAN_PIPELINES[pipeline] == "tasks":
+        return sorted({scan.split("_")[1] for scan in scans if scan.startswith("tfMRI_")})
+    return scans
+
+
+def is_complete(resources_root, graph, pipeline, session, scan=""):
+    """
+    Whether the output of the pipeline is in the archive, with the success file of its XNAT_CHECK step.
+    """
+    resource = graph.pipelines[pipeline]["output"].replace("${SCAN}", scan)
+    success = Path(resources_root, resource, session, "ProcessingInfo", f"{session}.{pipeline}.XNAT_CHECK.success")
+    return success.exists()
+
+
+def plan(graph, targets, session, extra, resources_root, force=False):
+    """
+    The nodes needed to run `targets` for a session.
+
+    Returns:
+        {node id: {"pipeline", "extra", "parents": [node ids], "status": "pending" or "done"}}
+    """
+    nodes = {}
+    visiting = set()
+
+    def add(pipeline, is_target):
+        if pipeline in visiting:
+            raise Exception("The pipelines depend on each other in a cycle.", pipeline)
+        ids = [node_id for node_id, node in nodes.items() if node["pipeline"] == pipeline]
+        if ids:
+            return ids
+        visiting.add(pipeline)
+
+        values = scan_values(pipeline, resources_root) if pipeline in PER_SCAN_PIPELINES else [extra]
+        for value in values:
+            node_id = f"{pipeline}:{value}" if pipeline in PER_SCAN_PIPELINES else pipeline
+            scan = value if pipeline in PER_SCAN_PIPELINES else ""
+            done = is_complete(resources_root, graph, pipeline, session, scan) and not (force and is_target)
+            nodes[node_id] = dict(pipeline=pipeline, extra=value, parents=[], status="done" if done else "pending")
+            ids.append(node_id)
+
+        pending = [node_id for node_id in ids if nodes[node_id]["status"] == "pending"]
+        if pending:
+            for upstream in graph.upstream(pipeline):
+                upstream_ids = add(upstream, False)
+                for node_id in pending:
+                    nodes[node_id]["parents"] += [x for x in upstream_ids if nodes[x]["status"] != "done"]
+        visiting.discard(pipeline)
+        return ids
+
+    for target in targets:
+        if target not in graph.pipelines:
+            raise ValueError("Unknown pipeline: ", target)
+        add(target, True)
+    return nodes
+
+
+def topological_order(nodes):
+    order, seen = [], set()
+
+    def visit(node_id):
+        if node_id not in seen:
+            seen.add(node_id)
+            for parent in nodes[node_id]["parents"]:
+                visit(parent)
+            order.append(node_id)
+
+    for node_id in nodes:
+        visit(node_id)
+    return order
+
+
+@contextlib.contextmanager
+def locked_state(state_path):
+    """
+    Read, then write back, the state. Launchers of sibling pipelines may run at the same time.
+    """
+    with open(f"{state_path}.lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        with open(state_path) as fd:
+            state = json.load(fd)
+        yield state
+        with open(f"{state_path}.tmp", "w") as fd:
+            json.dump(state, fd, indent=1)
+        os.replace(f"{state_path}.tmp", state_path)
+
+
+def sbatch(cmd, dry_run=False):
+    print(">> ", " ".join(cmd))
+    if dry_run:
+        return "<job_id>"
+    return subprocess.check_output(cmd).decode().strip().split(";")[0]
+
+
+def generate_and_submit(state, node):
+    """
+    Generate the scripts of a node with prunner and submit them.
+
+    Returns:
+        the job id of the last step
+    """
+    variables = {f"ENV_{k}": v for k, v in os.environ.items()}
+    variables.update(state["variables"])
+    variables.update(
+        PRUNNER_CONFIG_DIR=state["config_dir"],
+        DRYRUN=state["dry_run"],
+        VERBOSE=False,
+        DEFAULT_PIPELINE=node["pipeline"],
+        AUTOLAUNCH_AT_END=False,
+    )
+    subject_string = f"{state['project']}:{state['subject']}:{state['classifier']}:{node['extra']}"
+    result = Batch(node["pipeline"], variables).execute(subject_string)
+    cmd = [result["SUBMIT_TO_PBS_SCRIPT"], "--normal-start"]
+    if state["dry_run"]:
+        print(">> ", " ".join(cmd))
+        return "<job_id>"
+    output = subprocess.check_output(cmd).decode()
+    print(output)
+    for line in output.splitlines():
+        if line.startswith("Last step job id:"):
+            return line.split(":", 1)[1].strip()
+    raise Exception("Unable to find the job id in the output of", cmd)
+
+
+def fail(state, node_id, reason):
+    """
+    Mark a node, and everything that depends on it, as failed.
+    """
+    nodes = state["nodes"]
+    nodes[node_id].update(status="failed", reason=reason)
+    for child_id, child in nodes.items():
+        if node_id in child["parents"] and child["status"] in ("pending", "waiting"):
+            fail(state, child_id, f"{node_id} failed")
+
+
+def launch(state, state_path, node_id):
+    """
+    Generate and submit a node whose parents have finished, then schedule its children.
+    """
+    nodes = state["nodes"]
+    node = nodes[node_id]
+    resources_root = state["resources_root"]
+    session = f"{state['subject']}_{state['classifier']}"
+    for parent_id in node["parents"]:
+        parent = nodes[parent_id]
+        if parent["status"] == "submitted":
+            scan = parent["extra"] if parent["pipeline"] in PER_SCAN_PIPELINES else ""
+            graph = PipelineGraph(state["graph"])
+            done = state["dry_run"] or is_complete(resources_root, graph, parent["pipeline"], session, scan)
+            if done:
+                parent["status"] = "done"
+            else:
+                fail(state, parent_id, "its output was not archived")
+    if any(nodes[parent_id]["status"] == "failed" for parent_id in node["parents"]):
+        fail(state, node_id, "an upstream pipeline failed")
+        return
+
+    print(f"Launching {node_id}")
+    try:
+        node["job"] = generate_and_submit(state, node)
+    except Exception as e:
+        fail(state, node_id, f"{type(e).__name__}: {e}")
+        return
+    node.update(status="submitted", submitted=int(time.time()))
+    schedule_children(state, state_path, node_id)
+
+
+def schedule_children(state, state_path, node_id):
+    nodes = state["nodes"]
+    for child_id in topological_order(nodes):
+        child = nodes[child_id]
+        if node_id not in child["parents"] or child["status"] != "pending":
+            continue
+        parents = [nodes[parent_id] for parent_id in child["parents"]]
+        if not all(parent["status"] in ("submitted", "done") for parent in parents):
+            # the last parent to be submitted schedules it
+            continue
+        jobs = [parent["job"] for parent in parents if parent["status"] == "submitted"]
+        if not jobs:
+            launch(state, state_path, child_id)
+            continue
+        wrap = f"cd {state['config_dir']} && {sys.executable} scheduler.py continue {state_path} {child_id}"
+        cmd = ["sbatch", "--parsable", f"--dependency=afterany:{':'.join(jobs)}"]
+        cmd += [f"--job-name={state['subject']}_{state['classifier']}.{child_id}.schedule"]
+        cmd += LAUNCHER_SBATCH_OPTIONS
+        cmd += [f"--output={state_path}.{child_id.replace(':', '.')}.log", f"--wrap={wrap}"]
+        child.update(status="waiting", launcher=sbatch(cmd, state["dry_run"]))
+
+
+def submit(state, state_path):
+    with open(state_path, "w") as fd:
+        json.dump(state, fd, indent=1)
+    with locked_state(state_path) as state:
+        for node_id in topological_order(state["nodes"]):
+            node = state["nodes"][node_id]
+            if node["status"] == "pending" and not node["parents"]:
+                launch(state, state_path, node_id)
+    return state
+
+
+def resume(state_path, node_id):
+    with locked_state(state_path) as state:
+        if state["nodes"][node_id]["status"] == "waiting":
+            launch(state, state_path, node_id)
+        status = state["nodes"][node_id]["status"]
+    return 0 if status in ("submitted", "done") else 1
+
+
+def print_nodes(nodes):
+    for node_id in topological_order(nodes):
+        node = nodes[node_id]
+        details = [node["status"]]
+        if node.get("job"):
+            details.append(f"job {node['job']}")
+        if node.get("launcher") and node["status"] == "waiting":
+            details.append(f"launcher {node['launcher']}")
+        if node.get("reason"):
+            details.append(node["reason"])
+        after = f" after {', '.join(node['parents'])}" if node["parents"] else ""
+        print(f"{node_id:<45} {' | '.join(details)}{after}")
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(description="Run the pipelines of a subject in dependency order.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name in ("plan", "submit"):
+        sub = subparsers.add_parser(name)
+        sub.add_argument("targets", nargs="+", help="Pipelines to run, with their upstream pipelines.")
+        sub.add_argument("--subject", required=True, help="project:subject:classifier[:extra]")
+        sub.add_argument("--archive-root", default=DEFAULT_ARCHIVE_ROOT)
+        sub.add_argument("--force", action="store_true", help="Rerun the targets even if they are complete.")
+        if name == "submit":
+            sub.add_argument("--state-dir", default=DEFAULT_STATE_DIR)
+            sub.add_argument("--dryrun", "-n", action="store_true", help="Generate in dry-run mode, don't submit.")
+    sub = subparsers.add_parser("status")
+    sub.add_argument("state")
+    sub = subparsers.add_parser("continue", help="Run by the slurm job scheduled for a pipeline.")
+    sub.add_argument("state")
+    sub.add_argument("node")
+    parsed, rest = parser.parse_known_args(args)
+    overrides = {}
+    for arg in rest:
+        match = re.match("--([a-zA-Z0-9_]+)(?:=(.+))?", arg)
+        if not match:
+            parser.error(f"unrecognized argument: {arg}")
+        overrides[match.group(1)] = match.group(2) or ""
+    return parsed, overrides
+
+
+def main(args=None):
+    args, overrides = parse_arguments(args)
+    # paths in pipelines.yaml, e.g. bold_lists.yaml, are relative to the config dir
+    os.chdir(CONFIG_DIR)
+
+    if args.command == "status":
+        with open(args.state) as fd:
+            print_nodes(json.load(fd)["nodes"])
+        return 0
+    if args.command == "continue":
+        return resume(os.path.abspath(args.state), args.node)
+
+    components = args.subject.split(":")
+    if len(components) not in (3, 4):
+        raise ValueError("Expecting the subject in the format project:subject:classifier[:extra]", args.subject)
+    project, subject, classifier = components[:3]
+    extra = components[3] if len(components) == 4 else "all"
+    session = f"{subject}_{classifier}"
+    resources_root = os.path.join(args.archive_root, project, "arc001", session, "RESOURCES")
+
+    graph = PipelineGraph.from_config(CONFIG_DIR)
+    nodes = plan(graph, args.targets, session, extra, resources_root, args.force)
+    if args.command == "plan":
+        print_nodes(nodes)
+        return 0
+
+    os.makedirs(args.state_dir, exist_ok=True)
+    state_path = os.path.join(args.state_dir, f"{session}.{int(time.time())}.json")
+    state = dict(
+        config_dir=CONFIG_DIR,
+        project=project,
+        subject=subject,
+        classifier=classifier,
+        resources_root=resources_root,
+        dry_run=args.dryrun,
+        variables=overrides,
+        graph=graph.pipelines,
+        nodes=nodes,
+    )
+    state = submit(state, state_path)
+    print_nodes(state["nodes"])
+    print(f"State: {state_path}")
+    return 1 if any(node["status"] == "failed" for node in state["nodes"].values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
 
 from shared_values import (
     get_xnat_client,
@@ -18,8 +17,12 @@ from shared_values import (
     RESOURCES_ROOT,
     WORKING_DIR,
     CLEAN_DATA_DIR,
+    TRASH_DIR,
+    TELEMETRY_FILE,
+    PROFILE_JOBS,
 )
 from check import is_processing_complete
+from reaper import discard
 
 client = get_xnat_client()
 script_name = f"{PIPELINE_NAME}.XNAT_CHECK"
@@ -40,23 +43,18 @@ check_cmd_ret_code = is_processing_complete(
 )
 print("Everything OK? ", check_cmd_ret_code)
 
+uploads = {f"{dest_dir}/{log_filename}": log_filepath}
+# the records of the steps up to put, the one of this step is only written when it exits
+if TELEMETRY_FILE.exists():
+    uploads[f"{dest_dir}/{TELEMETRY_FILE.name}"] = TELEMETRY_FILE
+if PROFILE_JOBS:
+    # the put step's profile is written after it copied CHECK_DATA_DIR
+    for profile in sorted(CHECK_DATA_DIR.glob("*.prof")) + sorted(CHECK_DATA_DIR.glob("*.profile.txt")):
+        uploads[f"{dest_dir}/{profile.name}"] = profile
 if check_cmd_ret_code:
     print("Completion Check was successful")
     success_filepath.write_text("Completion Check was successful")
-    client.upload_resource_filepath(
-        OUTPUT_RESOURCE_NAME,
-        success_filepath,
-        resource_filepath=f"{dest_dir}/{success_filename}",
-    )
-
-    # Delete original data only after successful check
-    # otherwise, don't delete original directories for troubleshooting
-    print("Removing working_dir: ", str(WORKING_DIR))
-    subprocess.call(["rm", "-rf", str(WORKING_DIR)])
-
-    print("Removing clean_data_dir: ", str(CLEAN_DATA_DIR))
-    subprocess.call(["rm", "-rf", str(CLEAN_DATA_DIR)])
-
+    uploads[f"{dest_dir}/{success_filename}"] = success_filepath
 else:
     print("Completion Check was unsuccessful")
     if os.path.exists(success_filename):
@@ -66,13 +64,24 @@ else:
         OUTPUT_RESOURCE_NAME, f"{dest_dir}/{success_filename}"
     )
 
-client.upload_resource_filepath(
+# Small files are sent as one archive that is extracted server-side, with an index of what it held.
+client.upload_files_packed(
     OUTPUT_RESOURCE_NAME,
-    str(log_filepath),
-    resource_filepath=f"{dest_dir}/{log_filename}",
+    uploads,
+    reason=script_name,
+    index_filepath=f"{dest_dir}/{subject}_{classifier}.{script_name}.packed_index.json",
 )
 
 if check_cmd_ret_code:
+    # Delete original data only after successful check
+    # otherwise, don't delete original directories for troubleshooting
+    # They are moved to TRASH_DIR, the reaper removes them once the job is done, see reaper.py
+    print("Removing working_dir: ", str(WORKING_DIR))
+    discard(WORKING_DIR, TRASH_DIR)
+
+    print("Removing clean_data_dir: ", str(CLEAN_DATA_DIR))
+    discard(CLEAN_DATA_DIR, TRASH_DIR)
+
     # Clean up last remaining directory after successful run
-    print("Removing check_data_dir: ", str(CLEAN_DATA_DIR))
-    subprocess.call(["rm", "-rf", str(CHECK_DATA_DIR)])
+    print("Removing check_data_dir: ", str(CHECK_DATA_DIR))
+    discard(CHECK_DATA_DIR, TRASH_DIR)
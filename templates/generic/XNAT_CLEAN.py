@@ -1,9 +1,9 @@
 import sys
 
-from shared_values import WORKING_DIR, CLEAN_DATA_DIR, session
+from shared_values import WORKING_DIR, CLEAN_DATA_DIR, session, get_metadata_limiter
 from virtual_fs import VirtualFileSystem
 
-fs = VirtualFileSystem()
+fs = VirtualFileSystem(limiter=get_metadata_limiter())
 
 print("Copy the processing output.")
 processing_output = WORKING_DIR / session / "sessions" / session / "hcp" / session
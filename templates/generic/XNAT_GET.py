@@ -11,11 +11,18 @@ from shared_values import (
     session,
     WORKING_DIR,
     CHECK_DATA_DIR,
+    get_metadata_limiter,
+    get_shared_staging,
     print_system_info,
 )
 from get_data import PipelineResources, link_directory
 
 print_system_info()
+limiter = get_metadata_limiter()
+staging = get_shared_staging()
+if staging:
+    # released by the marker step (mark_complete.jinja2), whether or not the steps succeeded
+    staging.acquire()
 tmp_dir = WORKING_DIR / "tmp"
 tmp_dir.mkdir(parents=True, exist_ok=True)
 session_dir = WORKING_DIR / session
@@ -26,6 +33,8 @@ resources = PipelineResources(
     session,
     log=False,
     output_dir=tmp_dir,
+    limiter=limiter,
+    staging=staging,
 )
 
 print("Getting Data...")
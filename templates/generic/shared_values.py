@@ -1,6 +1,5 @@
-import subprocess
-
 # Import path modification
+import os
 import sys
 from pathlib import Path
 
@@ -8,7 +7,8 @@ sys.path.append("{{ PYTHON_IMPORT_DIR }}")
 
 # Path modification (above) must occur before
 # these imports below. Otherwise, you'll get a "ModuleNotFoundError".
-from xnat_file_client import XnatFileClient
+# xnat_file_client is imported by get_xnat_client, only the steps that talk to XNAT pay for it.
+from telemetry import record_at_exit
 
 OUTPUT_RESOURCE_NAME = "{{ OUTPUT_RESOURCE_NAME }}"
 PIPELINE_NAME = "{{ PIPELINE_NAME }}"
@@ -16,6 +16,7 @@ RESOURCES_ROOT = Path("{{ RESOURCES_ROOT }}")
 CHECK_DATA_DIR = Path("{{ CHECK_DATA_DIR }}")
 WORKING_DIR = Path("{{ WORKING_DIR }}")
 CLEAN_DATA_DIR = Path("{{ CLEAN_DATA_DIR }}")
+TRASH_DIR = Path("{{ TRASH_DIR }}")
 EXPECTED_FILES_LIST = Path("{{ EXPECTED_FILES_LIST }}")
 
 serverlist = "{{ PUT_SERVER_LIST }}"
@@ -27,12 +28,56 @@ session = "{{ SESSION }}"
 credentials_file = "{{ XNAT_CREDENTIALS_FILE }}"
 g_scan = "{{ _SCAN }}"
 CLOBBER_RESOURCE = {{ CLOBBER_RESOURCE }}
+TELEMETRY_FILE = Path("{{ TELEMETRY_FILE }}")
+TELEMETRY_HISTORY_FILE = Path("{{ TELEMETRY_HISTORY_FILE }}")
+PROFILE_JOBS = {{ PROFILE_JOBS }}
+SHARED_INPUTS_DIR = "{{ SHARED_INPUTS_DIR if SHARE_SESSION_INPUTS else '' }}"
+
+# step of each python script, and the directory whose files are counted when it is done
+TELEMETRY_STEPS = {
+    "{{ SCRIPTNAME_GET }}.py": ("get", WORKING_DIR),
+    "{{ SCRIPTNAME_CLEAN }}.py": ("clean", CLEAN_DATA_DIR),
+    "{{ SCRIPTNAME_PUT }}.py": ("put", CLEAN_DATA_DIR),
+    "{{ SCRIPTNAME_CHECK }}.py": ("check", None),
+}
 
 
 def get_xnat_client():
+    from xnat_file_client import XnatFileClient
+
     return XnatFileClient(project, subject, session, serverlist, credentials_file)
 
 
+def get_metadata_limiter():
+    from metadata_limiter import MetadataLimiter, stagger
+
+    stagger({{ START_JITTER_SECONDS }})
+    return MetadataLimiter({{ METADATA_OPS_PER_SECOND }}, "{{ METADATA_BUDGET_FILE }}")
+
+
+def get_shared_staging():
+    if not SHARED_INPUTS_DIR:
+        return None
+    from shared_staging import SharedStaging
+
+    return SharedStaging(SHARED_INPUTS_DIR, "{{ DIR_PREFIX }}", str(TRASH_DIR))
+
+
+def telemetry_labels():
+    return dict(
+        project=project, subject=subject, session=session, scan=extra, pipeline=PIPELINE_NAME, timestamp="{{ TIMESTAMP }}"
+    )
+
+
+if Path(sys.argv[0]).name in TELEMETRY_STEPS:
+    step, files_dir = TELEMETRY_STEPS[Path(sys.argv[0]).name]
+    record_at_exit(TELEMETRY_FILE, step, files_dir, telemetry_labels(), TELEMETRY_HISTORY_FILE)
+    if PROFILE_JOBS:
+        from profiling import profile_at_exit
+
+        profile_at_exit(CHECK_DATA_DIR, Path(sys.argv[0]).stem, {{ PROFILE_TOP_N }})
+
+
 def print_system_info():
-    platform = subprocess.check_output(["uname", "-a"]).decode()
+    platform = " ".join(os.uname())
     print(f" Platform:   {platform}")
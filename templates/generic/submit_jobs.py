@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import argparse
+import json
+import os
 import subprocess
+import time
 
 
 def shell(cmd, dry_run=False):
@@ -40,25 +43,108 @@ def slurm_chain(script, prior_job=None, dependency='afterok', dry_run=False):
     return job_id
 
 
-def main(start_index, end_index, do_marker=True, dry_run=False, prior_job=None):
+def record_job(step, job_id, dry_run=False):
+    """
+    Append the job to the job records file, used by running_registry.py to
+    match running status markers with slurm jobs.
+    """
+    if dry_run:
+        return
+    record = dict(
+        job_id=job_id,
+        step=step,
+        project="{{ PROJECT }}",
+        subject="{{ SUBJECT }}",
+        session="{{ SESSION }}",
+        scan="{{ SCAN }}",
+        pipeline="{{ PIPELINE_NAME }}",
+        check_data_dir="{{ CHECK_DATA_DIR }}",
+        submitted=int(time.time()),
+    )
+    try:
+        os.makedirs(os.path.dirname(job_records_file), exist_ok=True)
+        with open(job_records_file, "a") as fd:
+            fd.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"WARNING: Unable to record job {job_id} in {job_records_file}: {e}")
+
+
+def queue_reaper(prior_job, dry_run=False):
+    """
+    Queue a reaper to empty TRASH_DIR after `prior_job`, see lib/reaper.py, unless one is already pending.
+    The jobs are already submitted: a reaper that can't be queued is only reported.
+    """
+    try:
+        pending = shell(['squeue', '--noheader', '--name=reaper', '--user={{ USER }}', '--states=PENDING',
+                         '--format=%i'], dry_run)
+        if pending and not dry_run:
+            print(f"A reaper is already pending: {pending.split()[0]}")
+            return
+        shell(['{{ PYTHON }}', '{{ PYTHON_IMPORT_DIR }}/reaper.py', 'submit', '{{ TRASH_DIR }}',
+               f'--dependency=afterany:{prior_job}'], dry_run)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"WARNING: Unable to queue a reaper for {{ TRASH_DIR }}: {e}")
+
+
+def add_to_manifest(manifest, steps, do_marker=True, dry_run=False):
+    """
+    Instead of submitting the jobs, append them to a manifest. The jobs of all the
+    sessions in the manifest are then submitted as slurm job arrays by lib/slurm_array.py.
+    """
+    record = dict(
+        project="{{ PROJECT }}",
+        subject="{{ SUBJECT }}",
+        session="{{ SESSION }}",
+        scan="{{ SCAN }}",
+        pipeline="{{ PIPELINE_NAME }}",
+        check_data_dir="{{ CHECK_DATA_DIR }}",
+        job_records_file=job_records_file,
+        trash_dir="{{ TRASH_DIR }}",
+        steps=[[step, scripts[step]] for step in steps],
+        marker=scripts['marker'] if do_marker else None,
+        subject_string="{{ _1 }}",
+        serverlist="{{ PUT_SERVER_LIST }}",
+        credentials_file="{{ XNAT_CREDENTIALS_FILE }}",
+    )
+    print(f"Adding {len(steps)} step(s) to the manifest {manifest}")
+    if dry_run:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(manifest)), exist_ok=True)
+    # a single write, so that sessions generated in parallel don't interleave
+    with open(manifest, "a") as fd:
+        fd.write(json.dumps(record) + "\n")
+
+
+def main(start_index, end_index, do_marker=True, dry_run=False, prior_job=None, manifest=None):
     """
     Set up the slurm job chain.
     """
+    if manifest:
+        # the sessions of the manifest are marked as queued together, see lib/slurm_array.py
+        add_to_manifest(manifest, choices[start_index:end_index + 1], do_marker, dry_run)
+        return None
+
     if do_marker:
         print('Creating "Running Status Marker" file to indicate that jobs are queued.')
         shell([scripts['marker'], '--status=queued'], dry_run)
 
     for step in choices[start_index:end_index + 1]:
         prior_job = slurm_chain(scripts[step], prior_job, 'afterok', dry_run)
+        record_job(step, prior_job, dry_run)
+    print(f"Last step job id: {prior_job}")
 
     if do_marker:
         print('Adding slurm job to remove "Running Status Marker" file to indicate that jobs are no longer queued.')
         prior_job = slurm_chain(scripts['marker'], prior_job, 'afterany', dry_run)
+        record_job('marker', prior_job, dry_run)
 
+    # the jobs discard their directories into TRASH_DIR
+    queue_reaper(prior_job, dry_run)
     return prior_job
 
 
 breakpoint = "{{ BREAKPOINT }}"
+job_records_file = "{{ JOB_RECORDS_FILE }}"
 if (breakpoint == 'run_all'):
     choices = ['run_all']
     scripts = dict(
@@ -69,6 +155,7 @@ if (breakpoint == 'run_all'):
                         help='Do not submit jobs, just print commands that would run.')
     parser.add_argument('--show-breakpoint', '-b', action='store_true', help='Show the `BREAKPOINT` value.')
     parser.add_argument('--normal-start', '-a', action='store_true', help='Go from `start` til `BREAKPOINT`.')
+    parser.add_argument('--manifest', help='Add the jobs to this manifest instead of submitting them.')
 else: 
     choices = ['get', 'process', 'clean', 'put', 'check']
     scripts = dict(
@@ -88,6 +175,7 @@ else:
     parser.add_argument('--normal-start', '-a', action='store_true', help='Go from `start` til `BREAKPOINT`.')
     parser.add_argument('--resume', '-r', action='store_true', help='Continue from step after the `BREAKPOINT` til end.')
     parser.add_argument('--skip-marker', '-m', action='store_true', help='Do not add, then remove, a status marker on IntraDB.')
+    parser.add_argument('--manifest', help='Add the jobs to this manifest instead of submitting them.')
  
 
 
@@ -105,6 +193,7 @@ if __name__ == "__main__":
             do_marker=False,
             dry_run=args.dry_run,
             prior_job=None,
+            manifest=args.manifest,
         )
         exit(0)
 
@@ -124,5 +213,6 @@ if __name__ == "__main__":
         do_marker=not args.skip_marker,
         dry_run=args.dry_run,
         prior_job=None,
+        manifest=args.manifest,
     )
     print(f"Last job id: \n{job_id}")
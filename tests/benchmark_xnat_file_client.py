@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+benchmark_xnat_file_client.py: Measure XnatFileClient against a local FakeXnat server.
+
+Reports throughput and tail latency of `upload_resource_filepath`, `delete_resource`
+and `get_server` for directory shapes that resemble what the pipelines upload.
+
+Run from the root of the repo:
+
+    python -m tests.benchmark_xnat_file_client --repeat 5 --latency 0.02 --bandwidth 100
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "lib"))
+
+from tests.fake_xnat import FakeXnat  # noqa: E402
+from xnat_file_client import XnatFileClient, get_server  # noqa: E402
+
+PROJECT = "CCF_HCA_STG"
+SUBJECT = "HCA0123456789"
+SESSION = "HCA0123456789_V1_MR"
+MB = 1024 ** 2
+
+# name -> list of (relative path, size in bytes, compressible)
+SHAPES = {
+    # RunningStatus marker: a single tiny file
+    "marker": [("HcpPipeline.HCA0123456789_V1_MR.RUNNING", 16, True)],
+    # ProcessingInfo: many small text logs
+    "processing_info": [
+        (f"ProcessingInfo/processing/logs/comlogs/done_step{i:03d}.log", 4 * 1024 + 97 * i, True)
+        for i in range(200)
+    ],
+    # a handful of large, already-compressed NIfTI volumes
+    "nifti": [(f"MNINonLinear/Results/rfMRI_REST{i}/rfMRI_REST{i}.nii.gz", 16 * MB, False) for i in range(6)],
+    # a CinaB style tree mixing deep directories, text and binary files
+    "cinab": [
+        (
+            f"T1w/{SESSION}/surf/{hemi}.file{i:03d}" if i % 3 else f"MNINonLinear/xfms/file{i:03d}.txt",
+            (64 * 1024 if i % 3 else 2 * 1024),
+            i % 3 == 0,
+        )
+        for i in range(600)
+        for hemi in ["lh", "rh"][: 1 + (i % 2)]
+    ],
+}
+
+
+def make_shape(root, shape, scale=1.0):
+    total = 0
+    for relpath, size, compressible in SHAPES[shape]:
+        size = max(1, int(size * scale))
+        path = Path(root) / relpath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if compressible:
+            line = f"{relpath} line of log output\n".encode()
+            content = (line * (size // len(line) + 1))[:size]
+        else:
+            content = os.urandom(size)
+        path.write_bytes(content)
+        total += size
+    return total
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def report(name, timings, nbytes=0, nfiles=0):
+    total = sum(timings)
+    row = [
+        f"{name:<38}",
+        f"n={len(timings):<3}",
+        f"p50={statistics.median(timings) * 1000:9.1f}ms",
+        f"p95={percentile(timings, 95) * 1000:9.1f}ms",
+        f"p99={percentile(timings, 99) * 1000:9.1f}ms",
+        f"max={max(timings) * 1000:9.1f}ms",
+    ]
+    if nbytes:
+        row.append(f"{nbytes * len(timings) / total / MB:8.1f} MB/s")
+    if nfiles:
+        row.append(f"{nfiles * len(timings) / total:8.1f} files/s")
+    print("  ".join(row))
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def run(args):
+    workspace = Path(tempfile.mkdtemp(prefix="xnat_benchmark."))
+    servers = [FakeXnat(workspace / "archive", args.latency, args.bandwidth, args.error_rate, seed=0)]
+    servers += [FakeXnat(workspace / "archive") for _ in range(args.down_servers)]
+    for server in servers:
+        server.add_session(PROJECT, SUBJECT, SESSION)
+        server.start()
+    for server in servers[1:]:
+        server.down = True
+    serverlist = " ".join(server.url for server in servers)
+    xnat = servers[0]
+
+    try:
+        client = XnatFileClient(PROJECT, SUBJECT, SESSION, xnat.url, username="user", password="pass")
+        resources_root = Path(xnat.resources_root(PROJECT, SESSION))
+        print(f"Workspace: {workspace}")
+
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            results = []
+            try:
+                results.append(("get_server", timed(lambda: get_server(serverlist), args.repeat), 0, 0))
+                for shape in args.shapes:
+                    source = workspace / "source" / shape
+                    nbytes = make_shape(source, shape, args.scale)
+                    nfiles = len(SHAPES[shape])
+                    resource = f"Benchmark_{shape}"
+
+                    def upload_http():
+                        client.upload_resource_filepath(resource, source, retry_delay=0)
+
+                    def upload_reference():
+                        client.upload_resource_filepath(resource, source, use_http=False)
+
+                    def delete():
+                        upload_reference()
+                        client.delete_resource(resource, resources_root)
+
+                    results.append((f"upload http        [{shape}]", timed(upload_http, args.repeat), nbytes, nfiles))
+                    results.append((f"upload reference   [{shape}]", timed(upload_reference, args.repeat), nbytes, nfiles))
+                    results.append((f"upload + delete    [{shape}]", timed(delete, args.repeat), 0, nfiles))
+            finally:
+                sys.stdout = stdout
+
+        for result in results:
+            report(*result)
+        failures = [x for x in xnat.requests if x["status"] >= 400]
+        print(f"Requests: {len(xnat.requests)}, failed: {len(failures)}")
+    finally:
+        for server in servers:
+            server.stop()
+        shutil.rmtree(workspace, ignore_errors=True)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark XnatFileClient against a local fake XNAT server.")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions of each operation.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency added to every request.")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Upload bandwidth limit in MB/s.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500.")
+    parser.add_argument("--down-servers", type=int, default=0, help="Number of extra servers that are down.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplier applied to every file size.")
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=sorted(SHAPES))
+    parsed = parser.parse_args(args)
+    if parsed.bandwidth:
+        parsed.bandwidth *= MB
+    return parsed
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# lib/ modules are imported as top-level modules by the generated scripts,
+# (see PYTHON_IMPORT_DIR), so make them importable the same way in the tests.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "lib"))
@@ -0,0 +1,89 @@
+"""
+fake_slurm.py: Local stand-ins for the slurm commands (sbatch, squeue, ...) the code under test runs,
+and for the sessions of a manifest they submit.
+
+Each fake is a small bash script in `<tmp_path>/bin`, which is put first on the
+PATH of the test with `monkeypatch`.
+"""
+import os
+
+SESSION_HEADER = """#!/bin/bash
+#SBATCH --job-name="{name}.999"
+#SBATCH --nodes=1 --ntasks-per-node={cpus}
+{directives}#SBATCH --time={hours}:00:00 --mem={mem}
+#SBATCH --output="{dir}/{name}.%j.stdout"
+#SBATCH --error="{dir}/{name}.%j.stderr"
+"""
+
+
+def fake_commands(tmp_path, monkeypatch, **scripts):
+    """
+    Put a command named after each keyword, running the bash script given as its value, first on the PATH.
+
+    Returns:
+        the directory of the commands
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    for name, script in scripts.items():
+        (bin_dir / name).write_text(f"#!/bin/bash\n{script}\n")
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    return bin_dir
+
+
+def fake_sbatch(tmp_path, monkeypatch):
+    """
+    An sbatch that logs its arguments, one submission per line, and prints job ids from 1001 on, as with --parsable.
+
+    Returns:
+        the log
+    """
+    fake_commands(
+        tmp_path,
+        monkeypatch,
+        sbatch=f'echo "$@" >> {tmp_path}/sbatch.log\necho $((1000 + $(wc -l < {tmp_path}/sbatch.log)))',
+    )
+    return tmp_path / "sbatch.log"
+
+
+def make_session(tmp_path, session, pipeline="MsmAllProcessing", steps=("get", "process"), marker=True, cpus=1,
+                 mem=4000, hours=4, directives=(), exit_code=0):
+    """
+    A session of a manifest (see add_to_manifest in submit_jobs.py), with a script per step in `<tmp_path>/<session>`.
+    Each script echoes its step and session to `<step>.<job id>.stdout`, and exits with `exit_code`.
+
+    Args:
+        mem: --mem of the scripts, e.g. 4000 or "8G"
+        directives: more #SBATCH options of the scripts, e.g. ("--tmp=20G",)
+    """
+    session_dir = tmp_path / session
+    session_dir.mkdir()
+    record = dict(
+        project="CCF_HCA_STG",
+        subject=session.split("_")[0],
+        session=session,
+        scan="",
+        pipeline=pipeline,
+        check_data_dir=str(session_dir),
+        job_records_file=str(tmp_path / "jobs.jsonl"),
+        steps=[],
+        marker=None,
+    )
+    for step in steps + (("marker",) if marker else ()):
+        script = session_dir / f"{step}.sh"
+        header = SESSION_HEADER.format(
+            name=step,
+            dir=session_dir,
+            cpus=cpus,
+            hours=hours,
+            mem=mem,
+            directives="".join(f"#SBATCH {option}\n" for option in directives),
+        )
+        script.write_text(header + f"echo {step} {session}\nexit {exit_code}\n")
+        script.chmod(0o770)
+        if step == "marker":
+            record["marker"] = str(script)
+        else:
+            record["steps"].append([step, str(script)])
+    return record
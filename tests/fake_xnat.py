@@ -0,0 +1,298 @@
+"""
+fake_xnat.py: A local stand-in for the subset of the XNAT REST API used by XnatFileClient.
+
+Files are stored under `archive_root` using the same layout as the real archive,
+`<archive_root>/<project>/arc001/<session>/RESOURCES/<resource>/...`, so code that
+inspects RESOURCES_ROOT directly (e.g. `delete_resource`) behaves as in production.
+
+Latency, bandwidth, error injection and a "server down" mode can be configured
+on a running server to exercise the client's failure handling.
+"""
+import io
+import json
+import os
+import random
+import shutil
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+
+class FakeXnat:
+    def __init__(
+        self,
+        archive_root,
+        latency=0.0,
+        bandwidth=None,
+        error_rate=0.0,
+        seed=None,
+    ):
+        """
+        Args:
+            archive_root: directory in which resources are stored
+            latency: seconds to wait before answering each request
+            bandwidth: maximum bytes/second at which request bodies are received
+            error_rate: probability that a request is answered with a 500
+            seed: seed for the error injection
+        """
+        self.archive_root = str(archive_root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.down = False
+        self.requests = []
+        self._random = random.Random(seed)
+        self._forced_errors = []
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+
+    # configuration
+
+    def add_session(self, project, subject, label, session_id=None):
+        with self._lock:
+            sessions = self._sessions.setdefault((project, subject), [])
+            if session_id is None:
+                session_id = f"XNAT_E{len(self._sessions) * 1000 + len(sessions):05d}"
+            sessions.append({"label": label, "ID": session_id, "project": project})
+        return session_id
+
+    def fail_next(self, count=1, status=500):
+        """
+        Answer the next `count` requests (that are not pings) with `status`.
+        """
+        with self._lock:
+            self._forced_errors.extend([status] * count)
+
+    def resources_root(self, project, label):
+        return os.path.join(self.archive_root, project, "arc001", label, "RESOURCES")
+
+    # lifecycle
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"xnat": self})
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, kwargs=dict(poll_interval=0.05), daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # helpers for the handler
+
+    def _next_error(self):
+        with self._lock:
+            if self._forced_errors:
+                return self._forced_errors.pop(0)
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 500
+        return None
+
+    def _find_session(self, project, subject, session_id):
+        for item in self._sessions.get((project, subject), []):
+            if item["ID"] == session_id:
+                return item
+        return None
+
+    def _record(self, method, path, status, nbytes, started):
+        with self._lock:
+            self.requests.append(
+                dict(
+                    method=method,
+                    path=path,
+                    status=status,
+                    bytes=nbytes,
+                    duration=time.monotonic() - started,
+                )
+            )
+
+
+class _Handler(BaseHTTPRequestHandler):
+    xnat = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    # request plumbing
+
+    def _handle(self, method):
+        started = time.monotonic()
+        if self.xnat.down:
+            # HAProxy abruptly terminates the connection when a server is down
+            self.close_connection = True
+            self.connection.shutdown(2)
+            return
+
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self._read_body()
+
+        if self.xnat.latency:
+            time.sleep(self.xnat.latency)
+
+        status = None if path == "/" else self.xnat._next_error()
+        if status is not None:
+            response = (status, b"Injected failure")
+        else:
+            response = self._route(method, path, query, body)
+        # record before answering, so the client never sees a response that is not yet recorded
+        self.xnat._record(method, path, response[0], len(body), started)
+        self._send(*response)
+
+    def _read_body(self):
+        remaining = int(self.headers.get("Content-Length") or 0)
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+            if self.xnat.bandwidth:
+                time.sleep(len(chunk) / self.xnat.bandwidth)
+        return b"".join(chunks)
+
+    def _respond(self, status, content=b"", content_type="text/plain"):
+        return status, content, content_type
+
+    def _send(self, status, content=b"", content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    # routing
+
+    def _route(self, method, path, query, body):
+        if path == "/":
+            return self._respond(200, b"XNAT")
+        if path == "/data/services/refresh/catalog" and method == "POST":
+            return self._respond(200)
+
+        parts = path.strip("/").split("/")
+        # REST/projects/<p>/subjects/<s>/experiments[/<id>/resources/<r>[/files/<path>]]
+        if parts[:1] != ["REST"] or len(parts) < 6 or parts[1] != "projects" or parts[3] != "subjects":
+            return self._respond(404, b"Unknown endpoint")
+        project, subject = parts[2], parts[4]
+
+        if len(parts) == 6 and method == "GET":
+            sessions = self.xnat._sessions.get((project, subject), [])
+            content = json.dumps({"ResultSet": {"Result": sessions}}).encode()
+            return self._respond(200, content, "application/json")
+
+        if len(parts) < 9 or parts[7] != "resources":
+            return self._respond(404, b"Unknown endpoint")
+        session = self.xnat._find_session(project, subject, parts[6])
+        if session is None:
+            return self._respond(404, b"Unknown experiment")
+        resource_dir = os.path.join(
+            self.xnat.resources_root(project, session["label"]), parts[8]
+        )
+
+        if len(parts) == 9:
+            if method == "GET":
+                return self._respond(200 if os.path.isdir(resource_dir) else 404)
+            if method == "DELETE":
+                if not os.path.isdir(resource_dir):
+                    return self._respond(404)
+                shutil.rmtree(resource_dir)
+                return self._respond(200)
+        elif parts[9] == "files":
+            filepath = "/".join(parts[10:])
+            if method == "PUT":
+                return self._put_file(resource_dir, filepath, query, body)
+            if method == "DELETE":
+                target = os.path.join(resource_dir, filepath)
+                if not os.path.isfile(target):
+                    return self._respond(404)
+                os.remove(target)
+                return self._respond(200)
+
+        return self._respond(405, b"Method not allowed")
+
+    def _put_file(self, resource_dir, filepath, query, body):
+        target = os.path.join(resource_dir, filepath)
+        if "reference" in query:
+            source = query["reference"]
+            if os.path.isdir(source):
+                shutil.copytree(source, target, dirs_exist_ok=True)
+            elif os.path.isfile(source):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(source, target)
+            else:
+                return self._respond(400, b"Reference does not exist")
+            return self._respond(200)
+
+        upload = parse_multipart(self.headers.get("Content-Type", ""), body)
+        if upload is None:
+            return self._respond(400, b"Expecting a multipart upload")
+        filename, content = upload
+
+        if query.get("extract") == "true":
+            os.makedirs(target, exist_ok=True)
+            with zipfile.ZipFile(io.BytesIO(content)) as zf:
+                zf.extractall(target)
+        else:
+            if not filepath or filepath.endswith("/"):
+                target = os.path.join(target, filename)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, "wb") as fd:
+                fd.write(content)
+        return self._respond(200)
+
+
+def parse_multipart(content_type, body):
+    """
+    Return (filename, content) of the first part of a multipart/form-data body.
+    """
+    if "boundary=" not in content_type:
+        return None
+    boundary = content_type.split("boundary=", 1)[1].strip().strip('"').encode()
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        headers, content = part.split(b"\r\n\r\n", 1)
+        filename = ""
+        for line in headers.decode(errors="replace").split("\r\n"):
+            if line.lower().startswith("content-disposition") and 'filename="' in line:
+                filename = line.split('filename="', 1)[1].split('"', 1)[0]
+        if content.endswith(b"\r\n"):
+            content = content[:-2]
+        return filename, content
+    return None
@@ -0,0 +1,57 @@
+import os
+import zipfile
+
+from archive import STORED, DEFLATED, compress_type, write_archive
+
+
+def test_archive_round_trip(tmp_path):
+    source = tmp_path / "source"
+    (source / "MNINonLinear/Results").mkdir(parents=True)
+    (source / "ProcessingInfo").mkdir()
+    text = b"Completion Check was successful\n" * 5000
+    noise = os.urandom(300 * 1024)
+    (source / "ProcessingInfo/check.log").write_bytes(text)
+    (source / "MNINonLinear/Results/bold.nii.gz").write_bytes(noise)
+    (source / "MNINonLinear/Results/bold.nii").write_bytes(noise)
+    (source / "empty.txt").write_bytes(b"")
+
+    entries = [(path, str(path.relative_to(source))) for path in sorted(source.rglob("*")) if path.is_file()]
+    zip_path = write_archive(tmp_path / "source.zip", entries, workers=3)
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert zf.testzip() is None
+        assert sorted(zf.namelist()) == [
+            "MNINonLinear/Results/bold.nii",
+            "MNINonLinear/Results/bold.nii.gz",
+            "ProcessingInfo/check.log",
+            "empty.txt",
+        ]
+        methods = {info.filename: info.compress_type for info in zf.infolist()}
+        assert methods["ProcessingInfo/check.log"] == DEFLATED
+        # stored by extension, and because the content does not compress
+        assert methods["MNINonLinear/Results/bold.nii.gz"] == STORED
+        assert methods["MNINonLinear/Results/bold.nii"] == STORED
+        assert zf.read("ProcessingInfo/check.log") == text
+        assert zf.read("MNINonLinear/Results/bold.nii") == noise
+
+
+def test_archive_many_members(tmp_path):
+    entries = []
+    for i in range(70000 if os.environ.get("SLOW_TESTS") else 300):
+        path = tmp_path / f"file{i}.txt"
+        path.write_text(str(i))
+        entries.append((path, f"logs/file{i}.txt"))
+
+    zip_path = write_archive(tmp_path / "logs.zip", entries, workers=4)
+
+    with zipfile.ZipFile(zip_path) as zf:
+        assert len(zf.namelist()) == len(entries)
+        assert zf.read("logs/file7.txt") == b"7"
+
+
+def test_compress_type(tmp_path):
+    # known to be compressed by its extension, without reading it
+    assert compress_type(tmp_path / "missing.nii.gz") == STORED
+    text = tmp_path / "check.log"
+    text.write_bytes(b"Completion Check was successful\n" * 100)
+    assert compress_type(text) == DEFLATED
@@ -0,0 +1,77 @@
+import os
+
+from archive_watcher import ArchiveWatcher, producer
+from queue_feeder import Ledger
+from scheduler import PipelineGraph
+
+SESSION = "HCA0123456789_V1_MR"
+
+
+def test_producer():
+    graph = PipelineGraph.from_config()
+    assert producer(graph, "Structural_preproc") == ("StructuralPreprocessing", "")
+    assert producer(graph, "rfMRI_REST1_AP_preproc") == ("FunctionalPreprocessing", "rfMRI_REST1_AP")
+    assert producer(graph, "rfMRI_REST1_AP_unproc") is None
+
+
+def archive_resource(resources, resource, pipeline=None):
+    (resources / resource).mkdir(parents=True)
+    if pipeline:
+        info = resources / resource / SESSION / "ProcessingInfo"
+        info.mkdir(parents=True)
+        (info / f"{SESSION}.{pipeline}.XNAT_CHECK.success").write_text("Completion Check was successful")
+
+
+def test_poll(tmp_path):
+    resources = tmp_path / "archive" / "CCF_HCA_STG" / "arc001" / SESSION / "RESOURCES"
+    for resource in ("T1w_MPR_vNav_4e_RMS_unproc", "rfMRI_REST1_AP_unproc", "rfMRI_REST1_PA_unproc"):
+        archive_resource(resources, resource)
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    watcher = ArchiveWatcher(
+        str(tmp_path / "cursor.sqlite"), PipelineGraph.from_config(), str(tmp_path / "archive"), ledger
+    )
+
+    # the first poll only records what's there
+    archive_resource(resources, "Structural_preproc", "StructuralPreprocessing")
+    assert watcher.poll(["CCF_HCA_STG"], now=0) == []
+
+    # a new resource is only complete once the XNAT_CHECK success file is there
+    archive_resource(resources, "rfMRI_REST1_AP_preproc")
+    assert watcher.poll(["CCF_HCA_STG"], now=0) == []
+    info = resources / "rfMRI_REST1_AP_preproc" / SESSION / "ProcessingInfo"
+    info.mkdir(parents=True)
+    (info / f"{SESSION}.FunctionalPreprocessing.XNAT_CHECK.success").write_text("")
+    # MultiRunIcaFix waits for the other scan
+    assert watcher.poll(["CCF_HCA_STG"], now=1) == []
+
+    archive_resource(resources, "rfMRI_REST1_PA_preproc", "FunctionalPreprocessing")
+    queued = watcher.poll(["CCF_HCA_STG"], now=2)
+    assert queued == [("MultiRunIcaFixProcessing", "CCF_HCA_STG:HCA0123456789:V1_MR:all")]
+    assert ledger.session("MultiRunIcaFixProcessing", "CCF_HCA_STG:HCA0123456789:V1_MR:all")["state"] == "queued"
+    assert watcher.poll(["CCF_HCA_STG"], now=3) == []
+
+
+def test_poll_skips_unchanged_projects(tmp_path, monkeypatch):
+    resources = tmp_path / "archive" / "CCF_HCA_STG" / "arc001" / SESSION / "RESOURCES"
+    archive_resource(resources, "T1w_MPR_vNav_4e_RMS_unproc")
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    watcher = ArchiveWatcher(
+        str(tmp_path / "cursor.sqlite"), PipelineGraph.from_config(), str(tmp_path / "archive"), ledger
+    )
+    rctime = {"value": b"100.0"}
+    monkeypatch.setattr(os, "getxattr", lambda path, name: rctime["value"], raising=False)
+    scanned = []
+    scan_project = watcher._scan_project
+    monkeypatch.setattr(watcher, "_scan_project", lambda *args: scanned.append(args[0]) or scan_project(*args))
+
+    watcher.poll(["CCF_HCA_STG"], now=0)
+    watcher.poll(["CCF_HCA_STG"], now=1)
+    assert scanned == ["CCF_HCA_STG"]
+
+    # something changed below arc001
+    archive_resource(resources, "Structural_preproc")
+    rctime["value"] = b"200.0"
+    watcher.poll(["CCF_HCA_STG"], now=2)
+    assert scanned == ["CCF_HCA_STG"] * 2
+    row = watcher.db.execute("SELECT state FROM resources WHERE resource = 'Structural_preproc'").fetchone()
+    assert row["state"] == "pending"
@@ -0,0 +1,61 @@
+from batch import Batch, BatchFunctionTask, parse_arguments, read_subject_strings
+
+
+def test_parse_arguments(tmp_path):
+    subjects_file = tmp_path / "subjects.txt"
+    subjects_file.write_text("# batch 1\nCCF_HCA_STG:HCA1:V1_MR:all\n\nCCF_HCA_STG:HCA2:V1_MR:all  # rerun\n")
+    assert read_subject_strings(subjects_file) == ["CCF_HCA_STG:HCA1:V1_MR:all", "CCF_HCA_STG:HCA2:V1_MR:all"]
+
+    parsed, variables, subject_strings = parse_arguments(
+        ["--dryrun", "-c", str(tmp_path), "MsmAllProcessing", "CCF_HCA_STG:HCA0:V1_MR:all",
+         "--subjects-file", str(subjects_file), "--TIMESTAMP=999"]
+    )
+    assert parsed.PIPELINE == "MsmAllProcessing"
+    assert subject_strings == ["CCF_HCA_STG:HCA0:V1_MR:all"] + read_subject_strings(subjects_file)
+    assert variables["DRYRUN"] is True
+    assert variables["TIMESTAMP"] == "999"
+    assert variables["PRUNNER_CONFIG_DIR"] == str(tmp_path)
+    assert "_1" not in variables
+
+
+def test_shared_functions_run_once(tmp_path):
+    functions = tmp_path / "functions.py"
+    functions.write_text(
+        "calls = []\n"
+        "def check_required_files_are_available(QUNEX_CONTAINER):\n"
+        "    calls.append(QUNEX_CONTAINER)\n"
+        "def split_subject_components(_1):\n"
+        "    calls.append(_1)\n"
+        "    return {'SESSION': _1}\n"
+    )
+    task = BatchFunctionTask(str(functions))
+    for session in ["A", "B", "C"]:
+        variables = {"QUNEX_CONTAINER": "/containers/qunex.sif", "_1": session}
+        task.execute("check_required_files_are_available", variables)
+        assert task.execute("split_subject_components", variables) == {"SESSION": session}
+    task.execute("check_required_files_are_available", {"QUNEX_CONTAINER": "/other.sif"})
+
+    calls = task.loader.load().calls
+    assert calls == ["/containers/qunex.sif", "A", "B", "C", "/other.sif"]
+
+
+def test_batch_memoizes_shared_functions(tmp_path):
+    (tmp_path / "pipelines.yaml").write_text(
+        "Demo:\n"
+        "  - function: check_required_files_are_available\n"
+        "  - function: split_subject_components\n"
+    )
+    (tmp_path / "functions.py").write_text(
+        "calls = []\n"
+        "def check_required_files_are_available(QUNEX_CONTAINER):\n"
+        "    calls.append(QUNEX_CONTAINER)\n"
+        "def split_subject_components(_1):\n"
+        "    calls.append(_1)\n"
+        "    return {'SESSION': _1}\n"
+    )
+    variables = {"PRUNNER_CONFIG_DIR": str(tmp_path), "VERBOSE": False, "QUNEX_CONTAINER": "/containers/qunex.sif"}
+    batch = Batch("Demo", variables)
+    assert batch.run([f"CCF_HCA_STG:HCA{i}:V1_MR:all" for i in range(2)]) == {}
+
+    calls = batch.shared.get_task("function").loader.load().calls
+    assert calls == ["/containers/qunex.sif", "CCF_HCA_STG:HCA0:V1_MR:all", "CCF_HCA_STG:HCA1:V1_MR:all"]
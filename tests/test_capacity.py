@@ -0,0 +1,24 @@
+from capacity import estimate, free_bytes, main, tree_size
+
+
+def test_tree_size(tmp_path):
+    (tmp_path / "T1w" / "xfms").mkdir(parents=True)
+    (tmp_path / "T1w" / "T1w.nii.gz").write_bytes(b"1" * 1000)
+    (tmp_path / "T1w" / "xfms" / "acpc.mat").write_bytes(b"1" * 24)
+    (tmp_path / "top.txt").write_bytes(b"1" * 100)
+    # links are not followed, whatever they point to is counted where it is
+    (tmp_path / "link.nii.gz").symlink_to(tmp_path / "T1w" / "T1w.nii.gz")
+    (tmp_path / "T1w_link").symlink_to(tmp_path / "T1w")
+    assert tree_size(str(tmp_path), workers=2) == 1124
+    assert tree_size(str(tmp_path / "missing")) == 0
+
+
+def test_free_bytes(tmp_path):
+    assert free_bytes(str(tmp_path / "not" / "made" / "yet")) == free_bytes(str(tmp_path)) > 0
+
+
+def test_estimate(tmp_path, capsys):
+    assert estimate(10, 1.5, 0.2) == (30, 18)
+    assert estimate(0, 1.5, 0.2) == (0, 0)
+    assert main([str(tmp_path), str(tmp_path)]) == 0
+    assert "needed on scratch: 0.0 GB" in capsys.readouterr().out
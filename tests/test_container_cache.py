@@ -0,0 +1,71 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+from container_cache import cached_name, digest_file_problem, fetch, main
+
+
+def make_image(path, content):
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_fetch(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    image = make_image(tmp_path / "qunex_suite-0.96.2a.sif", b"image" * 1000)
+    digest = hashlib.sha256(b"image" * 1000).hexdigest()
+
+    # jobs starting together share one copy
+    paths = []
+    threads = [threading.Thread(target=lambda: paths.append(fetch(image, cache_dir))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert set(paths) == {os.path.join(cache_dir, f"qunex_suite-0.96.2a.{digest[:16]}.sif")}
+    assert sorted(os.listdir(cache_dir)) == [".index.json", ".lock", os.path.basename(paths[0])]
+
+    # a rebuilt image is copied again, under its new sha256
+    image = make_image(tmp_path / "qunex_suite-0.96.2a.sif", b"rebuilt" * 1000)
+    assert fetch(image, cache_dir) != paths[0]
+
+
+def test_eviction(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    images = [make_image(tmp_path / f"qunex_suite-0.9{i}.sif", bytes([i]) * 1000) for i in range(3)]
+    first, second = fetch(images[0], cache_dir, capacity=2500), fetch(images[1], cache_dir, capacity=2500)
+    os.utime(second, (1, 1))
+    # the first image was used more recently than the second
+    fetch(images[0], cache_dir, capacity=2500)
+    third = fetch(images[2], cache_dir, capacity=2500)
+    assert os.path.exists(first) and os.path.exists(third) and not os.path.exists(second)
+
+
+def test_digest_file(tmp_path, capsys):
+    cache_dir = str(tmp_path / "cache")
+    image = make_image(tmp_path / "qunex.sif", b"image")
+    assert digest_file_problem(image) is None
+    digest_file = tmp_path / "qunex.sif.sha256"
+    digest_file.write_text("not a digest\n")
+    assert "has no sha256" in digest_file_problem(image)
+
+    digest_file.write_text(f"{'0' * 64}  qunex.sif\n")
+    assert digest_file_problem(image) is None
+    with pytest.raises(Exception, match="not 0000"):
+        fetch(image, cache_dir)
+    assert os.listdir(cache_dir) == [".lock"]
+    # the job falls back to the image on Ceph
+    assert main(["fetch", image, "--cache-dir", cache_dir]) == 0
+    assert capsys.readouterr().out == image + "\n"
+
+    digest_file.write_text(hashlib.sha256(b"image").hexdigest())
+    os.utime(image, (os.path.getmtime(digest_file) + 10,) * 2)
+    assert "older than the image" in digest_file_problem(image)
+    assert fetch(image, cache_dir).endswith(cached_name(image, hashlib.sha256(b"image").hexdigest()))
+
+    # an image rebuilt without updating its .sha256 isn't mistaken for the copy of the old one
+    make_image(tmp_path / "qunex.sif", b"rebuilt")
+    os.utime(image, (os.path.getmtime(digest_file) + 10,) * 2)
+    assert fetch(image, cache_dir).endswith(cached_name(image, hashlib.sha256(b"rebuilt").hexdigest()))
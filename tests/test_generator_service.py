@@ -0,0 +1,45 @@
+import os
+import time
+
+from generator_service import Generator
+
+
+def make_config(root):
+    (root / "templates").mkdir()
+    (root / "pipelines.yaml").write_text(
+        "Hello:\n"
+        "  - function: split_subject_components\n"
+        "  - generate_file:\n"
+        "      template: hello.jinja2\n"
+        "      filepath: ${SESSION}.txt\n"
+    )
+    (root / "functions.py").write_text(
+        "def split_subject_components(_1):\n"
+        "    project, subject, classifier, scan = _1.split(':')\n"
+        "    return {'SESSION': f'{subject}_{classifier}'}\n"
+    )
+    (root / "templates" / "hello.jinja2").write_text("Hello {{ SESSION }}")
+
+
+def test_generate_and_reload(tmp_path, monkeypatch):
+    make_config(tmp_path)
+    monkeypatch.chdir(tmp_path)
+    generator = Generator(str(tmp_path))
+    variables = {"PRUNNER_CONFIG_DIR": str(tmp_path), "DRYRUN": False, "VERBOSE": False}
+
+    reloaded, results = generator.generate("Hello", ["P:S1:V1_MR:all", "bad"], variables)
+    assert not reloaded
+    assert results[0][1] is None
+    assert "ValueError" in results[1][1]
+    assert (tmp_path / "S1_V1_MR.txt").read_text() == "Hello S1_V1_MR"
+
+    template = tmp_path / "templates" / "hello.jinja2"
+    template.write_text("Goodbye {{ SESSION }}")
+    later = time.time() + 5
+    os.utime(template, (later, later))
+    reloaded, results = generator.generate("Hello", ["P:S2:V1_MR:all"], variables)
+    assert reloaded
+    assert (tmp_path / "S2_V1_MR.txt").read_text() == "Goodbye S2_V1_MR"
+
+    reloaded, _ = generator.generate("Hello", ["P:S3:V1_MR:all"], variables)
+    assert not reloaded
@@ -0,0 +1,41 @@
+import ast
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+from render_regression import render_all
+
+LIB_DIR = Path(__file__).resolve().parent.parent / "lib"
+# modules that take longer to import than the steps that don't need them take to run
+HEAVY_MODULES = ("requests", "requests_toolbelt", "urllib3", "http.client")
+
+
+def heavy_imports(module, cwd, argv0="-c"):
+    """
+    Returns:
+        the heavy modules that importing `module` imported
+    """
+    script = (
+        f"import sys; sys.argv[0] = {argv0!r}; sys.path.insert(0, {str(LIB_DIR)!r})\n"
+        f"import {module}\n"
+        f"print([m for m in {HEAVY_MODULES!r} if m in sys.modules])\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=cwd, capture_output=True, text=True, check=True)
+    return ast.literal_eval(result.stdout)
+
+
+def test_lib_imports_are_light(tmp_path):
+    for module in ("xnat_file_client", "telemetry", "check", "archive", "reaper"):
+        assert heavy_imports(module, tmp_path) == [], module
+
+
+def test_shared_values_import_is_light(tmp_path):
+    rendered, errors = render_all(["MsmAllProcessing"], ["CCF_HCA_STG"], 1, "")
+    assert not errors
+    outputs = rendered["MsmAllProcessing/CCF_HCA_STG"]
+    shared_values = re.sub(r'sys\.path\.append\(".*"\)', f"sys.path.append({str(LIB_DIR)!r})", outputs["shared_values.py"])
+    (tmp_path / "shared_values.py").write_text(shared_values)
+    clean_script = next(name for name in outputs if name.endswith("CLEAN_DATA_job.py"))
+
+    assert heavy_imports("shared_values", tmp_path, argv0=clean_script) == []
@@ -0,0 +1,71 @@
+import json
+
+import metadata_limiter
+from get_data import link_directory
+from metadata_limiter import MetadataLimiter, main, stagger, update_jobs
+from virtual_fs import VirtualFileSystem
+
+
+class Counter:
+    def __init__(self):
+        self.operations = 0
+
+    def consume(self, operations=1):
+        self.operations += operations
+
+
+def test_shared_budget(tmp_path, capsys):
+    budget_file = str(tmp_path / "metadata_budget.json")
+    first = MetadataLimiter(1000, budget_file, job="node1:1")
+    assert first.throttle.rate == 1000
+    second = MetadataLimiter(1000, budget_file, job="node2:1")
+    assert second.throttle.rate == 500
+    # the first job takes its share at its next refresh
+    first.refreshed = 0
+    first.consume()
+    assert first.throttle.rate == 500
+
+    second.close()
+    first.refresh(first.refreshed)
+    assert first.throttle.rate == 1000
+    # a job that stopped updating its share is gone
+    update_jobs(budget_file, "node3:1", first.refreshed - metadata_limiter.STALE_SECONDS - 1)
+    with open(budget_file) as fd:
+        assert list(json.load(fd)) == ["node1:1", "node3:1"]
+    assert list(update_jobs(budget_file, "node1:1", first.refreshed)) == ["node1:1"]
+
+    assert main(["status", budget_file, "--rate", "1000"]) == 0
+    assert capsys.readouterr().out.startswith("1 jobs sharing the budget\n1000 operations")
+
+
+def test_unshared_budget(tmp_path):
+    limiter = MetadataLimiter(100, str(tmp_path / "missing" / "metadata_budget.json"))
+    assert limiter.budget_file is None and limiter.throttle.rate == 100
+    assert MetadataLimiter(0, str(tmp_path / "metadata_budget.json")).throttle.rate == 0
+    assert not (tmp_path / "metadata_budget.json").exists()
+
+
+def test_stagger(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(metadata_limiter.time, "sleep", sleeps.append)
+    stagger(0)
+    stagger(30)
+    assert len(sleeps) == 1 and 0 <= sleeps[0] <= 30
+
+
+def test_operations_are_counted(tmp_path):
+    source = tmp_path / "RESOURCES" / "T1w_unproc"
+    (source / "OTHER_FILES").mkdir(parents=True)
+    (source / "T1w.nii.gz").write_bytes(b"t1")
+    (source / "OTHER_FILES" / "T1w.json").write_bytes(b"{}")
+    counter = Counter()
+    link_directory(source, tmp_path / "unprocessed" / "T1w", False, counter)
+    assert (tmp_path / "unprocessed" / "T1w" / "OTHER_FILES" / "T1w.json").is_symlink()
+    assert counter.operations == 11
+
+    counter = Counter()
+    fs = VirtualFileSystem(limiter=counter)
+    fs.copy(source, tmp_path / "clean")
+    fs.sync()
+    assert (tmp_path / "clean" / "T1w_unproc" / "T1w.nii.gz").is_symlink()
+    assert counter.operations == 12
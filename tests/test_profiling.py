@@ -0,0 +1,45 @@
+import pstats
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+from profiling import Spans
+
+LIB_DIR = Path(__file__).resolve().parent.parent / "lib"
+
+
+def test_spans(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "file").write_text("x")
+    spans = Spans()
+    spans.install()
+    try:
+        shutil.copytree(source, tmp_path / "copy")
+        subprocess.call(["true"])
+    finally:
+        spans.uninstall()
+    # copytree's own copyfile calls are part of its span
+    assert set(spans.totals) == {"filesystem: shutil.copytree", "subprocess: Popen.wait"}
+    assert spans.totals["filesystem: shutil.copytree"][0] == 1
+    assert shutil.copytree.__module__ == "shutil" and not hasattr(shutil.copytree, "__wrapped__")
+
+
+def test_profile_at_exit(tmp_path):
+    check_data_dir = tmp_path / "check"
+    check_data_dir.mkdir()
+    script = (
+        f"import os, sys; sys.path.insert(0, '{LIB_DIR}')\n"
+        "from profiling import profile_at_exit\n"
+        f"profile_at_exit('{check_data_dir}', 'session.XNAT_GET_DATA_job', top=5)\n"
+        "def busy(): return sorted(str(i) for i in range(10 ** 5))\n"
+        "busy()\n"
+        "os.system('true')\n"
+    )
+    assert subprocess.call([sys.executable, "-c", script]) == 0
+    functions = [name for _, _, name in pstats.Stats(str(check_data_dir / "session.XNAT_GET_DATA_job.prof")).stats]
+    assert "busy" in functions
+    summary = (check_data_dir / "session.XNAT_GET_DATA_job.profile.txt").read_text()
+    assert "subprocess: os.system" in summary
+    assert "# top 5 allocation sites" in summary
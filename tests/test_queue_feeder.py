@@ -0,0 +1,124 @@
+import os
+
+import queue_feeder
+from queue_feeder import Feeder, Ledger, marker_path, parse_submitted_jobs
+from tests.fake_slurm import fake_commands
+
+SUBMIT_OUTPUT = """Creating "Running Status Marker" file to indicate that jobs are queued.
+>>  /build/HCA1_V1_MR.MsmAllProcessing.MARK_COMPLETE_RUNNING_STATUS --status=queued
+Output: done
+>>  sbatch /build/HCA1_V1_MR.MsmAllProcessing.XNAT_GET_DATA_job.sh
+Output: Submitted batch job 101
+>>  sbatch --dependency=afterok:101 /build/HCA1_V1_MR.MsmAllProcessing.PROCESS_DATA_job.sh
+Output: Submitted batch job 102
+"""
+
+
+def test_parse_submitted_jobs():
+    assert parse_submitted_jobs(SUBMIT_OUTPUT) == [
+        ("/build/HCA1_V1_MR.MsmAllProcessing.XNAT_GET_DATA_job.sh", "101"),
+        ("/build/HCA1_V1_MR.MsmAllProcessing.PROCESS_DATA_job.sh", "102"),
+    ]
+
+
+class FakeBatch:
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.variables = {}
+
+    def execute(self, subject_string, variables):
+        # each session submits 2 jobs, numbered from the number of sessions submitted so far
+        n = len(list(self.tmp_path.glob("submit.*.sh")))
+        script = self.tmp_path / f"submit.{n}.sh"
+        script.write_text(
+            "#!/bin/bash\n"
+            f"echo '>>  sbatch get.sh'\necho 'Output: Submitted batch job {2 * n}'\n"
+            f"echo '>>  sbatch --dependency=afterok:{2 * n} process.sh'\necho 'Output: Submitted batch job {2 * n + 1}'\n"
+        )
+        script.chmod(0o755)
+        return dict(
+            SUBMIT_TO_PBS_SCRIPT=str(script),
+            CHECK_DATA_DIR=str(self.tmp_path),
+            RESOURCES_ROOT=str(self.tmp_path / "archive" / subject_string.split(":")[1] / "RESOURCES"),
+            OUTPUT_RESOURCE_NAME="MsmAll_proc",
+            SESSION=subject_string.split(":")[1] + "_V1_MR",
+            PIPELINE_NAME="MsmAllProcessing",
+        )
+
+
+def fake_slurm(tmp_path, monkeypatch):
+    for command in ("squeue", "sacct"):
+        (tmp_path / f"{command}.txt").write_text("")
+    fake_commands(
+        tmp_path,
+        monkeypatch,
+        # squeue.txt has the job ids and their reasons, the reasons are only printed when asked for
+        squeue=f'if [[ "$*" == *%r* ]]; then cat {tmp_path}/squeue.txt; else cut -d" " -f1 {tmp_path}/squeue.txt; fi',
+        sacct=f"cat {tmp_path}/sacct.txt",
+        scancel=f'echo "$@" >> {tmp_path}/scancel.log',
+    )
+
+
+def test_feed(tmp_path, monkeypatch):
+    fake_slurm(tmp_path, monkeypatch)
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    subjects = [f"CCF_HCA_STG:HCA{i}:V1_MR:all" for i in range(3)]
+    assert ledger.add("MsmAllProcessing", subjects, {"TIMESTAMP": "999"}) == 3
+    assert ledger.add("MsmAllProcessing", subjects) == 0
+
+    archive_root = tmp_path / "archive"
+    feeder = Feeder(ledger, {}, str(archive_root), user="hcp", depth=2, backoff=600)
+    monkeypatch.setattr(feeder, "batch", lambda pipeline: FakeBatch(tmp_path))
+
+    # the first session fills the queue
+    assert feeder.feed(now=0) == 1
+    assert ledger.counts() == {"submitted": 1, "queued": 2}
+    assert [job["job_id"] for job in ledger.jobs("MsmAllProcessing", subjects[0], 1)] == ["0", "1"]
+
+    # its jobs are still queued
+    (tmp_path / "squeue.txt").write_text("0 None\n1 Dependency\n")
+    assert feeder.feed(now=0) == 0
+
+    # lost to a node failure: retried after the backoff. The second session is running elsewhere.
+    (tmp_path / "squeue.txt").write_text("")
+    (tmp_path / "sacct.txt").write_text("0|NODE_FAIL\n1|CANCELLED by 0\n")
+    marker = marker_path(str(archive_root), subjects[1], "MsmAllProcessing")
+    os.makedirs(os.path.dirname(marker))
+    open(marker, "w").close()
+    now = queue_feeder.time.time()
+    assert feeder.feed(now=now) == 1
+    assert ledger.session("MsmAllProcessing", subjects[0])["state"] == "queued"
+    assert ledger.session("MsmAllProcessing", subjects[1])["state"] == "queued"
+    assert ledger.session("MsmAllProcessing", subjects[2])["state"] == "submitted"
+
+    # a step failed: the steps waiting on it are cancelled and the session is failed
+    (tmp_path / "squeue.txt").write_text(f"3 {queue_feeder.DEPENDENCY_FAILED}\n")
+    (tmp_path / "sacct.txt").write_text("2|FAILED\n3|CANCELLED by 0\n")
+    assert feeder.feed(now=now + 601) == 1
+    assert (tmp_path / "scancel.log").read_text() == "3\n"
+    assert ledger.session("MsmAllProcessing", subjects[2])["state"] == "failed"
+    assert ledger.session("MsmAllProcessing", subjects[0])["attempts"] == 2
+
+
+def test_feed_completes_sessions_with_a_success_file(tmp_path, monkeypatch):
+    fake_slurm(tmp_path, monkeypatch)
+    ledger = Ledger(str(tmp_path / "ledger.sqlite"))
+    subjects = [f"CCF_HCA_STG:HCA{i}:V1_MR:all" for i in range(2)]
+    ledger.add("MsmAllProcessing", subjects)
+    feeder = Feeder(ledger, {}, str(tmp_path / "archive"), user="hcp", depth=10)
+    monkeypatch.setattr(feeder, "batch", lambda pipeline: FakeBatch(tmp_path))
+    assert feeder.feed(now=0) == 2
+
+    # XNAT_CHECK uploaded the success file of HCA0; HCA1 has one from a previous run
+    submitted = ledger.session("MsmAllProcessing", subjects[0])["updated"]
+    for i, mtime in enumerate([submitted + 60, submitted - 3600]):
+        success = tmp_path / "archive" / f"HCA{i}" / "RESOURCES" / "MsmAll_proc" / f"HCA{i}_V1_MR" / \
+            "ProcessingInfo" / f"HCA{i}_V1_MR.MsmAllProcessing.XNAT_CHECK.success"
+        success.parent.mkdir(parents=True)
+        success.write_text("Completion Check was successful")
+        os.utime(success, (mtime, mtime))
+    (tmp_path / "sacct.txt").write_text("0|COMPLETED\n1|COMPLETED\n2|COMPLETED\n3|FAILED\n")
+    feeder.feed(now=0)
+
+    assert ledger.session("MsmAllProcessing", subjects[0])["state"] == "completed"
+    assert ledger.session("MsmAllProcessing", subjects[1])["state"] == "failed"
@@ -0,0 +1,96 @@
+import fcntl
+import json
+import os
+
+import reaper
+from reaper import discard, main, reap, remove_tree
+from tests.fake_slurm import fake_commands, fake_sbatch
+
+
+def make_tree(root):
+    for i in range(3):
+        (root / f"bold{i}" / "fix").mkdir(parents=True)
+        (root / f"bold{i}" / "fix" / "ica.nii.gz").write_bytes(b"1" * 100)
+        (root / f"bold{i}" / "bold.nii.gz").write_bytes(b"1" * 1000)
+        (root / f"bold{i}" / "link.nii.gz").symlink_to("bold.nii.gz")
+    (root / "empty").mkdir()
+    # a link to outside the tree is removed, not what it points to
+    (root / "archive").symlink_to(root.parent / "archive")
+
+
+def test_remove_tree(tmp_path):
+    (tmp_path / "archive").mkdir()
+    (tmp_path / "archive" / "T1w.nii.gz").write_bytes(b"t1")
+    make_tree(tmp_path / "study")
+    files, size = remove_tree(str(tmp_path / "study"), workers=4)
+    assert files == 10
+    assert size >= 3300
+    assert sorted(os.listdir(tmp_path)) == ["archive"]
+    assert (tmp_path / "archive" / "T1w.nii.gz").exists()
+
+
+def test_discard_and_reap(tmp_path, capsys):
+    make_tree(tmp_path / "build" / "WORKING_DIR")
+    trash = tmp_path / "build" / "trash"
+    moved = discard(str(tmp_path / "build" / "WORKING_DIR"), str(trash))
+    assert not (tmp_path / "build" / "WORKING_DIR").exists()
+    assert os.path.basename(moved).startswith("WORKING_DIR.")
+    assert discard(str(tmp_path / "build" / "WORKING_DIR"), str(trash)) is None
+
+    assert main(["run", str(trash), "--once", "--rate", "0"]) == 0
+    assert sorted(os.listdir(trash)) == sorted([reaper.LOCK_FILE, reaper.LOG_FILE])
+    with open(trash / reaper.LOG_FILE) as fd:
+        record = json.loads(fd.readline())
+    assert record["name"] == os.path.basename(moved) and record["files"] == 10
+    assert reap(str(trash)) == (0, 0, 0)
+
+    capsys.readouterr()
+    main(["status", str(trash)])
+    assert "waiting: 0 directories\nreclaimed: 1 directories, 10 files" in capsys.readouterr().out
+
+
+def test_discard_elsewhere(tmp_path, monkeypatch):
+    # TRASH_DIR on another file system
+    def rename(source, destination):
+        raise OSError(18, "Invalid cross-device link")
+
+    monkeypatch.setattr(reaper.os, "rename", rename)
+    make_tree(tmp_path / "scratch")
+    assert discard(str(tmp_path / "scratch"), str(tmp_path / "trash")) is None
+    assert not (tmp_path / "scratch").exists()
+
+
+def test_rate(tmp_path, monkeypatch):
+    # every unlink and rmdir is counted against the rate
+    operations = []
+    monkeypatch.setattr(reaper.Throttle, "consume", lambda self, amount: operations.append(amount))
+    make_tree(tmp_path / "study")
+    remove_tree(str(tmp_path / "study"), throttle=reaper.Throttle(10))
+    assert len(operations) == 10 + 8
+
+
+def test_reaper_already_at_work(tmp_path):
+    trash = tmp_path / "trash"
+    make_tree(trash / "WORKING_DIR.1")
+    with open(trash / reaper.LOCK_FILE, "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # a queued reaper leaves it to the one at work, a standing one reports it
+        assert main(["run", str(trash), "--once"]) == 0
+        assert main(["run", str(trash)]) == 1
+    assert (trash / "WORKING_DIR.1").exists()
+
+
+def test_submit(tmp_path, monkeypatch):
+    sbatch_log = fake_sbatch(tmp_path, monkeypatch)
+    assert reaper.submit(str(tmp_path / "trash"), "afterany:123") == "1001"
+    options = sbatch_log.read_text().split()
+    assert "--dependency=afterany:123" in options
+    assert f"--output={tmp_path}/reaper.%j.stdout" in options
+    assert sbatch_log.read_text().rstrip().endswith(f"reaper.py run --once {tmp_path}/trash")
+
+
+def test_submit_after_failure(tmp_path, monkeypatch, capsys):
+    # the jobs are submitted already, a reaper that can't be queued doesn't fail the submission
+    fake_commands(tmp_path, monkeypatch, sbatch="exit 1")
+    reaper.submit_after([str(tmp_path / "trash")] * 2, ["123", "124"])
+    assert capsys.readouterr().out.count("WARNING: Unable to queue a reaper") == 1
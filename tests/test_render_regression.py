@@ -0,0 +1,19 @@
+from render_regression import compare, main
+
+
+def test_compare():
+    baseline = {"A/P": {"x.sh": "1", "y.sh": "2", "z.sh": "3"}}
+    current = {"A/P": {"x.sh": "1", "y.sh": "4", "w.sh": "5"}, "B/P": {"x.sh": "1"}}
+    assert compare(baseline, current) == [
+        ("added", "A/P/w.sh"),
+        ("changed", "A/P/y.sh"),
+        ("removed", "A/P/z.sh"),
+        ("added", "B/P/x.sh"),
+    ]
+
+
+def test_rendered_scripts_match_baseline(tmp_path, capsys):
+    # If this fails after an intended change to the templates, review the differences with
+    # `python render_regression.py --write-dir` and store them with `python render_regression.py --update`
+    returncode = main(["--cache-dir", str(tmp_path / "cache")])
+    assert returncode == 0, capsys.readouterr().out
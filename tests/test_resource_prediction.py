@@ -0,0 +1,128 @@
+import json
+
+from resource_prediction import output_ratio, predict, quantile, read_history, run_totals
+
+
+def run(project, bolds, mem_gbs, hours, pipeline="MultiRunIcaFixProcessing", returncode=0):
+    return dict(
+        pipeline=pipeline,
+        project=project,
+        step="process",
+        bolds=str(bolds),
+        input_gbs="",
+        max_rss_kb=int(mem_gbs * 2 ** 20),
+        wall_seconds=hours * 3600,
+        returncode=returncode,
+    )
+
+
+def test_quantile():
+    assert quantile([3, 1, 2], 0.5) == 2
+    assert quantile([1, 2], 0.75) == 1.75
+    assert quantile([5], 0.95) == 5
+
+
+def test_predict():
+    # small sessions of 4 BOLDs and large ones of 12, in two projects
+    history = [run("CCF_HCA_STG", 4, 10 + i / 10, 5) for i in range(20)]
+    history += [run("CCF_HCA_STG", 12, 30 + i / 10, 20) for i in range(20)]
+    history += [run("CCF_BANDA_STG", 8, 55, 30) for _ in range(5)]
+    history += [run("CCF_HCA_STG", 4, 1, 1, pipeline="MsmAllProcessing")]
+
+    mem_gbs, hours, runs = predict(history, "MultiRunIcaFixProcessing", "CCF_HCA_STG", {"bolds": 4, "input_gbs": None},
+                                   q=0.95, margin=0.2, neighbours=20)
+    assert (mem_gbs, hours, runs) == (15, 6, 20)
+    mem_gbs, hours, _ = predict(history, "MultiRunIcaFixProcessing", "CCF_HCA_STG", {"bolds": 12, "input_gbs": None},
+                                neighbours=20)
+    assert (mem_gbs, hours) == (39, 24)
+
+    # too few runs of its own, BANDA is sized from every project
+    assert predict(history, "MultiRunIcaFixProcessing", "CCF_BANDA_STG", {"bolds": 8, "input_gbs": None},
+                   neighbours=20)[2] == 20
+    assert predict(history, "MsmAllProcessing", "CCF_HCA_STG", {"bolds": 4, "input_gbs": None}) is None
+
+
+def test_predict_memory():
+    history = [run("CCF_HCA_STG", 4, 10, 5) for i in range(20)]
+    history += [run("CCF_HCA_STG", 12, 30, 20) for i in range(20)]
+    predictors = {"bolds": 4, "input_gbs": None}
+    assert predict(history, "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors, margin=0, neighbours=20)[0] == 10
+
+    # the memory of the whole job, several processes, when it was measured
+    history[0] = dict(history[0], job_mem_kb=16 * 2 ** 20)
+    assert predict(history, "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors, q=1, margin=0, neighbours=20)[0] == 16
+
+    # killed at its limit, a run needed more than it used: not less than that, plus the margin
+    failed = run("CCF_HCA_STG", 4, 22, 5, returncode=137)
+    mem_gbs, hours, runs = predict(history + [failed], "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors,
+                                   margin=0.5, neighbours=20)
+    assert (mem_gbs, hours, runs) == (33, 8, 20)
+    # a failed run larger than the runs it is sized from doesn't count
+    failed = run("CCF_HCA_STG", 12, 60, 5, returncode=137)
+    assert predict(history + [failed], "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors, q=0.5, margin=0,
+                   neighbours=20)[0] == 10
+
+
+def test_predict_walltime():
+    history = [run("CCF_HCA_STG", 4, 10, 5) for i in range(20)]
+    predictors = {"bolds": 4, "input_gbs": None}
+    assert predict(history, "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors, margin=0)[1] == 5
+
+    # stopped at its time limit, a run needed more time than it had
+    timed_out = dict(run("CCF_HCA_STG", 4, 10, 24, returncode=-15), timed_out=True)
+    assert predict(history + [timed_out], "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors, margin=0.5)[1] == 36
+    # a run that failed otherwise doesn't
+    failed = run("CCF_HCA_STG", 4, 10, 24, returncode=1)
+    assert predict(history + [failed], "MultiRunIcaFixProcessing", "CCF_HCA_STG", predictors, margin=0)[1] == 5
+
+
+def test_run_totals():
+    history = []
+    for i in range(12):
+        steps = {"get": 0.5, "process": 5, "clean": 0.25, "put": 0.25, "check": 1}
+        if i == 11:
+            # failed in process, it never reached the check step
+            del steps["check"]
+        for step, hours in steps.items():
+            record = dict(run("CCF_HCA_STG", 4, 10, hours), step=step, session=f"HCA{i}_V1_MR", scan="",
+                          timestamp="1700000000")
+            history.append(record)
+    # resubmitted, the get step ran twice
+    history.append(dict(history[0], wall_seconds=3600))
+
+    totals = run_totals(history, "MultiRunIcaFixProcessing")
+    assert len(totals) == 11
+    assert totals[0]["wall_seconds"] == 7.5 * 3600
+    assert {r["wall_seconds"] for r in totals[1:]} == {7 * 3600}
+    _, hours, runs = predict(totals, "MultiRunIcaFixProcessing", "CCF_HCA_STG", {"bolds": 4, "input_gbs": None},
+                             q=0.5, margin=0)
+    assert (hours, runs) == (7, 11)
+
+
+def test_read_history(tmp_path):
+    history_file = tmp_path / "telemetry_history.jsonl"
+    assert read_history(str(history_file)) == []
+    history_file.write_text(json.dumps(run("CCF_HCA_STG", 4, 10, 5)) + "\nnot json\n")
+    records = read_history(str(history_file))
+    assert len(records) == 1
+    assert read_history(str(history_file)) is records
+    with open(history_file, "a") as fd:
+        fd.write(json.dumps(run("CCF_HCA_STG", 4, 10, 5)) + "\n")
+    assert len(read_history(str(history_file))) == 2
+
+    # moved aside by telemetry.append_history
+    history_file.rename(tmp_path / "telemetry_history.jsonl.1")
+    history_file.write_text(json.dumps(run("CCF_HCA_STG", 4, 10, 5)) + "\n")
+    assert len(read_history(str(history_file))) == 3
+
+
+def test_output_ratio():
+    history = []
+    for i in range(10):
+        record = run("CCF_HCA_STG", 4, 10, 5, pipeline="StructuralPreprocessing")
+        history.append(dict(record, input_gbs="2", write_bytes=(2 + i / 10) * 2 ** 31))
+    history.append(dict(history[0], write_bytes=100 * 2 ** 31, returncode=1))
+    assert output_ratio(history, "StructuralPreprocessing", q=1) == 2.9
+    assert output_ratio(history, "StructuralPreprocessing", q=0) == 2
+    assert output_ratio(history[:9], "StructuralPreprocessing", default=1.5) == 1.5
+    assert output_ratio(history, "MsmAllProcessing") is None
@@ -0,0 +1,85 @@
+import json
+import os
+import time
+
+from running_registry import RunningRegistry, expand_job_id, parse_marker
+
+PROJECT = "CCF_HCA_STG"
+
+
+def add_marker(archive, session, marker, age=0):
+    status_dir = archive / PROJECT / "arc001" / session / "RESOURCES" / "RunningStatus"
+    status_dir.mkdir(parents=True, exist_ok=True)
+    path = status_dir / marker
+    path.write_text("Reason: queued")
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def add_job(records, job_id, session, pipeline, scan="", step="get_data", age=7200):
+    record = dict(
+        job_id=job_id, step=step, project=PROJECT, session=session, pipeline=pipeline, scan=scan,
+        submitted=int(time.time() - age),
+    )
+    with open(records, "a") as fd:
+        fd.write(json.dumps(record) + "\n")
+
+
+def test_parse_marker():
+    assert parse_marker("MsmAll.HCA1_V1_MR.RUNNING", "HCA1_V1_MR") == ("MsmAll", "")
+    assert parse_marker("ICAFIX.HCA1_V1_MR_rfMRI_REST1_AP.RUNNING", "HCA1_V1_MR") == ("ICAFIX", "rfMRI_REST1_AP")
+    assert parse_marker("ICAFIX.HCA2_V1_MR.RUNNING", "HCA1_V1_MR") is None
+
+
+def test_query_and_stale(tmp_path):
+    archive = tmp_path / "archive"
+    records = tmp_path / "submitted_jobs.jsonl"
+    add_marker(archive, "HCA1_V1_MR", "MsmAll.HCA1_V1_MR.RUNNING", age=7200)
+    add_marker(archive, "HCA2_V1_MR", "MsmAll.HCA2_V1_MR.RUNNING", age=7200)
+    add_marker(archive, "HCA2_V1_MR", "ICAFIX.HCA2_V1_MR_rfMRI_REST1_AP.RUNNING")
+    add_marker(archive, "HCA4_V1_MR", "MsmAll.HCA4_V1_MR.RUNNING", age=7200)
+    add_marker(archive, "HCA5_V1_MR", "MsmAll.HCA5_V1_MR.RUNNING", age=7200)
+    (archive / PROJECT / "arc001" / "HCA3_V1_MR").mkdir()
+    add_job(records, "101", "HCA1_V1_MR", "MsmAll")
+    add_job(records, "102", "HCA1_V1_MR", "MsmAll", step="marker")
+    add_job(records, "201", "HCA2_V1_MR", "MsmAll")
+    # a submission of a day before HCA5's marker was set
+    add_job(records, "501", "HCA5_V1_MR", "MsmAll", age=7200 + 86400)
+
+    registry = RunningRegistry(str(tmp_path / "registry.sqlite"))
+    assert registry.refresh_markers(str(archive), [PROJECT]) == 4
+    assert registry.refresh_jobs(str(records)) == 4
+
+    markers = registry.in_flight(PROJECT, "MsmAll", {"102": "PENDING"})
+    assert [m["session"] for m in markers] == ["HCA1_V1_MR", "HCA2_V1_MR", "HCA4_V1_MR", "HCA5_V1_MR"]
+    assert markers[0]["jobs"] == [("101", "get_data", None), ("102", "marker", "PENDING")]
+    assert [m["scan"] for m in registry.in_flight(pipeline="ICAFIX")] == ["rfMRI_REST1_AP"]
+
+    # HCA2's job is gone; the fresh ICAFIX marker is within the grace period;
+    # HCA4's marker has no recorded job, e.g. it was set by another operator;
+    # HCA5's was set again since its only job, it isn't stale either
+    stale = registry.stale({"102": "PENDING"})
+    assert [(m["session"], m["pipeline"]) for m in stale] == [("HCA2_V1_MR", "MsmAll")]
+    assert [m["session"] for m in registry.unknown()] == ["HCA4_V1_MR", "HCA5_V1_MR"]
+
+    # nothing changed, nothing is rescanned or re-read
+    assert registry.refresh_markers(str(archive), [PROJECT]) == 0
+    assert registry.refresh_jobs(str(records)) == 0
+    add_job(records, "202", "HCA2_V1_MR", "MsmAll", step="marker")
+    assert registry.refresh_jobs(str(records)) == 1
+    assert registry.stale({"102": "PENDING", "202": "RUNNING"}) == []
+
+    # removing a marker changes the mtime of its directory
+    marker = archive / PROJECT / "arc001" / "HCA1_V1_MR" / "RESOURCES" / "RunningStatus" / "MsmAll.HCA1_V1_MR.RUNNING"
+    marker.unlink()
+    os.utime(marker.parent, (time.time() + 10, time.time() + 10))
+    assert registry.refresh_markers(str(archive), [PROJECT]) == 1
+    assert [m["session"] for m in registry.in_flight(pipeline="MsmAll")] == ["HCA2_V1_MR", "HCA4_V1_MR", "HCA5_V1_MR"]
+    registry.close()
+
+
+def test_expand_job_id():
+    assert expand_job_id("123") == ["123"]
+    assert expand_job_id("123_4") == ["123_4"]
+    assert expand_job_id("123_[0-2,7%2]") == ["123_0", "123_1", "123_2", "123_7"]
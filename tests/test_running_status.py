@@ -0,0 +1,43 @@
+import os
+
+from tests.fake_xnat import FakeXnat
+from running_status import BatchMarker, marker_filename, parse_subject_string
+
+
+def test_parse_subject_string():
+    assert parse_subject_string("CCF_HCA_STG:HCA0123456789:V1_MR:all") == (
+        "CCF_HCA_STG", "HCA0123456789", "HCA0123456789_V1_MR", ""
+    )
+    assert marker_filename("FunctionalPreprocessing", "HCA0123456789_V1_MR", "rfMRI_REST1_AP") == (
+        "FunctionalPreprocessing.HCA0123456789_V1_MR_rfMRI_REST1_AP.RUNNING"
+    )
+
+
+def test_batch_marker(tmp_path):
+    credentials = tmp_path / "credentials"
+    credentials.write_text("user\npass\n")
+    subjects = [f"CCF_HCA_STG:HCA000000{i}:V1_MR:all" for i in range(5)]
+
+    with FakeXnat(tmp_path / "archive") as xnat:
+        for i in range(5):
+            xnat.add_session("CCF_HCA_STG", f"HCA000000{i}", f"HCA000000{i}_V1_MR")
+        subjects.append("CCF_HCA_STG:HCA9999999:V1_MR:all")
+
+        marker = BatchMarker(xnat.url, credentials, archive_root=xnat.archive_root, workers=3)
+        failures = marker.update_all("MsmAllProcessing", subjects, "queued")
+
+        assert list(failures) == ["CCF_HCA_STG:HCA9999999:V1_MR:all"]
+        markers = [
+            os.path.join(
+                xnat.resources_root("CCF_HCA_STG", f"HCA000000{i}_V1_MR"),
+                "RunningStatus",
+                f"MsmAllProcessing.HCA000000{i}_V1_MR.RUNNING",
+            )
+            for i in range(5)
+        ]
+        assert all(open(path).read() == "Reason: queued" for path in markers)
+        assert not any(x["path"].endswith("refresh/catalog") for x in xnat.requests)
+
+        failures = marker.update_all("MsmAllProcessing", subjects[:5], "done")
+        assert failures == {}
+        assert not any(os.path.exists(path) for path in markers)
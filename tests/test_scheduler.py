@@ -0,0 +1,95 @@
+import json
+
+import scheduler
+from scheduler import PipelineGraph, plan, topological_order
+
+SESSION = "HCA0123456789_V1_MR"
+
+
+def complete(resources_root, resource, pipeline):
+    info = resources_root / resource / SESSION / "ProcessingInfo"
+    info.mkdir(parents=True)
+    (info / f"{SESSION}.{pipeline}.XNAT_CHECK.success").write_text("Completion Check was successful")
+
+
+def test_graph_from_config():
+    graph = PipelineGraph.from_config()
+    assert graph.upstream("StructuralPreprocessing") == []
+    assert graph.upstream("FunctionalPreprocessing") == ["StructuralPreprocessing"]
+    assert sorted(graph.upstream("MultiRunIcaFixProcessing")) == ["FunctionalPreprocessing", "StructuralPreprocessing"]
+    assert sorted(graph.upstream("MsmAllProcessing")) == [
+        "FunctionalPreprocessing",
+        "MultiRunIcaFixProcessing",
+        "StructuralPreprocessing",
+    ]
+    for pipeline in ("ReapplyFixProcessing", "TicaProcessing"):
+        assert sorted(graph.upstream(pipeline)) == [
+            "FunctionalPreprocessing",
+            "MsmAllProcessing",
+            "MultiRunIcaFixProcessing",
+            "StructuralPreprocessing",
+        ]
+    assert graph.upstream("BedpostxPreprocessing") == ["DiffusionPreprocessing"]
+    assert graph.pipelines["TicaProcessing"]["optional_inputs"] == [
+        "AutoReclean_proc",
+        "ReapplyFix_proc",
+        "Diffusion_preproc",
+    ]
+    assert "TaskAnalysisProcessing" not in graph.upstream("MsmAllProcessing")
+
+
+def test_plan_skips_completed_pipelines(tmp_path):
+    for scan in ("rfMRI_REST1_AP", "rfMRI_REST1_PA", "tfMRI_CARIT_PA"):
+        (tmp_path / f"{scan}_unproc").mkdir()
+    complete(tmp_path, "Structural_preproc", "StructuralPreprocessing")
+    complete(tmp_path, "rfMRI_REST1_AP_preproc", "FunctionalPreprocessing")
+
+    nodes = plan(PipelineGraph.from_config(), ["MultiRunIcaFixProcessing"], SESSION, "all", tmp_path)
+    assert nodes["StructuralPreprocessing"]["status"] == "done"
+    assert nodes["FunctionalPreprocessing:rfMRI_REST1_AP"]["status"] == "done"
+    assert nodes["FunctionalPreprocessing:rfMRI_REST1_PA"]["parents"] == []
+    # a session without diffusion data runs its functional pipelines
+    assert "DiffusionPreprocessing" not in nodes
+    assert sorted(nodes["MultiRunIcaFixProcessing"]["parents"]) == [
+        "FunctionalPreprocessing:rfMRI_REST1_PA",
+        "FunctionalPreprocessing:tfMRI_CARIT_PA",
+    ]
+    order = topological_order(nodes)
+    assert order.index("FunctionalPreprocessing:rfMRI_REST1_PA") < order.index("MultiRunIcaFixProcessing")
+
+    nodes = plan(PipelineGraph.from_config(), ["StructuralPreprocessing"], SESSION, "all", tmp_path, force=True)
+    assert nodes == {"StructuralPreprocessing": dict(pipeline="StructuralPreprocessing", extra="all", parents=[], status="pending")}
+
+
+def test_submit_and_continue(tmp_path, monkeypatch):
+    graph = PipelineGraph.from_config()
+    nodes = plan(graph, ["MsmAllProcessing", "BedpostxPreprocessing"], SESSION, "all", tmp_path / "RESOURCES")
+    generated, launchers = [], []
+    monkeypatch.setattr(scheduler, "generate_and_submit", lambda state, node: generated.append(node["pipeline"]) or f"{len(generated)}")
+    monkeypatch.setattr(scheduler, "sbatch", lambda cmd, dry_run: launchers.append(cmd) or f"l{len(launchers)}")
+    state = dict(
+        config_dir=scheduler.CONFIG_DIR,
+        project="CCF_HCA_STG",
+        subject="HCA0123456789",
+        classifier="V1_MR",
+        resources_root=str(tmp_path / "RESOURCES"),
+        dry_run=False,
+        variables={},
+        graph=graph.pipelines,
+        nodes=nodes,
+    )
+    state_path = str(tmp_path / "state.json")
+
+    state = scheduler.submit(state, state_path)
+    assert generated == ["StructuralPreprocessing"]
+    assert state["nodes"]["DiffusionPreprocessing"]["status"] == "waiting"
+    assert state["nodes"]["MultiRunIcaFixProcessing"]["status"] == "waiting"
+    assert "--dependency=afterany:1" in launchers[0]
+    assert state["nodes"]["MsmAllProcessing"]["status"] == "pending"
+    assert state["nodes"]["BedpostxPreprocessing"]["parents"] == ["DiffusionPreprocessing"]
+
+    # structural did not archive its output: everything downstream fails
+    assert scheduler.resume(state_path, "DiffusionPreprocessing") == 1
+    with open(state_path) as fd:
+        nodes = json.load(fd)["nodes"]
+    assert {node["status"] for node_id, node in nodes.items() if node_id != "StructuralPreprocessing"} == {"failed"}
@@ -0,0 +1,70 @@
+import os
+
+import scratch_stage
+from scratch_stage import Stage, Throttle, main, prefetch
+
+
+def test_throttle(monkeypatch):
+    waits = []
+    monkeypatch.setattr(scratch_stage.time, "sleep", waits.append)
+    throttle = Throttle(rate=100)
+    throttle.consume(100)
+    assert waits == []
+    throttle.consume(50)
+    assert 0.49 < waits[0] <= 0.5
+    Throttle(0).consume(10 ** 9)
+    assert len(waits) == 1
+
+
+def test_stage(tmp_path):
+    archive = tmp_path / "archive" / "T1w"
+    archive.mkdir(parents=True)
+    (archive / "T1w.nii.gz").write_bytes(b"t1" * 1000)
+    (archive / "T2w.nii.gz").write_bytes(b"t2" * 1000)
+
+    # a study folder made by the get step, then moved to scratch
+    study = tmp_path / "scratch" / "HCA0123456789_V1_MR"
+    (study / "T1w").mkdir(parents=True)
+    for name in ("T1w.nii.gz", "T2w.nii.gz"):
+        (study / "T1w" / name).symlink_to(archive / name)
+    (study / "T1w" / "T1w_link.nii.gz").symlink_to("T1w.nii.gz")
+    assert prefetch(str(study), workers=2) == (2, 4000)
+    assert not (study / "T1w" / "T1w.nii.gz").is_symlink()
+    assert (study / "T1w" / "T1w.nii.gz").read_bytes() == b"t1" * 1000
+    assert (study / "T1w" / "T1w_link.nii.gz").is_symlink()
+
+    # QuNex modifies an input and writes outputs, one of them is still being written
+    (study / "T1w" / "T2w.nii.gz").write_bytes(b"modified")
+    (study / "MNINonLinear").mkdir()
+    (study / "MNINonLinear" / "done.nii.gz").write_bytes(b"done")
+    (study / "MNINonLinear" / "scratch.txt").write_bytes(b"removed later")
+    old = os.stat(study / "MNINonLinear" / "done.nii.gz").st_mtime - 600
+    for name in ("done.nii.gz", "scratch.txt"):
+        os.utime(study / "MNINonLinear" / name, (old, old))
+    (study / "MNINonLinear" / "writing.nii.gz").write_bytes(b"partial")
+
+    build = tmp_path / "build" / "HCA0123456789_V1_MR"
+    stage = Stage(str(study), str(build), workers=2)
+    stage.sync()
+    assert (build / "MNINonLinear" / "done.nii.gz").read_bytes() == b"done"
+    assert not (build / "MNINonLinear" / "writing.nii.gz").exists()
+    # the unmodified input is linked to the archive again
+    assert os.readlink(build / "T1w" / "T1w.nii.gz") == str(archive / "T1w.nii.gz")
+    assert stage.verify() == ["T1w/T2w.nii.gz", "MNINonLinear/writing.nii.gz"]
+
+    (study / "MNINonLinear" / "scratch.txt").unlink()
+    (study / "empty").mkdir()
+    verified = tmp_path / "scratch_stage.verified"
+    assert main(["finish", str(study), str(build), "--verified-file", str(verified), "--bandwidth-mbs", "0"]) == 0
+    assert verified.exists()
+    assert (build / "T1w" / "T2w.nii.gz").read_bytes() == b"modified"
+    assert (build / "MNINonLinear" / "writing.nii.gz").read_bytes() == b"partial"
+    assert not (build / "MNINonLinear" / "scratch.txt").exists()
+    assert os.readlink(build / "T1w" / "T1w_link.nii.gz") == "T1w.nii.gz"
+    assert (build / "empty").is_dir()
+    assert not any(name.startswith(".scratch_stage") for name in os.listdir(build))
+
+    # a copy that went wrong is not verified
+    (build / "MNINonLinear" / "done.nii.gz").write_bytes(b"truncated")
+    verified.unlink()
+    assert Stage(str(study), str(build)).verify() == ["MNINonLinear/done.nii.gz"]
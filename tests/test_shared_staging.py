@@ -0,0 +1,125 @@
+import os
+
+from get_data import PipelineResources
+from shared_staging import SharedStaging, copy_links, main
+
+
+def make_archive(root):
+    resources = root / "archive" / "HCA0123456789_V1_MR" / "RESOURCES"
+    structural = resources / "Structural_preproc" / "HCA0123456789_V1_MR"
+    (structural / "T1w" / "xfms").mkdir(parents=True)
+    (structural / "T1w" / "T1w_acpc_dc.nii.gz").write_bytes(b"t1")
+    (structural / "T1w" / "xfms" / "acpc.mat").write_bytes(b"m")
+    (structural / "MNINonLinear").mkdir()
+    (structural / "MNINonLinear" / "T1w.nii.gz").write_bytes(b"t1")
+    for scan in ("rfMRI_REST1_AP", "rfMRI_REST1_PA"):
+        unproc = resources / f"{scan}_unproc"
+        unproc.mkdir()
+        (unproc / f"{scan}.nii.gz").write_bytes(scan.encode())
+    return resources
+
+
+def get(resources, job_dir, scan, staging):
+    """
+    What the get step of a FunctionalPreprocessing job does.
+    """
+    linked = []
+
+    class Counter:
+        def consume(self, operations=1):
+            linked.append(operations)
+
+    pipeline_resources = PipelineResources(resources, "HCA0123456789_V1_MR", False, job_dir / "tmp", Counter(), staging)
+    pipeline_resources.get_structural_preproc_data()
+    pipeline_resources.get_functional_unproc_data(scan)
+    return sum(linked)
+
+
+def test_shared_staging(tmp_path):
+    resources = make_archive(tmp_path)
+    shared = str(tmp_path / "build" / "FunctionalPreprocessing.HCA0123456789_V1_MR.shared_inputs")
+    trash = str(tmp_path / "build" / "trash")
+    jobs = [SharedStaging(shared, f"job{i}", trash) for i in range(2)]
+    for job in jobs:
+        job.acquire()
+
+    first = get(resources, tmp_path / "job0", "rfMRI_REST1_AP", jobs[0])
+    second = get(resources, tmp_path / "job1", "rfMRI_REST1_PA", jobs[1])
+    # the second job only copies the links staged by the first one
+    assert second < first
+    for job_dir, scan in ((tmp_path / "job0", "rfMRI_REST1_AP"), (tmp_path / "job1", "rfMRI_REST1_PA")):
+        session_dir = job_dir / "tmp" / "HCA0123456789_V1_MR"
+        assert os.readlink(session_dir / "T1w" / "xfms" / "acpc.mat") == str(
+            resources / "Structural_preproc" / "HCA0123456789_V1_MR" / "T1w" / "xfms" / "acpc.mat"
+        )
+        assert os.listdir(session_dir / "unprocessed") == [scan]
+
+    assert list(jobs[0].release()) == ["job1"]
+    assert os.path.isdir(shared)
+    assert jobs[1].release() == {}
+    assert not os.path.exists(shared)
+    assert len(os.listdir(trash)) == 1
+    assert jobs[1].release() == {}
+
+
+def test_without_staging(tmp_path):
+    resources = make_archive(tmp_path)
+    get(resources, tmp_path / "job", "rfMRI_REST1_AP", None)
+    assert (tmp_path / "job" / "tmp" / "HCA0123456789_V1_MR" / "MNINonLinear" / "T1w.nii.gz").is_symlink()
+
+
+def test_copy_links_keeps_existing(tmp_path):
+    (tmp_path / "staged" / "T1w").mkdir(parents=True)
+    (tmp_path / "staged" / "T1w" / "T1w.nii.gz").symlink_to("/archive/T1w.nii.gz")
+    (tmp_path / "staged" / "T1w" / "T2w.nii.gz").symlink_to("/archive/T2w.nii.gz")
+    (tmp_path / "job" / "T1w").mkdir(parents=True)
+    (tmp_path / "job" / "T1w" / "T1w.nii.gz").symlink_to("/other/T1w.nii.gz")
+    assert copy_links(str(tmp_path / "staged"), str(tmp_path / "job")) == 1
+    assert os.readlink(tmp_path / "job" / "T1w" / "T1w.nii.gz") == "/other/T1w.nii.gz"
+
+
+def test_release_cli(tmp_path, capsys):
+    shared = str(tmp_path / "shared_inputs")
+    SharedStaging(shared, "job0", None).acquire()
+    SharedStaging(shared, "job1", None).acquire()
+    assert main(["release", shared, "job0", "--trash-dir", str(tmp_path / "trash")]) == 0
+    main(["status", shared])
+    assert capsys.readouterr().out.splitlines()[1].startswith("job1 since")
+
+
+def test_restaged_when_sources_change(tmp_path):
+    resources = make_archive(tmp_path)
+    shared = str(tmp_path / "build" / "shared_inputs")
+    trash = str(tmp_path / "build" / "trash")
+    jobs = [SharedStaging(shared, f"job{i}", trash) for i in range(3)]
+    for job in jobs:
+        job.acquire()
+    first = get(resources, tmp_path / "job0", "rfMRI_REST1_AP", jobs[0])
+    assert get(resources, tmp_path / "job1", "rfMRI_REST1_PA", jobs[1]) < first
+
+    # Structural_preproc was reprocessed since
+    structural = resources / "Structural_preproc" / "HCA0123456789_V1_MR"
+    (structural / "T2w").mkdir()
+    (structural / "T2w" / "T2w_acpc_dc.nii.gz").write_bytes(b"t2")
+    os.utime(resources / "Structural_preproc", (0, 0))
+    (resources / "Structural_preproc" / "reprocessed").write_text("")
+
+    assert get(resources, tmp_path / "job2", "rfMRI_REST1_AP", jobs[2]) >= first
+    assert (tmp_path / "job2" / "tmp" / "HCA0123456789_V1_MR" / "T2w" / "T2w_acpc_dc.nii.gz").is_symlink()
+    assert len(os.listdir(trash)) == 1
+
+
+def test_release_is_idempotent(tmp_path):
+    shared = str(tmp_path / "shared_inputs")
+    trash = str(tmp_path / "trash")
+    jobs = [SharedStaging(shared, f"job{i}", trash) for i in range(2)]
+    for job in jobs:
+        job.acquire()
+    # e.g. by the check step, then by the marker step
+    assert list(jobs[0].release()) == ["job1"]
+    assert list(jobs[0].release()) == ["job1"]
+    assert os.path.isdir(shared)
+    # never acquired, e.g. the marker script run at submission
+    assert list(SharedStaging(shared, "job2", trash).release()) == ["job1"]
+    assert jobs[1].release() == {}
+    assert not os.path.exists(shared)
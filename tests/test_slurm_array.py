@@ -0,0 +1,115 @@
+import json
+import os
+import subprocess
+
+from tests.fake_slurm import fake_sbatch, make_session
+from tests.fake_xnat import FakeXnat
+from slurm_array import group_sessions, sbatch_directives, submit_manifest, write_array_script
+
+
+def test_sbatch_directives(tmp_path):
+    record = make_session(tmp_path, "HCA1_V1_MR")
+    shared, stdout, stderr = sbatch_directives(record["steps"][0][1])
+    assert shared == ["--nodes=1", "--ntasks-per-node=1", "--time=4:00:00", "--mem=4000"]
+    assert stdout == f"{tmp_path}/HCA1_V1_MR/get.%j.stdout"
+    assert stderr == f"{tmp_path}/HCA1_V1_MR/get.%j.stderr"
+
+
+def test_group_sessions(tmp_path):
+    records = [make_session(tmp_path, f"HCA{i}_V1_MR") for i in range(5)]
+    records.append(make_session(tmp_path, "HCA9_V1_MR", hours=48))
+    groups = group_sessions(records, max_array_size=3)
+    assert [[r["session"] for r in group] for group in groups] == [
+        ["HCA0_V1_MR", "HCA1_V1_MR", "HCA2_V1_MR"],
+        ["HCA3_V1_MR", "HCA4_V1_MR"],
+        ["HCA9_V1_MR"],
+    ]
+
+
+def test_group_sessions_resources(tmp_path):
+    # predicted resources differ per session, but within a power of 2 they share an array
+    records = [
+        make_session(tmp_path, "HCA0_V1_MR", hours=3, mem=3500),
+        make_session(tmp_path, "HCA1_V1_MR", hours=4, mem=4000),
+        make_session(tmp_path, "HCA2_V1_MR", hours=4, mem=3000),
+        make_session(tmp_path, "HCA3_V1_MR", hours=4, mem=9000),
+    ]
+    groups = group_sessions(records)
+    assert [[r["session"] for r in group] for group in groups] == [
+        ["HCA0_V1_MR", "HCA1_V1_MR", "HCA2_V1_MR"],
+        ["HCA3_V1_MR"],
+    ]
+
+    # the array asks for the most any of its sessions needs
+    scripts = [dict(r["steps"])["process"] for r in groups[0]]
+    array_script = write_array_script(str(tmp_path), "process", scripts, "process")
+    directives = [line for line in open(array_script) if line.startswith("#SBATCH")]
+    assert "#SBATCH --time=4:00:00\n" in directives
+    assert "#SBATCH --mem=4000\n" in directives
+
+
+def test_submit_manifest(tmp_path, monkeypatch):
+    sbatch_log = fake_sbatch(tmp_path, monkeypatch)
+    manifest = tmp_path / "batch.manifest"
+    records = [dict(make_session(tmp_path, f"HCA{i}_V1_MR"), trash_dir=str(tmp_path / "trash")) for i in range(3)]
+    manifest.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+    submit_manifest(str(manifest))
+
+    calls = sbatch_log.read_text().splitlines()
+    array_dir = f"{manifest}.arrays/000"
+    assert calls[:3] == [
+        f"--parsable --array=0-2 {array_dir}/get.sh",
+        f"--parsable --array=0-2 --dependency=aftercorr:1001 {array_dir}/process.sh",
+        f"--parsable --array=0-2 --dependency=afterany:1002 {array_dir}/marker.sh",
+    ]
+    # one reaper for the TRASH_DIR the sessions share
+    assert len(calls) == 4
+    assert "--dependency=afterany:1003" in calls[3] and calls[3].endswith(f"run --once {tmp_path}/trash")
+
+    # sessions of several arrays still get one reaper, after all of them
+    sbatch_log.unlink()
+    more = [make_session(tmp_path, f"HCA{i}_V1_MR", hours=48) for i in range(3, 5)]
+    manifest.write_text("".join(json.dumps(dict(r, trash_dir=str(tmp_path / "trash"))) + "\n" for r in records + more))
+    submit_manifest(str(manifest))
+    reapers = [call for call in sbatch_log.read_text().splitlines() if "reaper.py" in call]
+    assert len(reapers) == 1 and "--dependency=afterany:1003:1006" in reapers[0]
+
+    jobs = [json.loads(line) for line in open(tmp_path / "jobs.jsonl")]
+    assert [(j["job_id"], j["step"], j["session"]) for j in jobs][:4] == [
+        ("1001_0", "get", "HCA0_V1_MR"),
+        ("1001_1", "get", "HCA1_V1_MR"),
+        ("1001_2", "get", "HCA2_V1_MR"),
+        ("1002_0", "process", "HCA0_V1_MR"),
+    ]
+
+    # task 1 of the process array runs the process script of the second session, logging where it would have
+    process = open(f"{array_dir}/process.sh").read()
+    assert "#SBATCH --time=4:00:00" in process
+    assert "--job-name=\"process.999\"" not in process
+    env = dict(os.environ, SLURM_ARRAY_TASK_ID="1", SLURM_JOB_ID="2001")
+    subprocess.check_call(["bash", f"{array_dir}/process.sh"], env=env)
+    assert (tmp_path / "HCA1_V1_MR" / "process.2001.stdout").read_text() == "process HCA1_V1_MR\n"
+
+
+def test_submit_manifest_marks_sessions_queued(tmp_path, monkeypatch):
+    fake_sbatch(tmp_path, monkeypatch)
+    credentials = tmp_path / "credentials"
+    credentials.write_text("user\npass\n")
+    with FakeXnat(tmp_path / "archive") as xnat:
+        records = []
+        for i in range(3):
+            xnat.add_session("CCF_HCA_STG", f"HCA{i}", f"HCA{i}_V1_MR")
+            record = make_session(tmp_path, f"HCA{i}_V1_MR")
+            record.update(subject_string=f"CCF_HCA_STG:HCA{i}:V1_MR:all", serverlist=xnat.url)
+            records.append(dict(record, credentials_file=str(credentials)))
+        manifest = tmp_path / "batch.manifest"
+        manifest.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+        submit_manifest(str(manifest))
+
+        # one marker per session, from this process rather than a marker script per session
+        for i in range(3):
+            resources_root = xnat.resources_root("CCF_HCA_STG", f"HCA{i}_V1_MR")
+            marker = os.path.join(resources_root, "RunningStatus", f"MsmAllProcessing.HCA{i}_V1_MR.RUNNING")
+            assert open(marker).read() == "Reason: queued"
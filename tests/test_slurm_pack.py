@@ -0,0 +1,81 @@
+import json
+import os
+import sys
+
+import pytest
+
+from slurm_pack import pack_resources, parse_slurm_size, parse_slurm_time, run_pack, session_resources, submit_packs
+from tests.fake_slurm import fake_sbatch, make_session
+
+
+def test_parse_slurm_options():
+    assert parse_slurm_time("4:00:00") == 4
+    assert parse_slurm_time("90") == 1.5
+    assert parse_slurm_time("30:00") == 0.5
+    assert parse_slurm_time("1-00:00:00") == 24
+    assert parse_slurm_time("2-12") == 60
+    assert parse_slurm_time("1-06:30") == 30.5
+    assert parse_slurm_size("48000") == 48000
+    assert parse_slurm_size("48000M") == 48000
+    assert parse_slurm_size("48G") == 48 * 1024
+    assert parse_slurm_size("1t") == 1024 ** 2
+
+
+def test_session_resources(tmp_path):
+    script = tmp_path / "runall.sh"
+    script.write_text("#!/bin/bash\n#SBATCH --ntasks-per-node=4\n#SBATCH --time=1-00:00:00 --mem=48G --tmp=100G\n")
+    assert session_resources(str(script)) == (4, 48 * 1024, 100 * 1024, 24)
+
+
+def test_pack_resources():
+    sessions = [dict(cpus=4, mem=8000, tmp=20000, hours=4)] * 6
+    # 4 sessions at a time fit in 16 cores, so 2 waves
+    assert pack_resources(sessions, node_cpus=16, node_mem_gbs=64) == (16, 32000, 80000, 8)
+    # memory bound
+    assert pack_resources(sessions, node_cpus=16, node_mem_gbs=20) == (8, 16000, 40000, 12)
+    # a G is 1024 MB, as in the session's --mem=64G
+    assert pack_resources([dict(cpus=4, mem=64 * 1024, hours=4)], node_cpus=16, node_mem_gbs=64)[1] == 64 * 1024
+    with pytest.raises(Exception):
+        pack_resources([dict(cpus=32, mem=8000, hours=4)], node_cpus=16)
+
+
+def test_submit_and_run_pack(tmp_path, monkeypatch):
+    sbatch_log = fake_sbatch(tmp_path, monkeypatch)
+    manifest = tmp_path / "batch.manifest"
+    records = [
+        dict(
+            make_session(tmp_path, f"HCA{i}_V1_MR", pipeline="BedpostxPreprocessing", steps=("run_all",), marker=False,
+                         cpus=4, mem=8000, directives=("--account=hcp --partition=tier2_cpu", "--tmp=20G"),
+                         exit_code=i % 2),
+            trash_dir=str(tmp_path / "trash"),
+        )
+        for i in range(3)
+    ]
+    manifest.write_text("".join(json.dumps(r) + "\n" for r in records))
+
+    submit_packs(str(manifest), sessions_per_pack=2, node_cpus=8, node_mem_gbs=64)
+
+    pack_dir = f"{manifest}.packs"
+    calls = sbatch_log.read_text().splitlines()
+    assert calls[:2] == [
+        f"--parsable {pack_dir}/000/pack.sh",
+        f"--parsable {pack_dir}/001/pack.sh",
+    ]
+    # one reaper, once every pack is done
+    assert len(calls) == 3
+    assert "--dependency=afterany:1001:1002" in calls[2] and calls[2].endswith(f"run --once {tmp_path}/trash")
+    script = open(f"{pack_dir}/000/pack.sh").read()
+    assert f"#SBATCH --ntasks-per-node=8 --mem=16000 --time=4:00:00 --tmp={2 * 20 * 1024}" in script
+    assert "#SBATCH --account=hcp" in script
+    assert f"exec {sys.executable} " in script
+    jobs = [json.loads(line) for line in open(tmp_path / "jobs.jsonl")]
+    assert [(j["job_id"], j["session"]) for j in jobs] == [
+        ("1001", "HCA0_V1_MR"), ("1001", "HCA1_V1_MR"), ("1002", "HCA2_V1_MR")
+    ]
+
+    monkeypatch.setenv("SLURM_JOB_ID", "1001")
+    assert run_pack(f"{pack_dir}/000/pack.json") == 1
+    for i in range(2):
+        stdout = tmp_path / f"HCA{i}_V1_MR" / "run_all.1001.stdout"
+        assert stdout.read_text() == f"run_all HCA{i}_V1_MR\n"
+        assert open(os.path.join(pack_dir, "000", f"HCA{i}_V1_MR.exit")).read() == f"{i}\n"
@@ -0,0 +1,141 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+from pathlib import Path
+
+from telemetry import PACKED_ENV, MemorySampler, append_history, main, process_tree_kb, read_records, summarize
+
+LIB_DIR = Path(__file__).resolve().parent.parent / "lib"
+
+
+def test_run(tmp_path):
+    telemetry_file = tmp_path / "check" / "session.telemetry.jsonl"
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    cmd = f"import pathlib; [pathlib.Path('{output_dir}', str(i)).write_bytes(b'x' * 100000) for i in range(3)]"
+    returncode = main(
+        ["run", "--file", str(telemetry_file), "--step", "process", "--files", str(output_dir),
+         "--label", "pipeline=MsmAllProcessing", "--label", "project=CCF_HCA_STG", "--", sys.executable, "-c", cmd]
+    )
+    assert returncode == 0
+    record, = read_records([str(tmp_path)])
+    assert record["step"] == "process"
+    assert record["pipeline"] == "MsmAllProcessing"
+    assert record["files"] == 3
+    assert record["write_bytes"] >= 300000
+    assert record["max_rss_kb"] > 0
+    assert record["job_mem_kb"] is None or record["job_mem_kb"] >= record["max_rss_kb"]
+    assert record["returncode"] == 0
+
+
+def test_record_at_exit(tmp_path):
+    telemetry_file = tmp_path / "session.telemetry.jsonl"
+    script = (
+        f"import sys; sys.path.insert(0, '{LIB_DIR}')\n"
+        "from telemetry import record_at_exit\n"
+        f"record_at_exit('{telemetry_file}', 'get', labels=dict(pipeline='MsmAllProcessing', project='CCF_HCA_STG'))\n"
+        "sum(range(10 ** 6))\n"
+        "sys.exit(3)\n"
+    )
+    assert subprocess.call([sys.executable, "-c", script]) == 3
+    record = json.loads(telemetry_file.read_text())
+    assert record["step"] == "get"
+    assert record["files"] is None
+    assert record["user_cpu_seconds"] + record["system_cpu_seconds"] > 0
+
+    # a successful check removes CHECK_DATA_DIR, it is not created again for the record
+    check_data_dir = tmp_path / "check"
+    check_data_dir.mkdir()
+    script = (
+        f"import shutil, sys; sys.path.insert(0, '{LIB_DIR}')\n"
+        "from telemetry import record_at_exit\n"
+        f"record_at_exit('{check_data_dir}/session.telemetry.jsonl', 'check')\n"
+        f"shutil.rmtree('{check_data_dir}')\n"
+    )
+    assert subprocess.call([sys.executable, "-c", script]) == 0
+    assert not check_data_dir.exists()
+
+    # the history file gets the record, even without the telemetry file
+    history_file = tmp_path / "telemetry_history.jsonl"
+    check_data_dir.mkdir()
+    script = (
+        f"import shutil, sys; sys.path.insert(0, '{LIB_DIR}')\n"
+        "from telemetry import record_at_exit\n"
+        f"record_at_exit('{check_data_dir}/session.telemetry.jsonl', 'check', history_file='{history_file}')\n"
+        f"shutil.rmtree('{check_data_dir}')\n"
+    )
+    assert subprocess.call([sys.executable, "-c", script]) == 0
+    assert json.loads(history_file.read_text())["step"] == "check"
+
+
+def test_memory_sampler(tmp_path):
+    stat_file = tmp_path / "memory.stat"
+    sampler = MemorySampler(interval=0.01)
+    sampler.cgroup = (str(stat_file), ("anon", "shmem"))
+    stat_file.write_text(f"anon {3 * 2 ** 20}\nfile {50 * 2 ** 20}\nshmem {2 ** 20}\n")
+    sampler.sample()
+    stat_file.write_text(f"anon {2 ** 20}\nfile {80 * 2 ** 20}\nshmem 0\n")
+    sampler.start()
+    sampler.stop()
+    # the peak, without the page cache
+    assert sampler.peak_kb == 4 * 1024
+
+    # outside of a memory cgroup
+    sampler = MemorySampler()
+    sampler.cgroup = None
+    sampler.start()
+    sampler.stop()
+    assert sampler.peak_kb is None
+
+
+def test_append_history(tmp_path):
+    history_file = tmp_path / "telemetry_history.jsonl"
+    for i in range(5):
+        append_history(history_file, {"step": "process", "i": i}, max_bytes=50)
+    rotated = tmp_path / "telemetry_history.jsonl.1"
+    assert [json.loads(line)["i"] for line in rotated.read_text().splitlines()] == [2, 3]
+    assert [json.loads(line)["i"] for line in history_file.read_text().splitlines()] == [4]
+
+
+def test_summarize():
+    records = [
+        dict(pipeline="MsmAllProcessing", project="CCF_HCA_STG", step="get", wall_seconds=w, user_cpu_seconds=1,
+             system_cpu_seconds=1, max_rss_kb=1024, read_bytes=2 ** 20, write_bytes=0, files=None)
+        for w in (10, 20, 60)
+    ]
+    summary = summarize(records)
+    stats = summary[("MsmAllProcessing", "CCF_HCA_STG", "get")]
+    assert stats["count"] == 3
+    assert stats["wall_seconds"] == (20, 60)
+    assert stats["max_rss_mb"] == (1, 1)
+    assert stats["files"] is None
+    assert list(summarize(records, by=("step",))) == [("get",)]
+
+
+def test_packed_session(tmp_path, monkeypatch):
+    # a packed session records the memory of its own processes, not of the pack's cgroup
+    monkeypatch.setenv(PACKED_ENV, "1")
+    telemetry_file = tmp_path / "session.telemetry.jsonl"
+    cmd = "import time; x = bytearray(64 * 2 ** 20); time.sleep(0.5)"
+    monkeypatch.setattr("telemetry.MEMORY_SAMPLE_SECONDS", 0.05)
+    assert main(["run", "--file", str(telemetry_file), "--step", "process", "--", sys.executable, "-c", cmd]) == 0
+    record, = read_records([str(telemetry_file)])
+    assert record["packed"]
+    assert 64 * 1024 <= record["job_mem_kb"] < 1024 * 1024
+
+    assert process_tree_kb(os.getpid()) > 0
+
+
+def test_run_timed_out(tmp_path):
+    # slurm's SIGTERM at the time limit reaches the command, and the step is still recorded
+    telemetry_file = tmp_path / "session.telemetry.jsonl"
+    threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM)).start()
+    returncode = main(["run", "--file", str(telemetry_file), "--step", "process", "--", "sleep", "30"])
+    assert returncode == -signal.SIGTERM
+    record, = read_records([str(telemetry_file)])
+    assert record["timed_out"]
+    assert record["wall_seconds"] < 10
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
@@ -1,8 +1,10 @@
 import subprocess
 import os
+import sys
+import threading
 from pathlib import Path
 
-from util import escape_path, keep_resting_state_scans, is_unreadable
+from util import escape_path, keep_resting_state_scans, is_unreadable, shell_run
 
 
 def original_sed_command(text):
@@ -51,3 +53,32 @@ def test_is_readable_dir():
     p.chmod(0o333)
     assert is_unreadable(testname) == True
     p.rmdir()
+
+
+def python_cmd(code):
+    return f"{sys.executable} -c '{code}'"
+
+
+def test_shell_run(caplog):
+    caplog.set_level("INFO", logger="shell_run")
+    result = shell_run(python_cmd("import sys; [print(i) for i in range(100)]; sys.exit(3)"), tail_lines=5)
+    # started, but failed
+    assert result and not result.ok
+    assert result.returncode == 3
+    assert result.tail == ["95", "96", "97", "98", "99"]
+    # every line was logged as it came
+    assert sum(record.message.endswith("] 42") for record in caplog.records) == 1
+
+    assert shell_run(python_cmd("print(1)")).ok
+    assert not shell_run("/nonexistent/command")
+
+
+def test_shell_run_timeout_and_cancel():
+    result = shell_run(python_cmd("import time; print(1, flush=True); time.sleep(60)"), timeout=0.5)
+    assert result.timed_out and not result.ok and result.seconds < 30
+    assert result.tail == ["1"]
+
+    cancel = threading.Event()
+    threading.Timer(0.5, cancel.set).start()
+    result = shell_run(python_cmd("import time; time.sleep(60)"), cancel=cancel)
+    assert result.cancelled and not result.ok and result.seconds < 30
@@ -0,0 +1,202 @@
+import os
+
+import pytest
+
+from tests.fake_xnat import FakeXnat
+from xnat_file_client import (
+    UploadCheckpoint,
+    XnatFileClient,
+    batch_key,
+    checkpoint_path,
+    get_server,
+    plan_upload_batches,
+)
+
+PROJECT = "CCF_HCA_STG"
+SUBJECT = "HCA0123456789"
+SESSION = "HCA0123456789_V1_MR"
+
+
+@pytest.fixture
+def xnat(tmp_path):
+    server = FakeXnat(tmp_path / "archive")
+    server.add_session(PROJECT, SUBJECT, SESSION, "XNAT_E00042")
+    with server:
+        yield server
+
+
+@pytest.fixture
+def client(xnat):
+    return XnatFileClient(PROJECT, SUBJECT, SESSION, xnat.url, username="user", password="pass")
+
+
+def make_tree(root, count=6, size=1000):
+    for i in range(count):
+        path = root / f"dir{i % 2}" / f"file{i}.txt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(size))
+    return root
+
+
+def test_get_server_skips_servers_that_are_down(tmp_path):
+    with FakeXnat(tmp_path) as down, FakeXnat(tmp_path) as up:
+        down.down = True
+        assert get_server(f"{down.url} {up.url}") == up.url
+
+
+def test_client_finds_session_id(client):
+    assert client.sessionId == "XNAT_E00042"
+    assert client.api_base.endswith("/experiments/XNAT_E00042")
+
+
+def test_upload_file(client, xnat, tmp_path):
+    source = tmp_path / "HCA0123456789_V1_MR.success"
+    source.write_text("Completion Check was successful")
+    r = client.upload_resource_filepath(
+        "Structural_preproc", source, resource_filepath=f"{SESSION}/ProcessingInfo/{source.name}"
+    )
+    assert r.status_code == 200
+    uploaded = os.path.join(
+        xnat.resources_root(PROJECT, SESSION), "Structural_preproc", SESSION, "ProcessingInfo", source.name
+    )
+    assert open(uploaded).read() == "Completion Check was successful"
+
+
+def test_upload_directory_in_batches(client, xnat, tmp_path):
+    source = make_tree(tmp_path / "upload")
+    client.upload_resource_filepath("RunningStatus", source, batch_bytes=2500)
+
+    puts = [x for x in xnat.requests if x["method"] == "PUT"]
+    assert len(puts) == 3
+    resource = os.path.join(xnat.resources_root(PROJECT, SESSION), "RunningStatus")
+    for i in range(6):
+        assert os.path.isfile(os.path.join(resource, f"dir{i % 2}", f"file{i}.txt"))
+    assert not os.path.exists(checkpoint_path(str(source)))
+
+
+def test_interrupted_directory_upload_resumes(client, xnat, tmp_path):
+    source = make_tree(tmp_path / "upload")
+    calls = []
+    original_put = client._put
+
+    def put(url, filepath=None):
+        calls.append(url)
+        if len(calls) == 2:
+            xnat.fail_next(1)
+        return original_put(url, filepath)
+
+    client._put = put
+    with pytest.raises(Exception):
+        client.upload_resource_filepath(
+            "RunningStatus", source, batch_bytes=2500, attempts=1, retry_delay=0
+        )
+    assert os.path.exists(checkpoint_path(str(source)))
+    # neither the failed batch nor the one zipped ahead of it is left behind
+    assert not list(tmp_path.glob("*.zip"))
+
+    # only the failed batch and the one after it are sent again
+    calls.clear()
+    client._put = lambda url, filepath=None: calls.append(url) or original_put(url, filepath)
+    client.upload_resource_filepath("RunningStatus", source, batch_bytes=2500, retry_delay=0)
+    assert len(calls) == 2
+    assert not os.path.exists(checkpoint_path(str(source)))
+
+
+def test_plan_upload_batches(tmp_path):
+    source = make_tree(tmp_path / "upload", count=4, size=1000)
+    (source / "large.nii").write_bytes(os.urandom(5000))
+
+    batches = plan_upload_batches(str(source), batch_bytes=2500)
+    assert [[entry[0] for entry in batch] for batch in batches] == [
+        ["large.nii"],
+        [os.path.join("dir0", "file0.txt"), os.path.join("dir0", "file2.txt")],
+        [os.path.join("dir1", "file1.txt"), os.path.join("dir1", "file3.txt")],
+    ]
+
+
+def test_batch_key_changes_with_the_files(tmp_path):
+    source = make_tree(tmp_path / "upload", count=2)
+    key = batch_key(plan_upload_batches(str(source))[0])
+    assert batch_key(plan_upload_batches(str(source))[0]) == key
+
+    (source / "dir0" / "file0.txt").write_bytes(os.urandom(2000))
+    assert batch_key(plan_upload_batches(str(source))[0]) != key
+
+
+def test_checkpoint_of_another_destination_is_ignored(tmp_path):
+    path = str(tmp_path / "clean_data.upload_checkpoint.json")
+    UploadCheckpoint(path, "https://xnat/resources/A/files/").confirm("batch")
+
+    assert UploadCheckpoint(path, "https://xnat/resources/A/files/").is_confirmed("batch")
+    assert not UploadCheckpoint(path, "https://xnat/resources/B/files/").is_confirmed("batch")
+
+
+def test_modified_batch_is_uploaded_again(client, xnat, tmp_path):
+    source = make_tree(tmp_path / "upload")
+    calls = []
+    original_put = client._put
+
+    def put(url, filepath=None):
+        calls.append(url)
+        if len(calls) == 3:
+            xnat.fail_next(1)
+        return original_put(url, filepath)
+
+    client._put = put
+    with pytest.raises(Exception):
+        client.upload_resource_filepath(
+            "RunningStatus", source, batch_bytes=2500, attempts=1, retry_delay=0
+        )
+
+    # the first batch was confirmed, but one of its files changed since
+    (source / "dir0" / "file0.txt").write_bytes(os.urandom(1000))
+    os.utime(source / "dir0" / "file0.txt", (0, 0))
+    calls.clear()
+    client._put = lambda url, filepath=None: calls.append(url) or original_put(url, filepath)
+    client.upload_resource_filepath("RunningStatus", source, batch_bytes=2500, retry_delay=0)
+    assert len(calls) == 2
+    resource = os.path.join(xnat.resources_root(PROJECT, SESSION), "RunningStatus")
+    assert open(os.path.join(resource, "dir0", "file0.txt"), "rb").read() == \
+        (source / "dir0" / "file0.txt").read_bytes()
+
+
+def test_server_errors_are_retried(client, xnat, tmp_path):
+    source = tmp_path / "file.txt"
+    source.write_text("content")
+    xnat.fail_next(2)
+    r = client.upload_resource_filepath("RunningStatus", source, retry_delay=0)
+    assert r.status_code == 200
+    assert [x["status"] for x in xnat.requests if x["method"] == "PUT"] == [500, 500, 200]
+
+
+def test_reference_upload_and_delete(client, xnat, tmp_path):
+    source = make_tree(tmp_path / "clean_data")
+    client.upload_resource_filepath("MsmAll_proc", source, use_http=False)
+    assert client.resource_exists("MsmAll_proc")
+    # nothing is sent in batches, so there is nothing to resume
+    assert not os.path.exists(checkpoint_path(str(source)))
+
+    resources_root = tmp_path / "archive" / PROJECT / "arc001" / SESSION / "RESOURCES"
+    client.delete_resource("MsmAll_proc", resources_root)
+    assert not client.resource_exists("MsmAll_proc")
+
+
+def test_upload_files_packed(client, xnat, tmp_path):
+    files = {}
+    for name in ["check.log", "check.success", "hcpls2nii.log"]:
+        path = tmp_path / name
+        path.write_text(name)
+        files[f"{SESSION}/ProcessingInfo/{name}"] = path
+    large = tmp_path / "large.nii"
+    large.write_bytes(os.urandom(5000))
+    files[f"{SESSION}/large.nii"] = large
+
+    client.upload_files_packed(
+        "Structural_preproc", files, index_filepath=f"{SESSION}/ProcessingInfo/index.json", threshold=1000
+    )
+
+    assert len([x for x in xnat.requests if x["method"] == "PUT"]) == 2
+    resource = os.path.join(xnat.resources_root(PROJECT, SESSION), "Structural_preproc", SESSION)
+    for name in ["check.log", "check.success", "hcpls2nii.log", "index.json"]:
+        assert os.path.isfile(os.path.join(resource, "ProcessingInfo", name))
+    assert os.path.getsize(os.path.join(resource, "large.nii")) == 5000
@@ -1,7 +1,10 @@
+import collections
 import logging
 import os
 import subprocess
 import shlex
+import threading
+import time
 
 
 def escape_path(text):
@@ -12,32 +15,102 @@ def keep_resting_state_scans(scans):
     return [x for x in scans if not (x.startswith("t") or x.startswith("f"))]
 
 
-def shell_run(cmd):
+# lines of output kept to show what a failed command printed last
+TAIL_LINES = 50
+# seconds a command has to exit once terminated, before it is killed
+TERMINATE_GRACE_SECONDS = 10
+
+
+class ShellResult:
+    """
+    How a command of shell_run ended. True if it could be started, as shell_run used to return;
+    `ok` if it exited with 0.
+    """
+
+    def __init__(self, cmd, returncode=None, seconds=0.0, tail=(), timed_out=False, cancelled=False):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.seconds = seconds
+        self.tail = list(tail)
+        self.timed_out = timed_out
+        self.cancelled = cancelled
+
+    def __bool__(self):
+        return self.returncode is not None
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return f"ShellResult({self.cmd!r}, returncode={self.returncode}, seconds={self.seconds:.1f})"
+
+
+def shell_run(cmd, timeout=None, cancel=None, tail_lines=TAIL_LINES):
     """
-    Run a shell command and log stdout and stderr.
+    Run a shell command and log its stdout and stderr, line by line as they are printed.
 
-    Source: https://stackoverflow.com/a/21953948/11953415
+    Only the last `tail_lines` lines are kept, and logged again if the command fails.
+    The command is terminated after `timeout` seconds, or once the `cancel` event is set.
+
+    Returns:
+        ShellResult
     """
     logger = logging.getLogger("shell_run")
     logger.info('running subprocess: %s', cmd)
-    command_line_args = shlex.split(cmd)
+    start = time.monotonic()
     try:
         command_line_process = subprocess.Popen(
-            command_line_args,
+            shlex.split(cmd),
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
         )
-        stdout, _ = command_line_process.communicate()
-        logger.info("stdout:\n--------------------\n%s", stdout.decode())
-    except (OSError, subprocess.CalledProcessError) as exception:
+    except OSError as exception:
         logger.critical('Exception occured: ' + str(exception))
         logger.warning('Subprocess failed.')
-        return False
-    else:
-        # no exception was raised
-        logger.info('Subprocess finished.')
+        return ShellResult(cmd)
 
-    return True
+    tail = collections.deque(maxlen=tail_lines)
+
+    def stream():
+        for line in command_line_process.stdout:
+            line = line.decode(errors="replace").rstrip("\n")
+            tail.append(line)
+            logger.info("[%d] %s", command_line_process.pid, line)
+
+    reader = threading.Thread(target=stream, daemon=True)
+    reader.start()
+    result = ShellResult(cmd)
+    while command_line_process.poll() is None:
+        if timeout is not None and time.monotonic() - start > timeout:
+            result.timed_out = True
+        elif cancel is not None and cancel.is_set():
+            result.cancelled = True
+        else:
+            try:
+                command_line_process.wait(0.1)
+            except subprocess.TimeoutExpired:
+                pass
+            continue
+        logger.warning('Subprocess %s, terminating it.', "timed out" if result.timed_out else "cancelled")
+        command_line_process.terminate()
+        try:
+            command_line_process.wait(TERMINATE_GRACE_SECONDS)
+        except subprocess.TimeoutExpired:
+            command_line_process.kill()
+            command_line_process.wait()
+    # a child left running by a terminated command can keep the pipe open
+    reader.join(TERMINATE_GRACE_SECONDS if result.timed_out or result.cancelled else None)
+
+    result.returncode = command_line_process.returncode
+    result.seconds = time.monotonic() - start
+    result.tail = list(tail)
+    if result.ok:
+        logger.info('Subprocess finished in %.1fs.', result.seconds)
+    else:
+        logger.warning('Subprocess failed with %s after %.1fs, last lines:\n%s',
+                       result.returncode, result.seconds, "\n".join(result.tail))
+    return result
 
 
 def is_unreadable(filename):